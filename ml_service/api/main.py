@@ -1,5 +1,7 @@
 from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks, Form
-from fastapi.responses import FileResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pathlib import Path
 import shutil
 import uuid
@@ -7,13 +9,29 @@ from typing import Optional
 from model.generator import MusicGenerator
 
 app = FastAPI()
-generator = MusicGenerator()
+# CLAP's text tower is loaded once a prompt isn't in the prompt token cache, the full model once candidates are ranked
+generator = MusicGenerator(continuous_batching=True, lazy_clap=True, text_only_clap=True)
 
 def cleanup_temp_files(temp_dir: Path):
     """Clean up temporary files after response has been sent"""
     if temp_dir.exists():
         shutil.rmtree(temp_dir)
 
+@app.get("/stats/prefix_cache")
+async def prefix_cache_stats():
+    """Hits, misses, evictions and bytes held of the per-stage prefix caches"""
+    return generator.prefix_cache_stats()
+
+@app.get("/stats/prompt_token_cache")
+async def prompt_token_cache_stats():
+    """Hits, misses and entries of the prompt to clap token ids cache, and whether CLAP has been loaded"""
+    return generator.prompt_token_cache_stats()
+
+@app.get("/stats/input_token_cache")
+async def input_token_cache_stats():
+    """Hits (in memory and on disk), misses, evictions (from memory and on disk) and bytes held of the cache of uploaded audio's tokens"""
+    return generator.input_token_cache_stats()
+
 @app.post("/generate")
 async def generate_music(
     background_tasks: BackgroundTasks,
@@ -23,6 +41,9 @@ async def generate_music(
     time_steps_factor: Optional[int] = Form(5),
     temperature: Optional[float] = Form(0.95),
     prompt: Optional[str] = Form("Diverse kinds of instrument and richness"),
+    cond_scale: Optional[float] = Form(1.0),  # classifier free guidance on the prompt, 1 for none
+    n_candidates: int = Form(1),  # accompaniments generated, ranked by CLAP similarity to the prompt
+    top_k: int = Form(1),  # best candidates returned, more than 1 are returned as a zip
     save_for_eval: Optional[bool] = Form(False)
 ):
     request_id = str(uuid.uuid4())
@@ -40,8 +61,9 @@ async def generate_music(
         with input_path.open("wb") as input_file:
             shutil.copyfileobj(audio_file.file, input_file)
         
-        # Process the audio
-        output_path = generator.process_audio(
+        # Process the audio off the event loop, concurrent requests are decoded together by the generator
+        outputs = await run_in_threadpool(
+            generator.process_audio_candidates,
             audio_path=input_path,
             output_dir=output_dir,
             request_id=request_id,
@@ -50,17 +72,33 @@ async def generate_music(
             time_steps_factor=time_steps_factor,
             temperature=temperature,
             prompt=prompt,
+            cond_scale=cond_scale,
+            n_candidates=n_candidates,
+            top_k=top_k,
             save_for_eval=save_for_eval,
         )
         
         # Add cleanup task to background tasks
         background_tasks.add_task(cleanup_temp_files, temp_dir)
-        
+
+        similarities = ",".join(f"{similarity:.4f}" for _, similarity in outputs if similarity is not None)
+        headers = {"X-Clap-Similarities": similarities} if similarities else {}
+
+        if len(outputs) > 1:
+            # the best candidates, named by rank
+            archive_path = Path(shutil.make_archive(str(temp_dir / request_id), "zip", output_dir))
+            return FileResponse(
+                path=archive_path,
+                media_type="application/zip",
+                headers={"Content-Disposition": f"attachment; filename={archive_path.name}", **headers}
+            )
+
         # Return the generated file
+        output_path, _ = outputs[0]
         return FileResponse(
             path=output_path,
             media_type="audio/wav",
-            headers={"Content-Disposition": f"attachment; filename={output_path.name}"}
+            headers={"Content-Disposition": f"attachment; filename={output_path.name}", **headers}
         )
             
     except Exception as e:
@@ -69,3 +107,51 @@ async def generate_music(
             shutil.rmtree(temp_dir)
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/generate/stream")
+async def generate_music_stream(
+    audio_file: UploadFile = File(...),
+    semantic_steps: int = Form(2),
+    duration: Optional[int] = Form(3),
+    time_steps_factor: Optional[int] = Form(5),
+    temperature: Optional[float] = Form(0.95),
+    prompt: Optional[str] = Form("Diverse kinds of instrument and richness"),
+    cond_scale: Optional[float] = Form(1.0),
+):
+    """Like /generate, but the wav is streamed while it is generated"""
+    request_id = str(uuid.uuid4())
+    temp_dir = Path("temp") / request_id
+
+    try:
+        input_dir = temp_dir / "input"
+        input_dir.mkdir(parents=True)
+
+        input_path = input_dir / audio_file.filename
+        with input_path.open("wb") as input_file:
+            shutil.copyfileobj(audio_file.file, input_file)
+
+        # the first chunk (the wav header) is produced after the input is tokenized, so its errors still fail the request
+        stream = generator.stream_audio(
+            audio_path=input_path,
+            semantic_steps=semantic_steps,
+            duration=duration,
+            time_steps_factor=time_steps_factor,
+            temperature=temperature,
+            prompt=prompt,
+            cond_scale=cond_scale,
+        )
+        header = await run_in_threadpool(next, stream)
+
+        def body():
+            yield header
+            yield from stream
+
+        return StreamingResponse(
+            body(),
+            media_type="audio/wav",
+            background=BackgroundTask(cleanup_temp_files, temp_dir)
+        )
+
+    except Exception as e:
+        if temp_dir.exists():
+            shutil.rmtree(temp_dir)
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,589 @@
+import sys
+from pathlib import Path
+import argparse
+import copy
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import tempfile
+import threading
+import time
+
+import psutil
+import torch
+import torchaudio
+from einops import rearrange
+from torchaudio.functional import resample
+
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from model.generator import MusicGenerator
+from open_musiclm.config import create_clap_quantized_from_config, create_hubert_kmeans_from_config
+from open_musiclm.open_musiclm import get_or_compute_clap_token_ids
+from open_musiclm.utils import zero_mean_unit_var_norm
+from open_musiclm.transformer import Attention
+
+class PeakMemoryMonitor:
+    """Samples the resident memory of this process in a background thread and keeps the peak"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.peak = self.process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+    @property
+    def peak_increase_mb(self):
+        return (self.peak - self.baseline) / 2 ** 20
+
+def run_process_audio(generator: MusicGenerator, args, **kwargs):
+    """Run process_audio once, returns (seconds, peak memory increase in MB)"""
+    torch.manual_seed(args.seed)
+    with tempfile.TemporaryDirectory() as output_dir, PeakMemoryMonitor() as memory:
+        start = time.perf_counter()
+        generator.process_audio(
+            audio_path=Path(args.input),
+            output_dir=Path(output_dir),
+            semantic_steps=args.semantic_steps,
+            duration=args.duration,
+            time_steps_factor=args.time_steps_factor,
+            temperature=args.temperature,
+            prompt=args.prompt,
+            **kwargs
+        )
+        seconds = time.perf_counter() - start
+    return seconds, memory.peak_increase_mb
+
+def benchmark_prefill(generator: MusicGenerator, args):
+    """Compare generation time and peak memory across prefill chunk sizes (0 = no chunking)"""
+    for chunk_size in args.prefill_chunk_sizes:
+        for _ in range(args.runs):
+            seconds, peak_mb = run_process_audio(generator, args, prefill_chunk_size=chunk_size or None)
+            print(f"prefill_chunk_size={chunk_size}: {seconds:.2f}s, peak memory +{peak_mb:.0f} MB")
+
+def benchmark_concurrent(generator: MusicGenerator, args):
+    """Throughput of process_audio under several concurrent clients"""
+    def client(_):
+        for _ in range(args.requests_per_client):
+            run_process_audio(generator, args)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(client, range(args.clients)))
+    seconds = time.perf_counter() - start
+
+    num_requests = args.clients * args.requests_per_client
+    mode = "continuous batching" if args.continuous_batching else "no batching"
+    print(f"{args.clients} clients, {mode}: {num_requests} requests in {seconds:.2f}s, {num_requests / seconds:.3f} requests/s")
+
+def benchmark_compiled(generator: MusicGenerator, args):
+    """Decoding tokens/s of the coarse stage, eager vs with the compiled static shape decode step"""
+    wrapper = generator.coarse_stage.transformer_wrapper
+    num_quantizers = wrapper.token_sequences[-1].num_quantizers
+
+    generator_rng = torch.Generator().manual_seed(args.seed)
+    conditioning_token_ids = [
+        torch.randint(0, sequence.codebook_size, (1, args.conditioning_steps, sequence.num_quantizers), generator=generator_rng)
+        for sequence in wrapper.token_sequences[:-1]
+    ]
+
+    def tokens_per_second():
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        wrapper.generate(conditioning_token_ids=conditioning_token_ids, max_time_steps=args.time_steps, num_speculative_tokens=0)
+        return args.time_steps * num_quantizers / (time.perf_counter() - start)
+
+    # the first run fills the prefix cache, so the timed runs mostly measure decoding
+    tokens_per_second()
+    for _ in range(args.runs):
+        print(f"eager: {tokens_per_second():.1f} tokens/s")
+
+    start = time.perf_counter()
+    if not wrapper.compile_decoding(max_seq_len=args.max_seq_len):
+        return
+    print(f"compiled in {time.perf_counter() - start:.1f}s")
+
+    for _ in range(args.runs):
+        print(f"compiled: {tokens_per_second():.1f} tokens/s")
+
+@torch.no_grad()
+def benchmark_windows(generator: MusicGenerator, args):
+    """
+    Time to generate --output-seconds of semantic tokens in sliding windows with the semcoarsetosem stage, prefilling
+    every window as MusicLM.forward did vs carrying the cache over between windows (generate_sliding_windows)
+    """
+    wrapper = generator.semcoarsetosem_stage.transformer_wrapper
+
+    generator_rng = torch.Generator().manual_seed(args.seed)
+    conditioning_token_ids = [
+        torch.randint(0, sequence.codebook_size, (1, args.conditioning_steps, sequence.num_quantizers), generator=generator_rng)
+        for sequence in wrapper.token_sequences[:-1]
+    ]
+
+    window_size = args.window_seconds * args.steps_per_second
+    condition_length = int(window_size * (1 - args.window_step_percent))
+    first_window_size = min(args.output_seconds, args.window_seconds) * args.steps_per_second
+    num_windows = max(args.output_seconds * args.steps_per_second - first_window_size, 0) // (window_size - condition_length)
+    max_time_steps = first_window_size + num_windows * (window_size - condition_length)
+
+    def prefill_every_window():
+        token_ids = wrapper.generate(conditioning_token_ids=conditioning_token_ids, max_time_steps=first_window_size, num_speculative_tokens=0)
+        while token_ids.shape[1] < max_time_steps:
+            pred_token_ids = wrapper.generate(
+                conditioning_token_ids=conditioning_token_ids,
+                pred_token_ids=token_ids[:, -condition_length:],
+                max_time_steps=window_size,
+                num_speculative_tokens=0
+            )
+            token_ids = torch.cat((token_ids, pred_token_ids[:, condition_length:]), dim=1)
+        return token_ids
+
+    def carry_cache_over():
+        return wrapper.generate_sliding_windows(
+            conditioning_token_ids=conditioning_token_ids,
+            max_time_steps=max_time_steps,
+            window_time_steps=window_size,
+            condition_time_steps=condition_length
+        )
+
+    for name, generate in (("prefill every window", prefill_every_window), ("carry the cache over", carry_cache_over)):
+        for _ in range(args.runs):
+            # without the prefix cache, the first window of both is prefilled
+            for cache in generator.prefix_caches.values():
+                cache.clear()
+
+            torch.manual_seed(args.seed)
+            start = time.perf_counter()
+            token_ids = generate()
+            seconds = time.perf_counter() - start
+            print(f"{name}: {token_ids.shape[1]} time steps in {seconds:.2f}s, {token_ids.shape[1] / seconds:.1f} time steps/s")
+
+@torch.no_grad()
+def benchmark_sdpa(generator: MusicGenerator, args):
+    """Coarse stage logits and decoding tokens/s, einsum attention vs F.scaled_dot_product_attention"""
+    wrapper = generator.coarse_stage.transformer_wrapper
+    wrapper.eval()
+    num_quantizers = wrapper.token_sequences[-1].num_quantizers
+
+    generator_rng = torch.Generator().manual_seed(args.seed)
+    all_token_ids = [
+        torch.randint(0, sequence.codebook_size, (1, args.conditioning_steps, sequence.num_quantizers), generator=generator_rng)
+        for sequence in wrapper.token_sequences
+    ]
+
+    def set_sdpa(use_sdpa_attention):
+        for module in wrapper.modules():
+            if isinstance(module, Attention):
+                module.use_sdpa_attention = use_sdpa_attention
+
+        # so the timed generation prefills with the backend being measured
+        for cache in generator.prefix_caches.values():
+            cache.clear()
+
+    def run():
+        logits = wrapper(all_token_ids=all_token_ids, return_only_final_seq_logits=True)[-1]
+
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        wrapper.generate(conditioning_token_ids=all_token_ids[:-1], max_time_steps=args.time_steps, num_speculative_tokens=0)
+        return logits, args.time_steps * num_quantizers / (time.perf_counter() - start)
+
+    set_sdpa(False)
+    einsum_logits, einsum_tokens_per_second = run()
+    set_sdpa(True)
+    sdpa_logits, sdpa_tokens_per_second = run()
+
+    max_diff = (einsum_logits - sdpa_logits).abs().max().item()
+    top1 = (einsum_logits.argmax(dim=-1) == sdpa_logits.argmax(dim=-1)).float().mean().item()
+    print(f"logits: max abs difference {max_diff:.2e}, top-1 agreement {top1:.3f}")
+    print(f"decoding: einsum {einsum_tokens_per_second:.1f} tokens/s, sdpa {sdpa_tokens_per_second:.1f} tokens/s")
+
+def benchmark_pipeline(generator: MusicGenerator, args):
+    """
+    Time to generate for --num-inputs copies of the input, one process_audio after the other vs in the stage pipeline
+    (MusicGenerator.audio_pipeline), with the pipeline's per stage utilization timeline
+    """
+    audio_paths = [Path(args.input)] * args.num_inputs
+    stage_threads = {name: int(num_threads) for name, num_threads in (arg.split("=") for arg in args.stage_threads)}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        for audio_path in audio_paths:
+            generator.process_audio(
+                audio_path=audio_path,
+                output_dir=Path(output_dir),
+                semantic_steps=args.semantic_steps,
+                duration=args.duration,
+                time_steps_factor=args.time_steps_factor,
+                temperature=args.temperature,
+                prompt=args.prompt,
+            )
+        sequential_seconds = time.perf_counter() - start
+
+        pipeline = generator.audio_pipeline(
+            output_dir=Path(output_dir),
+            semantic_steps=args.semantic_steps,
+            duration=args.duration,
+            time_steps_factor=args.time_steps_factor,
+            temperature=args.temperature,
+            prompt=args.prompt,
+            stage_threads=stage_threads,
+        )
+        torch.manual_seed(args.seed)
+        list(pipeline.run(audio_paths))
+
+    print(f"sequential: {args.num_inputs} inputs in {sequential_seconds:.2f}s, {args.num_inputs / sequential_seconds:.3f} inputs/s")
+    print(f"pipelined: {args.num_inputs} inputs in {pipeline.seconds:.2f}s, {args.num_inputs / pipeline.seconds:.3f} inputs/s")
+    print(pipeline.format_timeline())
+
+@torch.no_grad()
+def benchmark_mert(generator: MusicGenerator, args):
+    """MERT time, peak memory and semantic token agreement, truncated after embed_layer vs all encoder layers"""
+    data, sample_hz = torchaudio.load(args.input)
+    data = zero_mean_unit_var_norm(data.mean(dim=0, keepdim=True)[:, :int(10 * sample_hz)])
+    wav = resample(data, sample_hz, generator.wav2vec.target_sample_hz).to(generator.device)
+
+    full_config = copy.deepcopy(generator.my_model_config)
+    full_config.hubert_kmeans_cfg.truncate_layers = False
+    full_wav2vec = create_hubert_kmeans_from_config(full_config, generator.checkpoint_paths["kmeans"], generator.device)
+
+    token_ids = {}
+    for name, wav2vec in (("all layers", full_wav2vec), ("truncated", generator.wav2vec)):
+        wav2vec.eval()
+        for _ in range(args.runs):
+            with PeakMemoryMonitor() as memory:
+                start = time.perf_counter()
+                token_ids[name] = wav2vec(wav, flatten=False)
+                seconds = time.perf_counter() - start
+            print(f"{name}: {seconds:.3f}s, peak memory +{memory.peak_increase_mb:.0f} MB")
+
+    agreement = (token_ids["truncated"] == token_ids["all layers"]).float().mean().item()
+    print(f"semantic token agreement: {agreement:.2%}")
+
+@torch.no_grad()
+def benchmark_encodec(generator: MusicGenerator, args):
+    """Encodec encode time of 10 s of the input, all quantizers of the bandwidth vs only the coarse ones"""
+    encodec_wrapper = generator.encodec_wrapper
+    num_coarse_quantizers = generator.model_config.global_cfg.num_coarse_quantizers
+
+    data, sample_hz = torchaudio.load(args.input)
+    data = data.mean(dim=0, keepdim=True)[:, :int(10 * sample_hz)]
+    wav = resample(data, sample_hz, encodec_wrapper.sample_rate).to(generator.device)
+
+    token_ids = {}
+    for name, num_quantizers in (("all quantizers", None), ("coarse only", num_coarse_quantizers)):
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            _, token_ids[name], _ = encodec_wrapper(wav, num_quantizers=num_quantizers)
+            seconds = time.perf_counter() - start
+            print(f"{name} ({token_ids[name].shape[-1]} levels): {seconds * 1000:.1f}ms")
+
+    coarse_match = torch.equal(token_ids["all quantizers"][..., :num_coarse_quantizers], token_ids["coarse only"])
+    print(f"coarse levels identical: {coarse_match}")
+
+@torch.no_grad()
+def benchmark_segments(generator: MusicGenerator, args):
+    """
+    Encodec encode and decode of --seconds of audio (the input repeated), all at once vs in segments: time, peak memory,
+    token agreement (overall and in the frames next to segment boundaries) and the SNR of the segmented decode
+    """
+    encodec_wrapper = generator.encodec_wrapper
+    segment_settings = (encodec_wrapper.segment_frames, encodec_wrapper.segment_workers)
+
+    data, sample_hz = torchaudio.load(args.input)
+    wav = resample(data.mean(dim=0, keepdim=True), sample_hz, encodec_wrapper.sample_rate)
+    num_samples = int(args.seconds * encodec_wrapper.sample_rate)
+    wav = wav.repeat(1, -(-num_samples // wav.shape[-1]))[:, :num_samples].to(generator.device)
+
+    results = {}
+    for name, segment_frames in (("all at once", None), ("segmented", args.segment_frames)):
+        encodec_wrapper.segment_frames, encodec_wrapper.segment_workers = segment_frames, args.segment_workers
+
+        with PeakMemoryMonitor() as encode_memory:
+            start = time.perf_counter()
+            _, token_ids, _ = encodec_wrapper(wav)
+            encode_seconds = time.perf_counter() - start
+
+        with PeakMemoryMonitor() as decode_memory:
+            start = time.perf_counter()
+            wave = encodec_wrapper.decode_from_codebook_indices(results["all at once"][0] if name == "segmented" else token_ids)
+            decode_seconds = time.perf_counter() - start
+
+        results[name] = (token_ids, wave)
+        print(f"{name}: encode {encode_seconds:.2f}s (peak memory +{encode_memory.peak_increase_mb:.0f} MB), decode {decode_seconds:.2f}s (peak memory +{decode_memory.peak_increase_mb:.0f} MB)")
+
+    encodec_wrapper.segment_frames, encodec_wrapper.segment_workers = segment_settings
+
+    (token_ids, wave), (segmented_token_ids, segmented_wave) = results["all at once"], results["segmented"]
+    matches = (token_ids == segmented_token_ids).all(dim=-1)[0]
+
+    boundaries = torch.arange(args.segment_frames, matches.shape[0], args.segment_frames)
+    near_boundaries = (boundaries[:, None] + torch.arange(-2, 2)).flatten().clamp(0, matches.shape[0] - 1)
+
+    snr = 10 * torch.log10(wave.pow(2).sum() / (wave - segmented_wave).pow(2).sum().clamp(min=1e-12))
+    print(f"frames matching: {matches.float().mean().item():.2%} overall, {matches[near_boundaries].float().mean().item():.2%} next to segment boundaries")
+    print(f"segmented decode SNR (same tokens): {snr.item():.1f} dB")
+
+@torch.no_grad()
+def benchmark_kmeans(generator: MusicGenerator, args):
+    """
+    Semantic token assignment of the input's MERT features, scikit-learn's predict on the joblib k-means model vs the
+    nearest cluster center in torch (HfHubertWithKmeans.assign_clusters). The assignments should be identical.
+    """
+    wav2vec = generator.wav2vec
+    assert wav2vec.kmeans is not None, 'the joblib k-means model is needed to compare against'
+
+    data, sample_hz = torchaudio.load(args.input)
+    data = zero_mean_unit_var_norm(data.mean(dim=0, keepdim=True)[:, :int(10 * sample_hz)])
+    wav = resample(data, sample_hz, wav2vec.target_sample_hz).to(generator.device)
+
+    embed = wav2vec(wav, return_embed=True)
+    embed = rearrange(embed, 'b n d -> (b n) d').float()
+
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        sklearn_token_ids = torch.from_numpy(wav2vec.kmeans.predict(embed.cpu().numpy())).long()
+        sklearn_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        token_ids = wav2vec.assign_clusters(embed).cpu()
+        seconds = time.perf_counter() - start
+
+        print(f"scikit-learn: {sklearn_seconds * 1000:.2f}ms, torch: {seconds * 1000:.2f}ms")
+
+    mismatches = (token_ids != sklearn_token_ids).sum().item()
+    print(f"{embed.shape[0]} features, {mismatches} assigned differently")
+
+def load_clap_cold(model_config, rvq_path, device, text_only, prompt, results):
+    """Load CLAP in a fresh process, puts (seconds, resident memory increase in MB, clap token ids of the prompt)"""
+    process = psutil.Process()
+    baseline = process.memory_info().rss
+
+    start = time.perf_counter()
+    clap = create_clap_quantized_from_config(model_config, rvq_path, device, text_only=text_only)
+    seconds = time.perf_counter() - start
+    resident_mb = (process.memory_info().rss - baseline) / 2 ** 20
+
+    clap_token_ids = get_or_compute_clap_token_ids(None, clap, None, [prompt])
+    results.put((seconds, resident_mb, clap_token_ids.cpu()))
+
+def benchmark_clap(generator: MusicGenerator, args):
+    """
+    Cold load time and resident memory of CLAP with both towers vs only the text tower (text_only_clap), each loaded in
+    a fresh process, and whether they give the prompt the same clap tokens
+    """
+    context = multiprocessing.get_context("spawn")
+
+    token_ids = {}
+    for name, text_only in (("full", False), ("text only", True)):
+        for _ in range(args.runs):
+            results = context.Queue()
+            process = context.Process(
+                target=load_clap_cold,
+                args=(generator.my_model_config, generator.checkpoint_paths["clap"], generator.device, text_only, args.prompt, results),
+            )
+            process.start()
+            seconds, resident_mb, token_ids[name] = results.get()
+            process.join()
+            print(f"{name}: loaded in {seconds:.2f}s, resident memory +{resident_mb:.0f} MB")
+
+    print(f"prompt clap tokens identical: {torch.equal(token_ids['full'], token_ids['text only'])}")
+
+def clap_text_similarity(generator: MusicGenerator, coarse_token_ids, prompt):
+    """Cosine similarity of the CLAP embeddings of the audio decoded from coarse tokens and of the prompt"""
+    wave = generator.encodec_wrapper.decode_from_codebook_indices(coarse_token_ids)
+    wave = rearrange(wave, 'b 1 n -> b n').float()
+    return generator.clap_similarities(wave, prompt).mean().item()
+
+def compare_to_fp32(generator: MusicGenerator, args, name, convert):
+    """
+    Generation time, token agreement and CLAP similarity of the generator after convert() (in place) against fp32,
+    on a fixed seed. Token agreement is reported for the input's semantic tokens (MERT), and for both stages teacher
+    forced on the fp32 generated tokens and for the sampled tokens.
+    """
+    stages = (generator.semcoarsetosem_stage, generator.coarse_stage)
+
+    def generate(conditioning_token_ids):
+        vocals_semantic_token_ids, vocals_coarse_token_ids, clap_token_ids = conditioning_token_ids
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        with generator.autocast():
+            semantic_token_ids = generator.semcoarsetosem_stage.generate(
+                vocals_semantic_token_ids=vocals_semantic_token_ids,
+                vocals_coarse_token_ids=vocals_coarse_token_ids,
+                max_time_steps=args.semantic_steps,
+                temperature=args.temperature,
+            ).squeeze(2)
+            coarse_token_ids = generator.coarse_stage.generate(
+                clap_token_ids=clap_token_ids,
+                semantic_token_ids=semantic_token_ids,
+                max_time_steps=args.duration * args.time_steps_factor,
+                temperature=args.temperature,
+            )
+        return (semantic_token_ids, coarse_token_ids), time.perf_counter() - start
+
+    @torch.no_grad()
+    def teacher_forced_predictions(conditioning_token_ids, semantic_token_ids, coarse_token_ids):
+        """most likely next token at every position of the given sequences, for both stages"""
+        vocals_semantic_token_ids, vocals_coarse_token_ids, clap_token_ids = conditioning_token_ids
+        all_token_ids = (
+            [vocals_semantic_token_ids, vocals_coarse_token_ids, semantic_token_ids],
+            [clap_token_ids, semantic_token_ids, coarse_token_ids],
+        )
+        predictions = []
+        for stage, token_ids in zip(stages, all_token_ids):
+            stage.eval()
+            with generator.autocast():
+                logits = stage.transformer_wrapper(all_token_ids=token_ids, return_only_final_seq_logits=True)[-1]
+            predictions.append(logits.argmax(dim=-1))
+        return predictions
+
+    def clap_similarity(coarse_token_ids):
+        with generator.autocast():
+            return clap_text_similarity(generator, coarse_token_ids, args.prompt)
+
+    fp32_conditioning = generator.prepare_conditioning(Path(args.input), args.prompt)
+    fp32_token_ids, fp32_seconds = generate(fp32_conditioning)
+    fp32_predictions = teacher_forced_predictions(fp32_conditioning, *fp32_token_ids)
+    fp32_similarity = clap_similarity(fp32_token_ids[1])
+
+    convert()
+
+    # conditioning from the fp32 run, so only the stage transformers differ
+    reduced_token_ids, reduced_seconds = generate(fp32_conditioning)
+    reduced_predictions = teacher_forced_predictions(fp32_conditioning, *fp32_token_ids)
+    reduced_similarity = clap_similarity(reduced_token_ids[1])
+
+    reduced_semantic_token_ids = generator.prepare_conditioning(Path(args.input), args.prompt)[0]
+    print(f"input semantic tokens: agreement {(fp32_conditioning[0] == reduced_semantic_token_ids).float().mean().item():.3f}")
+
+    for stage_name, fp32_ids, reduced_ids, fp32_pred, reduced_pred in zip(("semcoarsetosem", "coarse"), fp32_token_ids, reduced_token_ids, fp32_predictions, reduced_predictions):
+        teacher_forced = (fp32_pred == reduced_pred).float().mean().item()
+        sampled = (fp32_ids == reduced_ids).float().mean().item() if fp32_ids.shape == reduced_ids.shape else float('nan')
+        print(f"{stage_name}: teacher forced top-1 agreement {teacher_forced:.3f}, sampled token agreement {sampled:.3f}")
+
+    num_tokens = fp32_token_ids[0].numel() + fp32_token_ids[1].numel()
+    print(f"generation: fp32 {fp32_seconds:.2f}s ({num_tokens / fp32_seconds:.1f} tokens/s), {name} {reduced_seconds:.2f}s ({num_tokens / reduced_seconds:.1f} tokens/s)")
+    print(f"CLAP similarity to the prompt: fp32 {fp32_similarity:.3f}, {name} {reduced_similarity:.3f}")
+
+def benchmark_quantized(generator: MusicGenerator, args):
+    """Int8 dynamic quantized stage transformers against fp32"""
+    assert not generator.quantize and generator.precision == "fp32", 'the generator is converted in place, start from fp32'
+
+    def quantize():
+        generator.quantize = True
+        generator.quantize_transformers()
+
+    compare_to_fp32(generator, args, "int8", quantize)
+
+def benchmark_bf16(generator: MusicGenerator, args):
+    """bf16 inference against fp32"""
+    assert not generator.quantize and generator.precision == "fp32", 'the generator is converted in place, start from fp32'
+    compare_to_fp32(generator, args, "bf16", generator.use_bf16)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--semantic-steps", type=int, default=2)
+    parser.add_argument("--duration", type=int, default=3)
+    parser.add_argument("--time-steps-factor", type=int, default=5)
+    parser.add_argument("--temperature", type=float, default=0.95)
+    parser.add_argument("--prompt", type=str, default="Diverse kinds of instrument and richness")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--continuous-batching", action="store_true")
+
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    prefill_parser = subparsers.add_parser("prefill", help="time and peak memory per prefill chunk size")
+    prefill_parser.add_argument("--prefill-chunk-sizes", type=int, nargs="+", default=[0, 1024, 512, 256])
+
+    concurrent_parser = subparsers.add_parser("concurrent", help="throughput under concurrent clients")
+    concurrent_parser.add_argument("--clients", type=int, default=8)
+    concurrent_parser.add_argument("--requests-per-client", type=int, default=1)
+
+    compiled_parser = subparsers.add_parser("compiled", help="coarse decoding tokens/s, eager vs compiled")
+    compiled_parser.add_argument("--conditioning-steps", type=int, default=50)
+    compiled_parser.add_argument("--time-steps", type=int, default=75)
+    compiled_parser.add_argument("--max-seq-len", type=int, default=4096)
+
+    windows_parser = subparsers.add_parser("windows", help="long semantic generation, prefilling every sliding window vs carrying the cache over")
+    windows_parser.add_argument("--conditioning-steps", type=int, default=100)
+    windows_parser.add_argument("--output-seconds", type=int, default=60)
+    windows_parser.add_argument("--window-seconds", type=int, default=10)
+    windows_parser.add_argument("--window-step-percent", type=float, default=0.5)
+    windows_parser.add_argument("--steps-per-second", type=int, default=50)
+
+    sdpa_parser = subparsers.add_parser("sdpa", help="einsum vs scaled dot product attention, logit parity and decoding tokens/s")
+    sdpa_parser.add_argument("--conditioning-steps", type=int, default=50)
+    sdpa_parser.add_argument("--time-steps", type=int, default=75)
+
+    subparsers.add_parser("mert", help="MERT time, peak memory and token agreement, truncated after embed_layer vs all layers")
+
+    subparsers.add_parser("encodec", help="Encodec encode time on 10 s of the input, all quantizers vs coarse only")
+    segments_parser = subparsers.add_parser("segments", help="Encodec on long audio, all at once vs in segments")
+    segments_parser.add_argument("--seconds", type=float, default=180)
+    segments_parser.add_argument("--segment-frames", type=int, default=750)
+    segments_parser.add_argument("--segment-workers", type=int, default=1)
+
+    subparsers.add_parser("kmeans", help="semantic token assignment, scikit-learn predict vs torch, time and equivalence")
+
+    subparsers.add_parser("clap", help="CLAP cold load time and resident memory, both towers vs the text tower only")
+
+    pipeline_parser = subparsers.add_parser("pipeline", help="throughput over many inputs, one after the other vs in the stage pipeline")
+    pipeline_parser.add_argument("--num-inputs", type=int, default=4)
+    pipeline_parser.add_argument("--stage-threads", type=str, nargs="*", default=[], help="intra-op threads per stage, e.g. semantic=4 coarse=8")
+
+    subparsers.add_parser("quantized", help="int8 quantized vs fp32 speed, token agreement and CLAP similarity")
+    subparsers.add_parser("bf16", help="bf16 vs fp32 speed, token agreement and CLAP similarity")
+
+    args = parser.parse_args()
+
+    generator = MusicGenerator(continuous_batching=args.continuous_batching)
+
+    if args.benchmark == "prefill":
+        benchmark_prefill(generator, args)
+    elif args.benchmark == "concurrent":
+        benchmark_concurrent(generator, args)
+    elif args.benchmark == "compiled":
+        benchmark_compiled(generator, args)
+    elif args.benchmark == "windows":
+        benchmark_windows(generator, args)
+    elif args.benchmark == "sdpa":
+        benchmark_sdpa(generator, args)
+    elif args.benchmark == "mert":
+        benchmark_mert(generator, args)
+    elif args.benchmark == "encodec":
+        benchmark_encodec(generator, args)
+    elif args.benchmark == "segments":
+        benchmark_segments(generator, args)
+    elif args.benchmark == "kmeans":
+        benchmark_kmeans(generator, args)
+    elif args.benchmark == "clap":
+        benchmark_clap(generator, args)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(generator, args)
+    elif args.benchmark == "quantized":
+        benchmark_quantized(generator, args)
+    elif args.benchmark == "bf16":
+        benchmark_bf16(generator, args)
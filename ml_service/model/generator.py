@@ -4,12 +4,18 @@ import torch
 import torchaudio
 import argparse
 import json
+import hashlib
 import shutil
 from datetime import datetime
 import uuid
-from einops import rearrange
 from torchaudio.functional import resample
-from typing import Optional
+from typing import Callable, Dict, Iterator, List, Literal, Optional, Tuple
+import queue
+import struct
+import threading
+
+import torch.nn.functional as F
+from einops import rearrange
 
 project_root = Path(__file__).parent.parent
 sys.path.append(str(project_root))
@@ -17,6 +23,7 @@ sys.path.append(str(project_root))
 from open_musiclm.config import (
     create_clap_quantized_from_config,
     create_coarse_transformer_from_config,
+    create_coarse_draft_transformer_from_config,
     create_semcoarsetosem_transformer_from_config,
     create_encodec_from_config,
     create_hubert_kmeans_from_config,
@@ -28,10 +35,50 @@ from open_musiclm.open_musiclm import (
     get_or_compute_acoustic_token_ids,
     get_or_compute_semantic_token_ids
 )
+from open_musiclm.continuous_batching import ContinuousBatchingScheduler
+from open_musiclm.pipeline import PipelineStage, StagePipeline
+from open_musiclm.prefix_cache import PrefixCache
+from open_musiclm.quantization import quantize_dynamic_int8
+from open_musiclm.token_cache import InputTokenCache, PromptTokenCache, file_sha1
 from open_musiclm.utils import int16_to_float32, float32_to_int16, zero_mean_unit_var_norm
 
+def clap_fingerprint(model_config, rvq_checkpoint_path: Path) -> str:
+    """Identifies the CLAP model and RVQ checkpoint that turn prompts into clap token ids, see PromptTokenCache"""
+    clap_config = json.dumps(vars(model_config.clap_rvq_cfg), sort_keys=True, default=str)
+    return hashlib.sha1(f"{clap_config}:{file_sha1(rvq_checkpoint_path)}".encode()).hexdigest()
+
+def wav_stream_header(sample_rate: int, num_channels: int = 1, bits_per_sample: int = 16) -> bytes:
+    """Header of a pcm wav of unknown length, for streaming"""
+    block_align = num_channels * bits_per_sample // 8
+    unknown_size = 0xFFFFFFFF
+    return (
+        b"RIFF" + struct.pack("<I", unknown_size) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, num_channels, sample_rate, sample_rate * block_align, block_align, bits_per_sample)
+        + b"data" + struct.pack("<I", unknown_size)
+    )
+
+def wave_to_pcm16_bytes(wave: torch.Tensor) -> bytes:
+    """16 bit pcm of the first wave of a batch [B, 1, n]"""
+    return float32_to_int16(wave[0, 0].detach().float().cpu()).numpy().tobytes()
+
 class MusicGenerator:
-    def __init__(self):
+    def __init__(
+        self,
+        prefix_cache_max_bytes: int = 512 * 2 ** 20,
+        continuous_batching: bool = False,
+        max_batch_size: int = 8,
+        speculative_decoding: bool = False,
+        compiled_decoding: bool = False,
+        static_max_seq_len: int = 4096,
+        quantize: bool = False,
+        quantize_logit_weights: bool = False,
+        precision: Literal["fp32", "bf16"] = "fp32",
+        input_token_cache_dir: Optional[Path] = project_root / "cache" / "input_tokens",
+        input_token_cache_max_bytes: int = 1024 * 2 ** 20,
+        prompt_token_cache_path: Optional[Path] = project_root / "cache" / "clap_prompt_tokens.json",
+        lazy_clap: bool = False,
+        text_only_clap: bool = False,
+    ):
         self.base_dir = project_root
         self.weights_dir = self.base_dir / "model_weights"
         
@@ -47,11 +94,80 @@ class MusicGenerator:
             "clap": self.weights_dir / "clap.rvq.950_no_fusion.pt",
             "semcoarsetosem": self.weights_dir / "real_semcoarsetosem.transformer.5170.pt",
             "coarse": self.weights_dir / "coarse.transformer.18000.pt",
+            "coarse_draft": self.weights_dir / "coarse_draft.transformer.pt",
         }
 
         self.device = 'cpu'
+
+        # a shallow draft transformer proposes coarse tokens that the coarse transformer verifies (single requests only)
+        self.speculative_decoding = speculative_decoding
+
+        # int8 dynamic quantization of the stage transformers' linear layers
+        self.quantize = quantize
+        self.quantize_logit_weights = quantize_logit_weights
+
+        # bf16 autocast of the transformers, MERT and the Encodec decoder, see use_bf16
+        self.precision = "fp32"
+
+        # prefilled conditioning prefixes, shared across requests (one cache per stage)
+        self.prefix_caches = {
+            "semcoarsetosem": PrefixCache(max_bytes=prefix_cache_max_bytes),
+            "coarse": PrefixCache(max_bytes=prefix_cache_max_bytes),
+        }
+
+        # semantic and coarse tokens of uploaded audio, shared with other worker processes through the cache directory
+        # (keyed by the k-means checkpoint's content, so replacing it under the same name doesn't serve stale tokens)
+        self.kmeans_sha1 = file_sha1(self.checkpoint_paths["kmeans"])
+        self.input_token_cache = InputTokenCache(
+            cache_dir=input_token_cache_dir,
+            max_disk_bytes=input_token_cache_max_bytes,
+        )
+
+        # clap token ids of prompts, seeded with the shipped table of common prompts (model/precompute_prompt_tokens.py)
+        self.prompt_token_cache = PromptTokenCache(
+            fingerprint=clap_fingerprint(self.my_model_config, self.checkpoint_paths["clap"]),
+            path=prompt_token_cache_path,
+            shipped_path=self.weights_dir / "clap_prompt_tokens.json",
+        )
+
+        # load CLAP only once a prompt isn't cached (or candidates are ranked)
+        self.lazy_clap = lazy_clap
+        self._clap = None
+        self.clap_lock = threading.Lock()
+
+        # embed prompts with only the CLAP text tower, the full model is loaded only to rank candidates
+        self.text_only_clap = text_only_clap
+        self._clap_text = None
+
+        self.schedulers = None
+
+        assert not (quantize and precision == "bf16"), "int8 quantization and bf16 can't be combined"
+
         self._initialize_models()
 
+        if precision == "bf16":
+            self.use_bf16()
+
+        # decode with a compiled static shape step, compiled here at startup rather than on the first request
+        if compiled_decoding:
+            with self.autocast():
+                for stage in (self.semcoarsetosem_stage, self.coarse_stage):
+                    stage.transformer_wrapper.compile_decoding(max_seq_len=static_max_seq_len)
+
+        # concurrent process_audio calls are decoded together, one batch per stage
+        if continuous_batching:
+            autocast_dtype = torch.bfloat16 if self.precision == "bf16" else None
+            self.schedulers = {
+                "semcoarsetosem": ContinuousBatchingScheduler(
+                    self.semcoarsetosem_stage.transformer_wrapper, max_batch_size=max_batch_size, autocast_dtype=autocast_dtype
+                ),
+                "coarse": ContinuousBatchingScheduler(
+                    self.coarse_stage.transformer_wrapper, max_batch_size=max_batch_size, autocast_dtype=autocast_dtype
+                ),
+            }
+            for scheduler in self.schedulers.values():
+                scheduler.start()
+
     def _initialize_models(self):
         """Initialize all required models and stages"""
         self.wav2vec = create_hubert_kmeans_from_config(
@@ -62,9 +178,8 @@ class MusicGenerator:
             self.my_model_config, self.device
         )
 
-        self.clap = create_clap_quantized_from_config(
-            self.my_model_config, self.checkpoint_paths["clap"], self.device
-        )
+        if not self.lazy_clap:
+            self.load_clap(text_only=self.text_only_clap)
 
         self.semcoarsetosem_transformer = create_semcoarsetosem_transformer_from_config(
             self.my_model_config, self.checkpoint_paths["semcoarsetosem"], self.device
@@ -72,39 +187,156 @@ class MusicGenerator:
         self.coarse_transformer = create_coarse_transformer_from_config(
             self.model_config, self.checkpoint_paths["coarse"], self.device
         )
+        self.coarse_draft_transformer = None
+        if self.speculative_decoding:
+            self.coarse_draft_transformer = create_coarse_draft_transformer_from_config(
+                self.model_config, self.checkpoint_paths["coarse_draft"], self.device
+            )
+
+        if self.quantize:
+            self.quantize_transformers()
 
         self.semcoarsetosem_stage = SemcoarsetosemStage(
             semcoarsetosem_transformer=self.semcoarsetosem_transformer,
             neural_codec=self.encodec_wrapper,
             wav2vec=self.wav2vec,
+            prefix_cache=self.prefix_caches["semcoarsetosem"],
         )
         self.coarse_stage = CoarseStage(
             coarse_transformer=self.coarse_transformer,
             neural_codec=self.encodec_wrapper,
             wav2vec=self.wav2vec,
-            clap=self.clap
+            clap=None,    # the clap token ids are always given
+            prefix_cache=self.prefix_caches["coarse"],
+            draft_transformer=self.coarse_draft_transformer,
         )
 
-    def process_audio(
-        self,
-        audio_path: Path,
-        output_dir: Path,
-        semantic_steps: int,
-        duration: int,
-        time_steps_factor: int,
-        temperature: float,
-        prompt: str,
-        request_id: Optional[str] = None,
-        save_for_eval: bool = False,
-    ) -> Path:
-        """Process audio file and generate accompaniment"""
-        output_dir = Path(output_dir)
-        output_dir.mkdir(parents=True, exist_ok=True)
+    def load_clap(self, text_only: bool = False):
+        """ClapQuantized, text_only: one with only the text tower, unless the full model is already loaded"""
+        with self.clap_lock:
+            if self._clap is not None:
+                return self._clap
+
+            if text_only:
+                if self._clap_text is None:
+                    self._clap_text = create_clap_quantized_from_config(
+                        self.my_model_config, self.checkpoint_paths["clap"], self.device, text_only=True
+                    )
+                return self._clap_text
+
+            self._clap = create_clap_quantized_from_config(
+                self.my_model_config, self.checkpoint_paths["clap"], self.device
+            )
+            # the full model embeds text too
+            self._clap_text = None
+            return self._clap
+
+    @property
+    def clap(self):
+        """ClapQuantized with both towers, loaded on first use with lazy_clap or text_only_clap"""
+        return self._clap if self._clap is not None else self.load_clap()
+
+    @property
+    def clap_text(self):
+        """ClapQuantized to embed prompts, only its text tower is loaded with text_only_clap"""
+        if self._clap is not None:
+            return self._clap
+        return self._clap_text if self._clap_text is not None else self.load_clap(text_only=self.text_only_clap)
 
+    def clap_token_ids(self, prompt: str) -> torch.Tensor:
+        """Clap token ids (1, n, 1) of the prompt, from the prompt token cache if it has them"""
+        clap_token_ids = self.prompt_token_cache.get(prompt)
+        if clap_token_ids is not None:
+            return clap_token_ids.to(self.device)
+
+        clap_token_ids = get_or_compute_clap_token_ids(None, self.clap_text, None, [prompt])
+        self.prompt_token_cache.put(prompt, clap_token_ids)
+        return clap_token_ids
+
+    def autocast(self):
+        """Context to run MERT, the stage transformers and the Encodec decoder in"""
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.precision == "bf16")
+
+    def use_bf16(self):
+        """
+        Switch to bf16 inference (for CPUs with AVX512-BF16 / AMX), in place. The stage transformers are cast to bf16,
+        MERT and the Encodec decoder stay in fp32 and are autocast. l2norm and softmax in attention, the logits,
+        zero_mean_unit_var_norm and the k-means distances are kept in fp32.
+        """
+        self.precision = "bf16"
+
+        transformers = [self.semcoarsetosem_transformer, self.coarse_transformer]
+        if self.coarse_draft_transformer is not None:
+            transformers.append(self.coarse_draft_transformer)
+
+        for transformer in transformers:
+            transformer.to(torch.bfloat16)
+
+        # cached prefixes were prefilled in fp32
+        for cache in self.prefix_caches.values():
+            cache.clear()
+
+        if self.schedulers is not None:
+            for scheduler in self.schedulers.values():
+                scheduler.autocast_dtype = torch.bfloat16
+
+    def quantize_transformers(self):
+        """Int8 dynamic quantization of the stage transformers, in place"""
+        transformers = [self.semcoarsetosem_transformer, self.coarse_transformer]
+        if self.coarse_draft_transformer is not None:
+            transformers.append(self.coarse_draft_transformer)
+
+        for transformer in transformers:
+            quantize_dynamic_int8(transformer, quantize_logit_weights=self.quantize_logit_weights)
+
+        # cached prefixes were prefilled at full precision
+        for cache in self.prefix_caches.values():
+            cache.clear()
+
+    def prefix_cache_stats(self) -> dict:
+        """Hits, misses, evictions and bytes held of the prefix cache of each stage"""
+        return {name: cache.stats() for name, cache in self.prefix_caches.items()}
+
+    def prompt_token_cache_stats(self) -> dict:
+        """Hits, misses and entries of the prompt token cache, and whether CLAP is loaded"""
+        return {
+            **self.prompt_token_cache.stats(),
+            "clap_loaded": self._clap is not None,
+            "clap_text_tower_loaded": self._clap is not None or self._clap_text is not None,
+        }
+
+    def input_token_cache_stats(self) -> dict:
+        """Hits (in memory and on disk), misses, evictions (from memory and on disk) and bytes held of the input token cache"""
+        return self.input_token_cache.stats()
+
+    def input_token_fingerprint(self) -> str:
+        """Identifies the models and settings the input tokens are computed with, part of the input token cache key"""
+        fingerprint = json.dumps({
+            "hubert_kmeans": vars(self.my_model_config.hubert_kmeans_cfg),
+            "encodec": vars(self.my_model_config.encodec_cfg),
+            "kmeans": self.kmeans_sha1,
+            "num_coarse_quantizers": self.model_config.global_cfg.num_coarse_quantizers,
+            "precision": self.precision,
+        }, sort_keys=True, default=str)
+        return hashlib.sha1(fingerprint.encode()).hexdigest()
+
+    def prepare_conditioning(self, audio_path: Path, prompt: str):
+        """
+        Semantic and coarse acoustic tokens of (the first 10 seconds of) the input audio, and the clap tokens of the
+        prompt. The input tokens are cached by the decoded samples, so uploading the same audio again skips them.
+        """
         data, sample_hz = torchaudio.load(audio_path)
         if data.shape[0] > 1:
             data = torch.mean(data, dim=0).unsqueeze(0)
 
+        clap_token_ids = self.clap_token_ids(prompt)
+
+        cache_key = self.input_token_cache.key(data, sample_hz, self.input_token_fingerprint())
+        cached = self.input_token_cache.get(cache_key)
+        if cached is not None:
+            vocals_semantic_token_ids, vocals_coarse_token_ids = (t.to(self.device) for t in cached)
+            return vocals_semantic_token_ids, vocals_coarse_token_ids, clap_token_ids
+
         target_length = int(10 * sample_hz)
         normalized_data = zero_mean_unit_var_norm(data)
         data = data[:, :target_length]
@@ -116,45 +348,341 @@ class MusicGenerator:
         audio_for_encodec = int16_to_float32(float32_to_int16(audio_for_encodec)).to(self.device)
         audio_for_wav2vec = int16_to_float32(float32_to_int16(audio_for_wav2vec)).to(self.device)
 
-        vocals_semantic_token_ids = get_or_compute_semantic_token_ids(
-            None, audio_for_wav2vec, self.wav2vec
-        )
+        with self.autocast():
+            vocals_semantic_token_ids = get_or_compute_semantic_token_ids(
+                None, audio_for_wav2vec, self.wav2vec
+            )
         vocals_coarse_token_ids, _ = get_or_compute_acoustic_token_ids(
             None, None, audio_for_encodec, self.encodec_wrapper, 
-            self.model_config.global_cfg.num_coarse_quantizers
+            self.model_config.global_cfg.num_coarse_quantizers,
+            coarse_only=True
         )
-            
-        clap_token_ids = get_or_compute_clap_token_ids(None, self.clap, None, [prompt])
 
-        generated_inst_semantic_ids = self.semcoarsetosem_stage.generate(
-            vocals_semantic_token_ids=vocals_semantic_token_ids,
-            vocals_coarse_token_ids=vocals_coarse_token_ids,
-            max_time_steps=semantic_steps,
+        self.input_token_cache.put(cache_key, [vocals_semantic_token_ids, vocals_coarse_token_ids])
+
+        return vocals_semantic_token_ids, vocals_coarse_token_ids, clap_token_ids
+
+    def generate_coarse_token_ids(
+        self,
+        vocals_semantic_token_ids: torch.Tensor,
+        vocals_coarse_token_ids: torch.Tensor,
+        clap_token_ids: torch.Tensor,
+        *,
+        semantic_steps: int,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        n_candidates: int = 1,
+        on_time_step: Optional[Callable[[torch.Tensor], None]] = None,
+    ) -> torch.Tensor:
+        """
+        Generate the semantic tokens of the accompaniment, then its coarse acoustic tokens (b * n_candidates, n, q)
+
+        cond_scale is the classifier free guidance scale of the coarse stage on the prompt (1 for none)
+        n_candidates coarse token sequences are sampled per semantic token sequence, from a single prefill
+        on_time_step is called with the coarse tokens (b * n_candidates, 1, q) of every time step once sampled
+        """
+        generated_inst_semantic_ids = self.generate_semantic_token_ids(
+            vocals_semantic_token_ids,
+            vocals_coarse_token_ids,
+            semantic_steps=semantic_steps,
+            temperature=temperature,
+            prefill_chunk_size=prefill_chunk_size,
+        )
+
+        return self.generate_coarse_token_ids_from_semantic(
+            generated_inst_semantic_ids,
+            clap_token_ids,
+            duration=duration,
+            time_steps_factor=time_steps_factor,
+            temperature=temperature,
+            prefill_chunk_size=prefill_chunk_size,
+            cond_scale=cond_scale,
+            n_candidates=n_candidates,
+            on_time_step=on_time_step,
+        )
+
+    def generate_semantic_token_ids(
+        self,
+        vocals_semantic_token_ids: torch.Tensor,
+        vocals_coarse_token_ids: torch.Tensor,
+        *,
+        semantic_steps: int,
+        temperature: float,
+        prefill_chunk_size: Optional[int] = 512,
+    ) -> torch.Tensor:
+        """Semantic tokens of the accompaniment, from the semantic and coarse acoustic tokens of the input"""
+        # autocast is thread local, schedulers enter it in their own thread
+        with self.autocast():
+            if self.schedulers is not None:
+                return self.schedulers["semcoarsetosem"].generate(
+                    conditioning_token_ids=[vocals_semantic_token_ids, vocals_coarse_token_ids],
+                    max_time_steps=semantic_steps,
+                    temperature=temperature,
+                    prefill_chunk_size=prefill_chunk_size,
+                )
+
+            return self.semcoarsetosem_stage.generate(
+                vocals_semantic_token_ids=vocals_semantic_token_ids,
+                vocals_coarse_token_ids=vocals_coarse_token_ids,
+                max_time_steps=semantic_steps,
+                temperature=temperature,
+                prefill_chunk_size=prefill_chunk_size,
+            )
+
+    def generate_coarse_token_ids_from_semantic(
+        self,
+        generated_inst_semantic_ids: torch.Tensor,
+        clap_token_ids: torch.Tensor,
+        *,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        n_candidates: int = 1,
+        on_time_step: Optional[Callable[[torch.Tensor], None]] = None,
+    ) -> torch.Tensor:
+        """Coarse acoustic tokens of the accompaniment (b * n_candidates, n, q), see generate_coarse_token_ids"""
+        with self.autocast():
+            # the scheduler decodes single samples without guidance or streaming, other requests are generated on their own
+            if self.schedulers is not None and cond_scale == 1 and n_candidates == 1 and on_time_step is None:
+                return self.schedulers["coarse"].generate(
+                    conditioning_token_ids=[clap_token_ids, generated_inst_semantic_ids.squeeze(2)],
+                    max_time_steps=duration * time_steps_factor,
+                    temperature=temperature,
+                    prefill_chunk_size=prefill_chunk_size,
+                )
+
+            return self.coarse_stage.generate(
+                clap_token_ids=clap_token_ids,
+                semantic_token_ids=generated_inst_semantic_ids.squeeze(2),
+                max_time_steps=duration * time_steps_factor,
+                include_eos_in_output=False,
+                append_eos_to_conditioning_tokens=True,
+                temperature=temperature,
+                prefill_chunk_size=prefill_chunk_size,
+                cond_scale=cond_scale,
+                num_samples=n_candidates,
+                on_time_step=on_time_step,
+            )
+
+    def stream_audio(
+        self,
+        audio_path: Path,
+        semantic_steps: int,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prompt: str,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        chunk_frames: int = 15,
+    ) -> Iterator[bytes]:
+        """
+        Generate an accompaniment like process_audio, as a 16 bit mono wav streamed while it is generated. The coarse
+        tokens are decoded chunk_frames Encodec frames at a time, as soon as they are sampled.
+        """
+        conditioning_token_ids = self.prepare_conditioning(audio_path, prompt)
+
+        # generation runs in its own thread, handing over the coarse tokens of every time step
+        time_steps = queue.Queue()
+        end = object()
+
+        def generate():
+            try:
+                self.generate_coarse_token_ids(
+                    *conditioning_token_ids,
+                    semantic_steps=semantic_steps,
+                    duration=duration,
+                    time_steps_factor=time_steps_factor,
+                    temperature=temperature,
+                    prefill_chunk_size=prefill_chunk_size,
+                    cond_scale=cond_scale,
+                    on_time_step=time_steps.put,
+                )
+                time_steps.put(end)
+            except Exception as e:
+                time_steps.put(e)
+
+        threading.Thread(target=generate, daemon=True).start()
+
+        yield wav_stream_header(self.encodec_wrapper.sample_rate)
+
+        decoder = self.encodec_wrapper.incremental_decoder(chunk_frames=chunk_frames)
+        eos_id = self.coarse_stage.transformer_wrapper.eos_ids[-1]
+
+        while True:
+            token_ids = time_steps.get()
+
+            if token_ids is end:
+                break
+            if isinstance(token_ids, Exception):
+                raise token_ids
+
+            # the time step holding eos ends the sequence
+            if (token_ids == eos_id).any() or (token_ids < 0).any():
+                continue
+
+            with self.autocast():
+                wave = decoder.push(token_ids)
+            yield wave_to_pcm16_bytes(wave)
+
+        with self.autocast():
+            wave = decoder.flush()
+        yield wave_to_pcm16_bytes(wave)
+
+    def clap_similarities(self, waves: torch.Tensor, prompt: str) -> torch.Tensor:
+        """Cosine similarity of the CLAP embeddings of waves (b, n) at the Encodec sample rate and of the prompt, (b,)"""
+        clap_input = resample(waves, self.encodec_wrapper.sample_rate, self.clap.sample_rate)
+        clap_input = int16_to_float32(float32_to_int16(clap_input))
+
+        # all candidates go through the audio tower as one batch, the prompt's embedding is cached by clap
+        audio_latents = self.clap(audio_input=list(clap_input), return_embedding=True)
+        text_latents = self.clap(text_input=[prompt], return_embedding=True)
+        return F.cosine_similarity(audio_latents, text_latents, dim=-1)
+
+    def process_audio(
+        self,
+        audio_path: Path,
+        output_dir: Path,
+        semantic_steps: int,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prompt: str,
+        request_id: Optional[str] = None,
+        save_for_eval: bool = False,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        n_candidates: int = 1,
+    ) -> Path:
+        """Process audio file and generate accompaniment
+
+        prefill_chunk_size bounds how many conditioning positions are run through the transformers at once
+        (None for all at once), trading a little speed for much lower peak memory.
+        cond_scale is the classifier free guidance scale on the prompt, 1 for none.
+        n_candidates accompaniments are generated and the one closest to the prompt by CLAP is returned.
+        """
+        (output_path, _), = self.process_audio_candidates(
+            audio_path=audio_path,
+            output_dir=output_dir,
+            semantic_steps=semantic_steps,
+            duration=duration,
+            time_steps_factor=time_steps_factor,
             temperature=temperature,
+            prompt=prompt,
+            request_id=request_id,
+            save_for_eval=save_for_eval,
+            prefill_chunk_size=prefill_chunk_size,
+            cond_scale=cond_scale,
+            n_candidates=n_candidates,
+            top_k=1,
         )
+        return output_path
+
+    def process_audio_candidates(
+        self,
+        audio_path: Path,
+        output_dir: Path,
+        semantic_steps: int,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prompt: str,
+        request_id: Optional[str] = None,
+        save_for_eval: bool = False,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        n_candidates: int = 1,
+        top_k: int = 1,
+    ) -> List[Tuple[Path, Optional[float]]]:
+        """
+        Generate n_candidates accompaniments and keep the top_k closest to the prompt by CLAP, best first.
+        Returns their output paths with their CLAP similarity (None for a single candidate, which isn't ranked).
 
-        generated_wave = self.coarse_stage.generate(
-            clap_token_ids=clap_token_ids,
-            semantic_token_ids=generated_inst_semantic_ids.squeeze(2),
-            max_time_steps=duration * time_steps_factor,
-            reconstruct_wave=True,
-            include_eos_in_output=False,
-            append_eos_to_conditioning_tokens=True,
+        The candidates share the generated semantic tokens and the coarse stage's prefilled conditioning, they are
+        sampled as one batch.
+        """
+        assert 1 <= top_k <= n_candidates, 'top_k must be between 1 and n_candidates'
+
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+
+        conditioning_token_ids = self.prepare_conditioning(audio_path, prompt)
+
+        generated_coarse_ids = self.generate_coarse_token_ids(
+            *conditioning_token_ids,
+            semantic_steps=semantic_steps,
+            duration=duration,
+            time_steps_factor=time_steps_factor,
             temperature=temperature,
+            prefill_chunk_size=prefill_chunk_size,
+            cond_scale=cond_scale,
+            n_candidates=n_candidates,
         )
 
-        generated_wave = rearrange(generated_wave, 'b n -> b 1 n').detach().cpu()
+        return self.save_candidates(
+            audio_path,
+            output_dir,
+            generated_coarse_ids,
+            prompt=prompt,
+            top_k=top_k,
+            request_id=request_id,
+            save_for_eval=save_for_eval,
+            parameters={
+                "semantic_steps": semantic_steps,
+                "duration": duration,
+                "time_steps_factor": time_steps_factor,
+                "temperature": temperature,
+                "cond_scale": cond_scale,
+                "n_candidates": n_candidates,
+            },
+        )
+
+    def save_candidates(
+        self,
+        audio_path: Path,
+        output_dir: Path,
+        generated_coarse_ids: torch.Tensor,
+        *,
+        prompt: str,
+        top_k: int = 1,
+        request_id: Optional[str] = None,
+        save_for_eval: bool = False,
+        parameters: Optional[dict] = None,
+    ) -> List[Tuple[Path, Optional[float]]]:
+        """Decode the candidates' coarse tokens and save the top_k closest to the prompt by CLAP, see process_audio_candidates"""
+        n_candidates = generated_coarse_ids.shape[0]
+
+        with self.autocast():
+            generated_waves = self.encodec_wrapper.decode_from_codebook_indices(generated_coarse_ids)
+        generated_waves = generated_waves.detach().float().cpu()
+
+        if n_candidates > 1:
+            similarities = self.clap_similarities(rearrange(generated_waves, 'b 1 n -> b n'), prompt)
+            ranked = similarities.topk(top_k, sorted=True).indices.tolist()
+            similarities = similarities.tolist()
+        else:
+            ranked, similarities = [0], [None]
 
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_name = f"{audio_path.stem}_{timestamp}_generated.wav"
-        output_path = output_dir / output_name
 
-        torchaudio.save(output_path, generated_wave[0], self.encodec_wrapper.sample_rate)
+        outputs = []
+        for rank, candidate in enumerate(ranked):
+            suffix = "" if top_k == 1 else f"_{rank}"
+            output_path = output_dir / f"{audio_path.stem}_{timestamp}_generated{suffix}.wav"
+            torchaudio.save(output_path, generated_waves[candidate], self.encodec_wrapper.sample_rate)
+            outputs.append((output_path, similarities[candidate]))
 
         if save_for_eval:
             save_dir = self.base_dir / "saved_generations"
             save_dir.mkdir(exist_ok=True)
             
+            output_path, clap_similarity = outputs[0]
+
             request_id = request_id or str(uuid.uuid4())
             shutil.copy2(audio_path, save_dir / f"{request_id}_input.wav")
             shutil.copy2(output_path, save_dir / f"{request_id}_output.wav")
@@ -164,11 +692,9 @@ class MusicGenerator:
                 "timestamp": datetime.now().isoformat(),
                 "input_file": audio_path.name,
                 "output_file": output_path.name,
+                "clap_similarity": clap_similarity,
                 "parameters": {
-                    "semantic_steps": semantic_steps,
-                    "duration": duration,
-                    "time_steps_factor": time_steps_factor,
-                    "temperature": temperature,
+                    **(parameters or {}),
                     "prompt": prompt[0] if prompt else None
                 }
             }
@@ -176,29 +702,146 @@ class MusicGenerator:
             with open(save_dir / f"{request_id}_metadata.json", 'w') as f:
                 json.dump(metadata, f, indent=2)
 
-        return output_path
+        return outputs
+
+    def audio_pipeline(
+        self,
+        output_dir: Path,
+        semantic_steps: int,
+        duration: int,
+        time_steps_factor: int,
+        temperature: float,
+        prompt: str,
+        save_for_eval: bool = False,
+        prefill_chunk_size: Optional[int] = 512,
+        cond_scale: float = 1.,
+        n_candidates: int = 1,
+        top_k: int = 1,
+        stage_threads: Optional[Dict[str, int]] = None,
+    ) -> StagePipeline:
+        """
+        process_audio_candidates split into stages that run on their own threads, for many input files: while the
+        coarse stage generates for one file, the semantic stage already generates for the next and the Encodec
+        decoder decodes the previous one. pipeline.run(audio_paths) yields the outputs of each file in order,
+        pipeline.utilization() and pipeline.format_timeline() report how busy every stage was.
+
+        stage_threads sets the intra-op threads of the stages "conditioning" (MERT, Encodec encoder, CLAP), "semantic",
+        "coarse" and "decode" (Encodec decoder, CLAP ranking, saving).
+        """
+        assert 1 <= top_k <= n_candidates, 'top_k must be between 1 and n_candidates'
+
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        stage_threads = stage_threads or {}
+
+        def conditioning(audio_path):
+            return audio_path, self.prepare_conditioning(audio_path, prompt)
+
+        def semantic(job):
+            audio_path, (vocals_semantic_token_ids, vocals_coarse_token_ids, clap_token_ids) = job
+            generated_inst_semantic_ids = self.generate_semantic_token_ids(
+                vocals_semantic_token_ids,
+                vocals_coarse_token_ids,
+                semantic_steps=semantic_steps,
+                temperature=temperature,
+                prefill_chunk_size=prefill_chunk_size,
+            )
+            return audio_path, generated_inst_semantic_ids, clap_token_ids
+
+        def coarse(job):
+            audio_path, generated_inst_semantic_ids, clap_token_ids = job
+            generated_coarse_ids = self.generate_coarse_token_ids_from_semantic(
+                generated_inst_semantic_ids,
+                clap_token_ids,
+                duration=duration,
+                time_steps_factor=time_steps_factor,
+                temperature=temperature,
+                prefill_chunk_size=prefill_chunk_size,
+                cond_scale=cond_scale,
+                n_candidates=n_candidates,
+            )
+            return audio_path, generated_coarse_ids
+
+        def decode(job):
+            audio_path, generated_coarse_ids = job
+            return self.save_candidates(
+                audio_path,
+                output_dir,
+                generated_coarse_ids,
+                prompt=prompt,
+                top_k=top_k,
+                save_for_eval=save_for_eval,
+                parameters={
+                    "semantic_steps": semantic_steps,
+                    "duration": duration,
+                    "time_steps_factor": time_steps_factor,
+                    "temperature": temperature,
+                    "cond_scale": cond_scale,
+                    "n_candidates": n_candidates,
+                },
+            )
+
+        return StagePipeline([
+            PipelineStage(name, fn, num_threads=stage_threads.get(name))
+            for name, fn in [("conditioning", conditioning), ("semantic", semantic), ("coarse", coarse), ("decode", decode)]
+        ])
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--input", type=str, required=True)
+    parser.add_argument("--input", type=str, nargs="+", required=True, help="several files are generated in a pipeline, see MusicGenerator.audio_pipeline")
     parser.add_argument("--output-dir", type=str, default="output")
     parser.add_argument("--semantic-steps", type=int, default=2)
     parser.add_argument("--duration", type=int, default=3)
     parser.add_argument("--time-steps-factor", type=int, default=5)
     parser.add_argument("--temperature", type=float, default=0.95)
     parser.add_argument("--prompt", type=str, default="Diverse kinds of instrument and richness")
+    parser.add_argument("--cond-scale", type=float, default=1., help="classifier free guidance scale on the prompt, 1 for none")
+    parser.add_argument("--n-candidates", type=int, default=1, help="generate several accompaniments and keep the best by CLAP")
+    parser.add_argument("--top-k", type=int, default=1, help="with --n-candidates, the number of best candidates to save")
     parser.add_argument("--save-for-eval", action="store_true")
+    parser.add_argument("--prefill-chunk-size", type=int, default=512, help="0 to prefill the conditioning tokens all at once")
+    parser.add_argument("--speculative-decoding", action="store_true", help="draft coarse tokens with model_weights/coarse_draft.transformer.pt")
+    parser.add_argument("--compiled-decoding", action="store_true", help="decode with a static shape step compiled by torch.compile")
+    parser.add_argument("--quantize", action="store_true", help="int8 dynamic quantization of the stage transformers")
+    parser.add_argument("--quantize-logit-weights", action="store_true", help="with --quantize, also store the logit weights in int8")
+    parser.add_argument("--precision", choices=["fp32", "bf16"], default="fp32")
+    parser.add_argument("--lazy-clap", action="store_true", help="load CLAP only for prompts missing from the prompt token cache")
+    parser.add_argument("--text-only-clap", action="store_true", help="embed prompts with only the CLAP text tower, load the audio tower only to rank candidates")
+    parser.add_argument("--stage-threads", type=str, nargs="*", default=[], help="intra-op threads per pipeline stage, e.g. semantic=4 coarse=8")
     
     args = parser.parse_args()
     
-    generator = MusicGenerator()
-    generator.process_audio(
-        audio_path=Path(args.input),
+    generator = MusicGenerator(
+        speculative_decoding=args.speculative_decoding,
+        compiled_decoding=args.compiled_decoding,
+        quantize=args.quantize,
+        quantize_logit_weights=args.quantize_logit_weights,
+        precision=args.precision,
+        lazy_clap=args.lazy_clap,
+        text_only_clap=args.text_only_clap,
+    )
+    generation_kwargs = dict(
         output_dir=Path(args.output_dir),
         semantic_steps=args.semantic_steps,
         duration=args.duration,
         time_steps_factor=args.time_steps_factor,
         temperature=args.temperature,
         prompt=args.prompt,
-        save_for_eval=args.save_for_eval
-    )
\ No newline at end of file
+        save_for_eval=args.save_for_eval,
+        prefill_chunk_size=args.prefill_chunk_size or None,
+        cond_scale=args.cond_scale,
+        n_candidates=args.n_candidates,
+        top_k=args.top_k
+    )
+
+    if len(args.input) > 1:
+        stage_threads = {name: int(num_threads) for name, num_threads in (arg.split("=") for arg in args.stage_threads)}
+        pipeline = generator.audio_pipeline(**generation_kwargs, stage_threads=stage_threads)
+        all_outputs = list(pipeline.run([Path(path) for path in args.input]))
+        print(pipeline.format_timeline())
+    else:
+        all_outputs = [generator.process_audio_candidates(audio_path=Path(args.input[0]), **generation_kwargs)]
+
+    for outputs in all_outputs:
+        for output_path, clap_similarity in outputs:
+            print(output_path if clap_similarity is None else f"{output_path}: CLAP similarity {clap_similarity:.3f}")
\ No newline at end of file
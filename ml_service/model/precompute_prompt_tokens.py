@@ -0,0 +1,35 @@
+import sys
+from pathlib import Path
+import argparse
+
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
+from model.generator import clap_fingerprint
+from open_musiclm.config import create_clap_quantized_from_config, my_load_model_config
+from open_musiclm.open_musiclm import get_or_compute_clap_token_ids
+from open_musiclm.token_cache import PromptTokenCache
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="precompute the clap token ids of common prompts, the table MusicGenerator's prompt token cache is seeded with")
+    parser.add_argument("--prompts", type=str, default=str(project_root / "model/common_prompts.txt"), help="one prompt per line")
+    parser.add_argument("--output", type=str, default=str(project_root / "model_weights/clap_prompt_tokens.json"))
+    parser.add_argument("--config", type=str, default=str(project_root / "open_musiclm/configs/model/my_musiclm_for_semcoarsetosem.json"))
+    parser.add_argument("--rvq-checkpoint", type=str, default=str(project_root / "model_weights/clap.rvq.950_no_fusion.pt"))
+    parser.add_argument("--device", type=str, default="cpu")
+
+    args = parser.parse_args()
+
+    model_config = my_load_model_config(args.config)
+    # prompts only need the text tower
+    clap = create_clap_quantized_from_config(model_config, args.rvq_checkpoint, args.device, text_only=True)
+
+    with open(args.prompts) as f:
+        prompts = list(dict.fromkeys(PromptTokenCache.normalize(line) for line in f if line.strip()))
+
+    # the prompts go through the text tower as one batch
+    clap_token_ids = get_or_compute_clap_token_ids(None, clap, None, prompts)
+
+    table = PromptTokenCache(fingerprint=clap_fingerprint(model_config, Path(args.rvq_checkpoint)))
+    table.write(Path(args.output), {prompt: token_ids.flatten().tolist() for prompt, token_ids in zip(prompts, clap_token_ids)})
+    print(f"{len(prompts)} prompts written to {args.output}")
@@ -1,3 +1,6 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import torch
 import torch.nn.functional as F
@@ -23,6 +26,7 @@ class ClapQuantized(nn.Module):
                  rq_ema_decay: float = 0.95,
                  learn_rvq: bool = False,
                  threshold_ema_dead_code: float = 0.0,
+                 max_cached_text_embeddings: int = 1024,
                  ):
         super().__init__()
 
@@ -30,6 +34,11 @@ class ClapQuantized(nn.Module):
         self.codebook_size = codebook_size
         self.learn_rvq = learn_rvq
 
+        # LRU cache of text embeddings, the clap tower is frozen so they never change
+        self.max_cached_text_embeddings = max_cached_text_embeddings
+        self.text_embedding_cache = OrderedDict()
+        self.text_embedding_cache_lock = threading.Lock()
+
         self.sample_rate = self.clap.model_cfg['audio_cfg']['sample_rate']
 
         for param in self.clap.parameters():
@@ -58,6 +67,7 @@ class ClapQuantized(nn.Module):
 
         assert exists(audio_input) ^ exists(text_input), "either audio or text must be provided, but not both"
         if exists(audio_input):
+            assert not self.clap.text_only, "this clap was created with text_only, it can't embed audio"
             assert all(wave.dim() == 1 for wave in audio_input), f"audio_input must be a list of 1D tensors, but got {audio_input[0].shape}"
 
         with torch.no_grad():
@@ -65,13 +75,34 @@ class ClapQuantized(nn.Module):
             if exists(audio_input):
                 embedding = self.clap.get_audio_embedding_from_data(audio_input)
             else:
-                embedding = self.clap.get_text_embedding(text_input)
+                embedding = self.get_text_embedding(text_input)
 
         if return_embedding:
             return embedding
 
         return self.quantize(embedding, return_rvq_loss=return_rvq_loss)
 
+    def get_text_embedding(self, text_input: List[str]):
+        """text embeddings (n, d), only the texts that aren't cached yet are run through the text tower, as one batch"""
+        with self.text_embedding_cache_lock:
+            cached = {text: self.text_embedding_cache[text] for text in text_input if text in self.text_embedding_cache}
+            for text in cached:
+                self.text_embedding_cache.move_to_end(text)
+
+        missing = list(dict.fromkeys(text for text in text_input if text not in cached))
+
+        if len(missing) > 0:
+            embeddings = self.clap.get_text_embedding(missing)
+            computed = dict(zip(missing, embeddings))
+            cached.update(computed)
+
+            with self.text_embedding_cache_lock:
+                self.text_embedding_cache.update(computed)
+                while len(self.text_embedding_cache) > self.max_cached_text_embeddings:
+                    self.text_embedding_cache.popitem(last=False)
+
+        return torch.stack([cached[text] for text in text_input])
+
     def quantize(self, embedding, return_rvq_loss=False):
         """
         Quantize an embedding and optionally return the loss
@@ -94,12 +125,18 @@ def create_clap_quantized(
     rvq_checkpoint_path=None,
     checkpoint_path: Optional[str] = None,
     amodel_type: str = 'HTSAT-tiny',
+    text_only: bool = False,
     **kwargs
 ):
+    """
+    text_only: build and load only the text tower of CLAP (and the RVQ), for inference that only quantizes text
+               embeddings, e.g. turning prompts into clap tokens. The audio tower is neither built nor read from the
+               checkpoint.
+    """
     if device is None:
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-    clap = CLAP_Module(enable_fusion=enable_fusion, device=device, amodel=amodel_type)
+    clap = CLAP_Module(enable_fusion=enable_fusion, device=device, amodel=amodel_type, text_only=text_only)
     clap.load_ckpt(ckpt=checkpoint_path)
 
     clap_quantized = ClapQuantized(clap=clap, learn_rvq=learn_rvq, **kwargs)
@@ -23,12 +23,17 @@ class HubertKmeansConfig:
     seq_len_multiple_of: int = 320
     codebook_size: int = 1024
     output_hz: int = 50
+    truncate_layers: bool = True    # run MERT only up to embed_layer
 
 @dataclass
 class EncodecConfig:
     bandwidth: float
     codebook_size: int
     output_hz: int = 75
+    segment_frames: Optional[int] = 1500    # encode / decode audio longer than this many frames in segments, see EncodecWrapper
+    segment_context_frames: int = 75
+    segment_crossfade_frames: int = 4
+    segment_workers: int = 1
 
 RelativePositionBiasType = Literal['continuous', 't5', 'none']
 
@@ -44,6 +49,8 @@ class BaseTransformerConfig:
     non_causal_prefix_size: int = 0
     relative_position_bias_type: RelativePositionBiasType = 'continuous'
     use_memory_efficient_attention: bool = False
+    use_sdpa_attention: bool = False
+    cond_drop_prob: float = 0.0
     use_absolute_position_embeddings: bool = False
 
 @dataclass
@@ -140,6 +147,22 @@ def create_coarse_transformer_from_config(model_config: MusicLMModelConfig, chec
         load_model(transformer, checkpoint_path)
     return transformer
 
+def create_coarse_draft_transformer_from_config(model_config: MusicLMModelConfig, checkpoint_path: Optional[str], device, depth=2, **kwargs):
+    """shallow coarse transformer, over the same token sequences, to propose tokens for speculative decoding"""
+    from .open_musiclm import create_coarse_transformer
+    transformer = create_coarse_transformer(
+        **{**asdict(model_config.coarse_cfg), 'depth': depth, **kwargs},
+        clap_codebook_size=model_config.clap_rvq_cfg.codebook_size,
+        semantic_codebook_size=model_config.hubert_kmeans_cfg.codebook_size,
+        acoustic_codebook_size=model_config.encodec_cfg.codebook_size,
+        num_clap_quantizers=model_config.clap_rvq_cfg.rq_num_quantizers,
+        num_coarse_quantizers=model_config.global_cfg.num_coarse_quantizers,
+    ).to(device)
+
+    if exists(checkpoint_path):
+        load_model(transformer, checkpoint_path, device)
+    return transformer
+
 def load_model_config(config_path: str) -> MusicLMModelConfig:
     with open(config_path, 'r') as f:
         config = json.load(f)
@@ -0,0 +1,255 @@
+import queue
+import threading
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+
+import torch
+import torch.nn.functional as F
+from beartype.typing import List, Optional
+from einops import rearrange
+
+from .open_musiclm import TokenConditionedTransformerWrapper
+from .transformer import KVCache
+from .utils import exists, gumbel_sample, mask_out_after_eos_id, top_k
+
+
+@dataclass
+class GenerationRequest:
+    conditioning_token_ids: List[torch.Tensor]    # batch size 1
+    max_time_steps: int
+    temperature: float
+    include_eos_in_output: bool
+    prefill_chunk_size: Optional[int]
+    future: Future = field(default_factory=Future)
+
+
+@dataclass
+class BatchRow:
+    request: GenerationRequest
+    pred_token_ids: torch.Tensor    # preallocated (max_time_steps * num_quantizers,) output, filled with -1
+    pred_len: int = 0
+
+
+class ContinuousBatchingScheduler:
+    """
+    Steps the generate requests of concurrent callers through one TokenConditionedTransformerWrapper as a single batch.
+
+    Each request is prefilled on its own and joins the batch at the next time step boundary. Rows of different lengths
+    are left padded and the padding is masked out, which keeps the relative positions within every row intact.
+    A row leaves the batch, and its future resolves, as soon as it has sampled eos or reached its max_time_steps.
+    """
+
+    def __init__(
+        self,
+        transformer_wrapper: TokenConditionedTransformerWrapper,
+        *,
+        max_batch_size=8,
+        filter_thres=0.9,
+        allow_eos_in_output=False,
+        append_eos_to_conditioning_tokens=True,
+        autocast_dtype: Optional[torch.dtype] = None
+    ):
+        self.transformer_wrapper = transformer_wrapper
+        self.max_batch_size = max_batch_size
+        self.filter_thres = filter_thres
+        self.allow_eos_in_output = allow_eos_in_output
+        self.append_eos_to_conditioning_tokens = append_eos_to_conditioning_tokens
+
+        # autocast is thread local, so the decoding thread enters it itself (on every step, so it can be changed)
+        self.autocast_dtype = autocast_dtype
+
+        self.num_quantizers = transformer_wrapper.token_sequences[-1].num_quantizers
+        self.eos_id = transformer_wrapper.eos_ids[-1]
+
+        self.requests = queue.Queue()
+        self.thread = None
+        self.running = False
+
+        self.reset_batch()
+
+    def reset_batch(self):
+        self.rows: List[BatchRow] = []
+        self.cache: Optional[KVCache] = None
+        self.self_attn_mask = None    # (b, n), False for left padding
+        self.next_logits = None    # (b, c)
+        self.temperatures = None    # (b, 1)
+
+    @property
+    def device(self):
+        return self.transformer_wrapper.device
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if exists(self.thread):
+            self.thread.join()
+            self.thread = None
+
+    def submit(
+        self,
+        *,
+        conditioning_token_ids: List[torch.Tensor],
+        max_time_steps: int,
+        temperature=1.,
+        include_eos_in_output=False,
+        prefill_chunk_size: Optional[int] = None
+    ) -> Future:
+        """queue a request of batch size 1, the future resolves to the sampled token ids (1, max_time_steps, q)"""
+        assert all(t.shape[0] == 1 for t in conditioning_token_ids), 'requests are batched by the scheduler, submit one at a time'
+
+        request = GenerationRequest(
+            conditioning_token_ids=conditioning_token_ids,
+            max_time_steps=max_time_steps,
+            temperature=temperature,
+            include_eos_in_output=include_eos_in_output,
+            prefill_chunk_size=prefill_chunk_size
+        )
+        self.requests.put(request)
+        return request.future
+
+    def generate(self, **kwargs):
+        """submit a request and block until it is generated"""
+        return self.submit(**kwargs).result()
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type, dtype=self.autocast_dtype, enabled=exists(self.autocast_dtype))
+
+    def run(self):
+        with torch.no_grad():
+            self.transformer_wrapper.eval()
+
+            while self.running:
+                try:
+                    with self.autocast():
+                        self.admit_requests()
+
+                        if len(self.rows) > 0:
+                            self.step()
+                            self.remove_finished_rows()
+                except Exception as e:
+                    for row in self.rows:
+                        if not row.request.future.done():
+                            row.request.future.set_exception(e)
+                    self.reset_batch()
+
+    def admit_requests(self):
+        while len(self.rows) < self.max_batch_size:
+            try:
+                # only wait for requests when there is nothing to decode
+                request = self.requests.get(block=len(self.rows) == 0, timeout=0.1)
+            except queue.Empty:
+                return
+
+            try:
+                self.add_row(request)
+            except Exception as e:
+                request.future.set_exception(e)
+
+    def add_row(self, request: GenerationRequest):
+        device = self.device
+        max_pred_len = max(request.max_time_steps, 0) * self.num_quantizers
+        pred_token_ids = torch.full((max_pred_len,), -1, device=device, dtype=torch.long)
+
+        if max_pred_len == 0:
+            request.future.set_result(self.postprocess(BatchRow(request=request, pred_token_ids=pred_token_ids)))
+            return
+
+        conditioning_token_ids = self.transformer_wrapper.prepare_conditioning_token_ids(
+            [t.to(device) for t in request.conditioning_token_ids],
+            append_eos_to_conditioning_tokens=self.append_eos_to_conditioning_tokens
+        )
+        empty_pred_token_ids = torch.empty((1, 0), device=device, dtype=torch.long)
+
+        logits, cache = self.transformer_wrapper.prefill(
+            all_token_ids=conditioning_token_ids + [empty_pred_token_ids],
+            prefill_chunk_size=request.prefill_chunk_size
+        )
+
+        mask = torch.ones((1, cache.seq_len), device=device, dtype=torch.bool)
+        temperature = torch.full((1, 1), request.temperature, device=device)
+
+        if exists(self.cache):
+            seq_len = max(self.cache.seq_len, cache.seq_len)
+
+            self.cache = KVCache.cat([self.cache.left_pad(seq_len), cache.left_pad(seq_len)])
+            self.self_attn_mask = torch.cat((
+                F.pad(self.self_attn_mask, (seq_len - self.self_attn_mask.shape[-1], 0), value=False),
+                F.pad(mask, (seq_len - mask.shape[-1], 0), value=False)
+            ), dim=0)
+            self.next_logits = torch.cat((self.next_logits, logits), dim=0)
+            self.temperatures = torch.cat((self.temperatures, temperature), dim=0)
+        else:
+            self.cache, self.self_attn_mask, self.next_logits, self.temperatures = cache, mask, logits, temperature
+
+        self.rows.append(BatchRow(request=request, pred_token_ids=pred_token_ids))
+
+    def step(self):
+        """sample one time step (num_quantizers tokens) for every row"""
+        for ind in range(self.num_quantizers):
+            is_last_step = ind == (self.num_quantizers - 1)
+
+            logits = self.next_logits
+
+            if not self.allow_eos_in_output or not is_last_step:
+                # prevent eos 1) if we don't allow it or 2) in the middle of a time step
+                logits[:, -1] = float('-inf')
+
+            filtered_logits = top_k(logits, thres=self.filter_thres)
+            sampled = gumbel_sample(filtered_logits, temperature=self.temperatures, dim=-1)
+
+            pred_positions = torch.tensor([row.pred_len for row in self.rows], device=self.device)
+            for row, token_id in zip(self.rows, sampled):
+                row.pred_token_ids[row.pred_len] = token_id
+                row.pred_len += 1
+
+            self.self_attn_mask = F.pad(self.self_attn_mask, (0, 1), value=True)
+            self.next_logits, self.cache = self.transformer_wrapper.transformer.decode_step(
+                token_ids=rearrange(sampled, 'b -> b 1'),
+                pred_positions=pred_positions,
+                cache=self.cache,
+                self_attn_mask=self.self_attn_mask
+            )
+
+    def is_finished(self, row: BatchRow):
+        return row.pred_len >= row.pred_token_ids.shape[0] or row.pred_token_ids[row.pred_len - 1].item() == self.eos_id
+
+    def remove_finished_rows(self):
+        finished = [self.is_finished(row) for row in self.rows]
+
+        if not any(finished):
+            return
+
+        for row, is_finished in zip(self.rows, finished):
+            if is_finished:
+                row.request.future.set_result(self.postprocess(row))
+
+        keep = [i for i, is_finished in enumerate(finished) if not is_finished]
+
+        if len(keep) == 0:
+            self.reset_batch()
+            return
+
+        keep = torch.tensor(keep, device=self.device)
+
+        self.rows = [row for row, is_finished in zip(self.rows, finished) if not is_finished]
+        self.cache = self.cache.map(lambda t: t[keep])
+        self.self_attn_mask = self.self_attn_mask[keep]
+        self.next_logits = self.next_logits[keep]
+        self.temperatures = self.temperatures[keep]
+
+        # drop positions that are padding for every remaining row
+        num_padding = self.self_attn_mask.any(dim=0).long().argmax().item()
+        if num_padding > 0:
+            self.cache = self.cache.map_kv(lambda t: t[:, num_padding:])
+            self.self_attn_mask = self.self_attn_mask[:, num_padding:]
+
+    def postprocess(self, row: BatchRow):
+        pred_token_ids = rearrange(row.pred_token_ids, 'n -> 1 n')
+        pred_token_ids = mask_out_after_eos_id(pred_token_ids, self.eos_id, keep_eos=row.request.include_eos_in_output)
+        return rearrange(pred_token_ids, 'b (n q) -> b n q', q=self.num_quantizers)
@@ -1,6 +1,9 @@
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 import torch
 import torch.nn.functional as F
+from beartype.typing import Optional
 from einops import rearrange
 from encodec import EncodecModel
 from torch import nn
@@ -10,10 +13,20 @@ from .utils import exists, beartype_jit
 
 @beartype_jit
 class EncodecWrapper(nn.Module):
+    """
+    Long audio can be encoded and decoded in segments of segment_frames frames, each processed along with the
+    segment_context_frames before it (and a few lookahead frames after it), so memory is bounded by the segment length
+    and the tokens and samples near segment boundaries (nearly) match processing everything at once. Decoded segments
+    overlap by segment_crossfade_frames and are crossfaded. Segments are independent, up to segment_workers run at once.
+    """
     def __init__(self,
                  *,
                  encodec: EncodecModel,
                  output_hz: int = 75,
+                 segment_frames: Optional[int] = None,
+                 segment_context_frames: int = 75,
+                 segment_crossfade_frames: int = 4,
+                 segment_workers: int = 1,
                  ):
         super().__init__()
 
@@ -26,25 +39,71 @@ class EncodecWrapper(nn.Module):
         self.num_quantizers = int(encodec.bandwidth / 24 * total_quantizers) # output quantizers per frame
         self.codebook_size = encodec.quantizer.bins
 
-    def forward(self, x: torch.Tensor, return_encoded = True, **kwargs):
+        self.samples_per_frame = self.sample_rate // output_hz
+        self.segment_frames = segment_frames
+        self.segment_context_frames = segment_context_frames
+        self.segment_crossfade_frames = segment_crossfade_frames
+        self.segment_workers = segment_workers
+
+    def forward(self, x: torch.Tensor, return_encoded = True, num_quantizers: Optional[int] = None, **kwargs):
+        """
+        num_quantizers: only run the first levels of the residual quantizer (e.g. the coarse ones), by default all
+                        num_quantizers of the bandwidth. The levels returned are the same either way.
+        """
         assert return_encoded == True
 
         if x.dim() == 2:
             x = rearrange(x, 'b t -> b 1 t') # add in "mono" dimension
 
+        if exists(self.segment_frames) and x.shape[-1] > self.segment_frames * self.samples_per_frame:
+            return None, self.encode_segments(x, num_quantizers=num_quantizers), None
+
+        return None, self.encode(x, num_quantizers=num_quantizers), None # [B, T, n_q]
+
+    def encode(self, x: torch.Tensor, num_quantizers: Optional[int] = None):
+        """codes [B, T, n_q] of x [B, 1, n], all at once"""
         with torch.no_grad():
             self.encodec.eval()
+
+            if exists(num_quantizers) and num_quantizers < self.num_quantizers:
+                # the 24kHz model encodes in one segment without normalization, as EncodecModel._encode_frame
+                assert not exists(self.encodec.segment) and not self.encodec.normalize, 'only the 24kHz model encodes part of the quantizers'
+                codes = self.encodec.quantizer.vq.encode(self.encodec.encoder(x), n_q=num_quantizers)  # [n_q, B, T]
+                return rearrange(codes, 'n_q b t -> b t n_q')
+
             encoded_frames = self.encodec.encode(x)
         codes = torch.cat([encoded[0] for encoded in encoded_frames], dim=-1)  # [B, n_q, T]
-        codes = rearrange(codes, 'b n_q t -> b t n_q')
+        return rearrange(codes, 'b n_q t -> b t n_q')
+
+    def encode_segments(self, x: torch.Tensor, num_quantizers: Optional[int] = None, lookahead_frames=2):
+        """codes [B, T, n_q] of x [B, 1, n], segment_frames frames at a time"""
+        num_frames = -(-x.shape[-1] // self.samples_per_frame)
+
+        def encode_segment(start):
+            end = min(start + self.segment_frames, num_frames)
+            context_start = max(start - self.segment_context_frames, 0)
+            context_end = min(end + lookahead_frames, num_frames)
 
-        return None, codes, None # [B, T, n_q]
+            segment = x[..., (context_start * self.samples_per_frame):(context_end * self.samples_per_frame)]
+            codes = self.encode(segment, num_quantizers=num_quantizers)
+            return codes[:, (start - context_start):(end - context_start)]
+
+        codes = self.map_segments(encode_segment, list(range(0, num_frames, self.segment_frames)))
+        return torch.cat(codes, dim=1)
 
     def decode_from_codebook_indices(self, quantized_indices):
         """
         Args:
-            quantized_indices: [B, T, n_q]
+            quantized_indices: [B, T, n_q], n_q can be less than num_quantizers (e.g. coarse tokens only), the residual
+                               quantizer then sums only the first n_q levels
         """
+        if exists(self.segment_frames) and quantized_indices.shape[1] > self.segment_frames:
+            return self.decode_segments(quantized_indices)
+
+        return self.decode(quantized_indices)
+
+    def decode(self, quantized_indices):
+        """wave [B, 1, n] of quantized_indices [B, T, n_q], all at once"""
         quantized_indices = rearrange(quantized_indices, 'b t n_q -> b n_q t')
 
         frames = [(quantized_indices, None)] # 1 frame for now
@@ -53,6 +112,125 @@ class EncodecWrapper(nn.Module):
             wave = self.encodec.decode(frames)
         return wave
 
+    def decode_segments(self, quantized_indices, lookahead_frames=2):
+        """wave [B, 1, n] of quantized_indices [B, T, n_q], segment_frames frames at a time"""
+        num_frames = quantized_indices.shape[1]
+        crossfade = self.segment_crossfade_frames * self.samples_per_frame
+
+        def decode_segment(start):
+            # each segment also covers the crossfade into the next one
+            end = min(start + self.segment_frames + self.segment_crossfade_frames, num_frames)
+            context_start = max(start - self.segment_context_frames, 0)
+            context_end = min(end + lookahead_frames, num_frames)
+
+            wave = self.decode(quantized_indices[:, context_start:context_end])
+            return wave[..., ((start - context_start) * self.samples_per_frame):((end - context_start) * self.samples_per_frame)]
+
+        waves = self.map_segments(decode_segment, list(range(0, num_frames, self.segment_frames)))
+
+        output = waves[0]
+        for wave in waves[1:]:
+            # the end of the wave so far and the start of the segment cover the same samples
+            overlap = min(crossfade, wave.shape[-1])
+            if overlap == 0:
+                output = torch.cat((output, wave), dim=-1)
+                continue
+
+            fade_in = torch.linspace(0., 1., overlap + 2, device=wave.device, dtype=wave.dtype)[1:-1]
+            blended = output[..., -overlap:] * (1. - fade_in) + wave[..., :overlap] * fade_in
+            output = torch.cat((output[..., :-overlap], blended, wave[..., overlap:]), dim=-1)
+
+        return output
+
+    def map_segments(self, fn, starts):
+        """fn of every segment start, on up to segment_workers threads, in the caller's autocast"""
+        if self.segment_workers <= 1 or len(starts) <= 1:
+            return [fn(start) for start in starts]
+
+        # autocast is thread local
+        device_type = next(self.parameters()).device.type
+        autocast_dtype = torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type) else None
+
+        def run(start):
+            with torch.autocast(device_type=device_type, dtype=autocast_dtype, enabled=exists(autocast_dtype)):
+                return fn(start)
+
+        with ThreadPoolExecutor(max_workers=self.segment_workers) as executor:
+            return list(executor.map(run, starts))
+
+    def incremental_decoder(self, **kwargs):
+        """IncrementalDecoder, decode_from_codebook_indices for frames pushed a few at a time"""
+        return IncrementalDecoder(self, **kwargs)
+
+class IncrementalDecoder:
+    """
+    Decodes codebook indices pushed a few frames at a time, for streaming. Every chunk_frames frames are decoded along
+    with the context_frames before them, so the decoder's convolutions and lstm see (nearly) the same past as when
+    decoding all frames at once, and the lookahead_frames after them, which the transposed convolutions overlap into.
+    Only the samples of the chunk itself are returned, so consecutive chunks join without seams.
+    """
+
+    def __init__(self, encodec_wrapper: 'EncodecWrapper', chunk_frames=15, context_frames=25, lookahead_frames=2):
+        self.encodec_wrapper = encodec_wrapper
+        self.chunk_frames = chunk_frames
+        self.context_frames = context_frames
+        self.lookahead_frames = lookahead_frames
+
+        self.samples_per_frame = encodec_wrapper.sample_rate // encodec_wrapper.output_hz
+
+        self.indices = None    # [B, T, n_q], starting at frame self.offset
+        self.offset = 0
+        self.num_decoded = 0    # frames returned so far
+
+    @property
+    def num_frames(self):
+        return self.offset + (self.indices.shape[1] if exists(self.indices) else 0)
+
+    def decode(self, end):
+        """wave [B, 1, n] of the frames num_decoded .. end, decoded along with the context frames before them"""
+        start = max(self.num_decoded - self.context_frames, 0)
+        wave = self.encodec_wrapper.decode_from_codebook_indices(self.indices[:, (start - self.offset):(end - self.offset)])
+        return wave[..., ((self.num_decoded - start) * self.samples_per_frame):]
+
+    def push(self, quantized_indices):
+        """
+        Args:
+            quantized_indices: [B, T, n_q], the next frames
+        Returns:
+            the wave [B, 1, n] of the chunks completed by them, empty if none
+        """
+        if exists(self.indices):
+            self.indices = torch.cat((self.indices, quantized_indices), dim=1)
+        else:
+            self.indices = quantized_indices
+
+        waves = []
+        while self.num_frames - self.num_decoded >= self.chunk_frames + self.lookahead_frames:
+            wave = self.decode(self.num_decoded + self.chunk_frames + self.lookahead_frames)
+            waves.append(wave[..., :(self.chunk_frames * self.samples_per_frame)])
+            self.num_decoded += self.chunk_frames
+
+        # drop the frames that are no longer needed as context
+        keep_from = max(self.num_decoded - self.context_frames, 0)
+        self.indices = self.indices[:, (keep_from - self.offset):]
+        self.offset = keep_from
+
+        if len(waves) == 0:
+            return torch.zeros((self.indices.shape[0], 1, 0), device=self.indices.device)
+
+        return torch.cat(waves, dim=-1)
+
+    def flush(self):
+        """the wave [B, 1, n] of the remaining frames"""
+        if self.num_frames == self.num_decoded:
+            batch = self.indices.shape[0] if exists(self.indices) else 1
+            return torch.zeros((batch, 1, 0))
+
+        wave = self.decode(self.num_frames)
+        self.num_decoded = self.num_frames
+        return wave
+
+
 def create_encodec_24khz(bandwidth: float = 6.0, codebook_size: int = 1024, **kwargs):
     """
     Create a pretrained EnCodec model.
@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import torch
 from torch import nn
@@ -9,7 +10,9 @@ from beartype.typing import Optional
 from torchaudio.functional import resample
 from .utils import exists, curtail_to_multiple, zero_mean_unit_var_norm
 from transformers import HubertModel
-from sklearn.cluster import MiniBatchKMeans
+
+if TYPE_CHECKING:
+    from sklearn.cluster import MiniBatchKMeans
 
 import joblib
 import logging
@@ -20,29 +23,44 @@ class HfHubertWithKmeans(nn.Module):
     """
     Hugging Face HubertModel + a k-means layer on top. Pretrained checkpoint for music: https://huggingface.co/m-a-p/MERT-v0
     Note: MERT-v0 outputs features at 50Hz while Wav2Vec-BERT (used in the paper) outputs at 25 Hz.
+
+    The k-means cluster centers, from a fitted scikit-learn model or given as a (codebook_size, d) tensor, are kept in
+    buffers and features are assigned to the nearest one on their own device, see assign_clusters.
     """
 
     def __init__(
         self,
         *,
         hubert: HubertModel,
-        kmeans: Optional[MiniBatchKMeans] = None,
+        kmeans: Optional['MiniBatchKMeans'] = None,
+        cluster_centers: Optional[torch.Tensor] = None,
         embed_layer: int=7,
         target_sample_hz=16000,
         seq_len_multiple_of=int(16000 / 50),
         normalize_embeds=True,
         codebook_size: int=1024,
-        output_hz: int=50
+        output_hz: int=50,
+        truncate_layers=True,
+        kmeans_chunk_size=8192
     ):
         super().__init__()
         self.target_sample_hz = target_sample_hz
         self.output_hz = output_hz
         self.seq_len_multiple_of = seq_len_multiple_of
-        self.codebook_size = kmeans.n_clusters if exists(kmeans) else None
-
         self.codebook_size = codebook_size
         if exists(kmeans):
             assert self.codebook_size == kmeans.n_clusters, "codebook_size must match kmeans.n_clusters"
+            assert not exists(cluster_centers), "pass either kmeans or cluster_centers"
+            cluster_centers = torch.from_numpy(kmeans.cluster_centers_)
+
+        if exists(cluster_centers):
+            assert cluster_centers.shape[0] == self.codebook_size, "codebook_size must match the number of cluster centers"
+            cluster_centers = cluster_centers.float()
+
+        # not part of the state dict, they come from the k-means model
+        self.register_buffer('cluster_centers', cluster_centers, persistent=False)
+        self.register_buffer('cluster_center_norms', cluster_centers.pow(2).sum(dim=-1) if exists(cluster_centers) else None, persistent=False)
+        self.kmeans_chunk_size = kmeans_chunk_size
 
         self.normalize_embeds = normalize_embeds
 
@@ -51,6 +69,16 @@ class HfHubertWithKmeans(nn.Module):
         self.hubert = hubert
         self.kmeans = kmeans
 
+        # only the hidden state of embed_layer is used, drop the encoder layers after it. Without a final layer norm
+        # (the post layer norm encoder of MERT-v0) the last hidden state of the truncated model is that hidden state
+        self.truncate_layers = truncate_layers
+        if truncate_layers:
+            assert not hubert.config.do_stable_layer_norm, "truncate_layers needs an encoder without a final layer norm"
+            assert embed_layer <= len(hubert.encoder.layers), "embed_layer is past the last encoder layer"
+
+            hubert.encoder.layers = hubert.encoder.layers[:embed_layer]
+            hubert.config.num_hidden_layers = embed_layer
+
     @torch.no_grad()
     def forward(
         self,
@@ -59,7 +87,7 @@ class HfHubertWithKmeans(nn.Module):
         return_embed=False,
         input_sample_hz=None
     ):
-        assert return_embed or exists(self.kmeans), "kmeans model must be provided if return_embed==False"
+        assert return_embed or exists(self.cluster_centers), "kmeans model must be provided if return_embed==False"
 
         device = wav_input.device
 
@@ -74,8 +102,11 @@ class HfHubertWithKmeans(nn.Module):
             'attention_mask': torch.ones_like(wav_input, device=device), # TODO: handle padding
         }
 
-        outputs = self.hubert(**hubert_args, output_hidden_states = True)
-        embed = outputs.hidden_states[self.embed_layer]
+        if self.truncate_layers:
+            embed = self.hubert(**hubert_args).last_hidden_state
+        else:
+            outputs = self.hubert(**hubert_args, output_hidden_states = True)
+            embed = outputs.hidden_states[self.embed_layer]
 
         if self.normalize_embeds:
             embed = zero_mean_unit_var_norm(embed)
@@ -84,8 +115,7 @@ class HfHubertWithKmeans(nn.Module):
             return embed
 
         embed, packed_shape = pack([embed], '* d')
-        codebook_indices = self.kmeans.predict(embed.detach().cpu().numpy())
-        codebook_indices = torch.from_numpy(codebook_indices).to(device).long()
+        codebook_indices = self.assign_clusters(embed)
 
         if flatten:
             return codebook_indices
@@ -94,6 +124,20 @@ class HfHubertWithKmeans(nn.Module):
         return codebook_indices
 
 
+    def assign_clusters(self, embed: torch.Tensor):
+        """index of the nearest cluster center of every feature (n, d), computed kmeans_chunk_size features at a time"""
+        indices = []
+
+        # k-means distances in fp32, also when the features come from a lower precision (autocast) forward
+        with torch.autocast(device_type=embed.device.type, enabled=False):
+            for chunk in embed.float().split(self.kmeans_chunk_size):
+                # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, where |x|^2 is the same for every center
+                distances = self.cluster_center_norms - 2 * chunk @ self.cluster_centers.t()
+                indices.append(distances.argmin(dim=-1))
+
+        return torch.cat(indices).long()
+
+
 def get_kmeans_model(
     n_clusters,
     init,
@@ -104,6 +148,8 @@ def get_kmeans_model(
     n_init,
     reassignment_ratio,
 ):
+    from sklearn.cluster import MiniBatchKMeans
+
     return MiniBatchKMeans(
         n_clusters=n_clusters,
         init=init,
@@ -151,8 +197,18 @@ def learn_kmeans(
     print("finished successfully")
 
 
+def export_kmeans_cluster_centers(kmeans_path, output_path):
+    """save the cluster centers of a joblib k-means model as a tensor, which get_hubert_kmeans loads without scikit-learn"""
+    kmeans = joblib.load(kmeans_path)
+    torch.save(torch.from_numpy(kmeans.cluster_centers_), output_path)
+
+
 def get_hubert_kmeans(model_name: str="m-a-p/MERT-v0", kmeans_path: Optional[str]='./checkpoints/kmeans.joblib', **kwargs):
+    """kmeans_path is a joblib k-means model, or its cluster centers saved by export_kmeans_cluster_centers (.pt)"""
     wav2vec = HubertModel.from_pretrained(model_name)
-    kmeans = joblib.load(kmeans_path) if exists(kmeans_path) else None
 
+    if exists(kmeans_path) and Path(kmeans_path).suffix == '.pt':
+        return HfHubertWithKmeans(hubert=wav2vec, cluster_centers=torch.load(kmeans_path), **kwargs)
+
+    kmeans = joblib.load(kmeans_path) if exists(kmeans_path) else None
     return HfHubertWithKmeans(hubert=wav2vec, kmeans=kmeans, **kwargs)
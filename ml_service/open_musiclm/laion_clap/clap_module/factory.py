@@ -48,8 +48,13 @@ def _rescan_model_configs():
 _rescan_model_configs()  # initial populate of model config registry
 
 
-def load_state_dict(checkpoint_path: str, map_location="cpu", skip_params=True):
-    checkpoint = torch.load(checkpoint_path, map_location=map_location)
+def load_state_dict(checkpoint_path: str, map_location="cpu", skip_params=True, mmap=False):
+    # mmap: tensors are read from the file as they are accessed, so the ones not loaded into a model stay on disk
+    # (only for checkpoints saved with torch >= 1.6)
+    if mmap:
+        checkpoint = torch.load(checkpoint_path, map_location=map_location, mmap=True)
+    else:
+        checkpoint = torch.load(checkpoint_path, map_location=map_location)
     if isinstance(checkpoint, dict) and "state_dict" in checkpoint:
         state_dict = checkpoint["state_dict"]
     else:
@@ -77,7 +82,8 @@ def create_model(
     pretrained_audio: str = "",
     pretrained_text: str = "",
     enable_fusion: bool = False,
-    fusion_type: str = 'None'
+    fusion_type: str = 'None',
+    text_only: bool = False,
     # pretrained_image: bool = False,
 ):
     amodel_name = amodel_name.replace(
@@ -86,6 +92,7 @@ def create_model(
     pretrained_orig = pretrained
     pretrained = pretrained.lower()
     if pretrained == "openai":
+        assert not text_only, 'the openai model is always built with its audio branch'
         if amodel_name in _MODEL_CONFIGS:
             logging.info(f"Loading {amodel_name} model config.")
             model_cfg = deepcopy(_MODEL_CONFIGS[amodel_name])
@@ -133,7 +140,7 @@ def create_model(
         model_cfg["text_cfg"]["model_type"] = tmodel_name
         model_cfg["enable_fusion"] = enable_fusion
         model_cfg["fusion_type"] = fusion_type
-        model = CLAP(**model_cfg)
+        model = CLAP(**model_cfg, text_only=text_only)
 
         if pretrained:
             checkpoint_path = ""
@@ -430,6 +430,7 @@ class CLAP(nn.Module):
         fusion_type: str = 'None',
         joint_embed_shape: int = 512,
         mlp_act: str = 'relu',
+        text_only: bool = False,
     ):
         super().__init__()
         if isinstance(audio_cfg, dict):
@@ -443,6 +444,8 @@ class CLAP(nn.Module):
         self.fusion_type = fusion_type
         self.joint_embed_shape = joint_embed_shape
         self.mlp_act = mlp_act
+        # text_only: build neither the audio branch nor its transform and projection, e.g. to only embed text
+        self.text_only = text_only
 
 
         self.context_length = text_cfg.context_length
@@ -461,7 +464,9 @@ class CLAP(nn.Module):
 
         # audio branch
         # audio branch parameters
-        if audio_cfg.model_type == "PANN":
+        if text_only:
+            self.audio_branch = None
+        elif audio_cfg.model_type == "PANN":
             self.audio_branch = create_pann_model(audio_cfg, enable_fusion, fusion_type)
         elif audio_cfg.model_type == "HTSAT":
             self.audio_branch = create_htsat_model(audio_cfg, enable_fusion, fusion_type)
@@ -529,18 +534,22 @@ class CLAP(nn.Module):
         # text branch parameters
 
         # audio branch parameters
-        self.audio_transform = MLPLayers(units=[self.joint_embed_shape,
-                                                self.joint_embed_shape,
-                                                self.joint_embed_shape], dropout=0.1)
+        if text_only:
+            self.audio_transform = None
+            self.audio_projection = None
+        else:
+            self.audio_transform = MLPLayers(units=[self.joint_embed_shape,
+                                                    self.joint_embed_shape,
+                                                    self.joint_embed_shape], dropout=0.1)
 
-        # below here is text branch parameters
+            # below here is text branch parameters
 
-        # ============================================================================================================
-        self.audio_projection = nn.Sequential(
-                nn.Linear(embed_dim, self.joint_embed_shape),
-                mlp_act_layer,
-                nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
-            )
+            # ============================================================================================================
+            self.audio_projection = nn.Sequential(
+                    nn.Linear(embed_dim, self.joint_embed_shape),
+                    mlp_act_layer,
+                    nn.Linear(self.joint_embed_shape, self.joint_embed_shape)
+                )
 
         self.logit_scale_a = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
         self.logit_scale_t = nn.Parameter(torch.ones([]) * np.log(1 / 0.07))
@@ -587,6 +596,7 @@ class CLAP(nn.Module):
         return mask
 
     def encode_audio(self, audio, device):
+        assert not self.text_only, 'this model was built with text_only, it has no audio branch'
         return self.audio_branch(audio, mixup_lambda=None, device=device)  # mix lambda needs to add
 
     # def list_of_dict_of_tensor2dict_of_tensor(self, x, device):
@@ -28,7 +28,7 @@ def float32_to_int16_torch(x):
     return (x * 32767.).type(torch.int16)
 
 class CLAP_Module(torch.nn.Module):
-    def __init__(self, enable_fusion=False, device=None, amodel= 'HTSAT-tiny', tmodel='roberta') -> None:
+    def __init__(self, enable_fusion=False, device=None, amodel= 'HTSAT-tiny', tmodel='roberta', text_only=False) -> None:
         """Initialize CLAP Model
 
         Parameters
@@ -41,6 +41,8 @@ class CLAP_Module(torch.nn.Module):
             audio encoder architecture, default: HTSAT-tiny
         tmodel: str
             text encoder architecture, default: roberta
+        text_only: bool
+            if true, only the text branch is built and loaded, the model can embed text but not audio (default: false)
         """
         super(CLAP_Module, self).__init__()
         if device is None:
@@ -55,7 +57,8 @@ class CLAP_Module(torch.nn.Module):
                 precision=precision,
                 device=device,
                 enable_fusion=enable_fusion,
-                fusion_type=fusion_type
+                fusion_type=fusion_type,
+                text_only=text_only
             )
         else:
             model, model_cfg = create_model(
@@ -63,13 +66,20 @@ class CLAP_Module(torch.nn.Module):
                 tmodel,
                 precision=precision,
                 device=device,
-                enable_fusion=enable_fusion
+                enable_fusion=enable_fusion,
+                text_only=text_only
             )
         self.enable_fusion = enable_fusion
+        self.text_only = text_only
         self.model = model
         self.model_cfg = model_cfg
         self.tokenize = RobertaTokenizer.from_pretrained('roberta-base')
 
+        if text_only:
+            self.mel_transform = None
+            self.log_mel_transform = None
+            return
+
         audio_cfg = model_cfg['audio_cfg']
         self.mel_transform = torchaudio.transforms.MelSpectrogram(
             sample_rate=audio_cfg['sample_rate'],
@@ -136,7 +146,13 @@ class CLAP_Module(torch.nn.Module):
                 ckpt = wget.download(download_link + weight_file_name, os.path.dirname(ckpt))
                 print('Download completed!')
         print('Load Checkpoint...')
-        ckpt = load_state_dict(ckpt, skip_params=True)
+        if self.text_only:
+            # the audio tensors of the checkpoint are skipped, and with mmap never read from disk
+            ckpt = load_state_dict(ckpt, skip_params=True, mmap=True)
+            model_keys = self.model.state_dict().keys()
+            ckpt = {k: v for k, v in ckpt.items() if k in model_keys}
+        else:
+            ckpt = load_state_dict(ckpt, skip_params=True)
         self.model.load_state_dict(ckpt, strict=False)
         param_names = [n for n, p in self.model.named_parameters()]
         for n in param_names:
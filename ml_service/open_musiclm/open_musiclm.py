@@ -3,7 +3,7 @@ from dataclasses import dataclass
 
 import torch
 import torch.nn.functional as F
-from beartype.typing import List, Optional
+from beartype.typing import Callable, Dict, List, Optional, Tuple
 from einops import einsum, rearrange, reduce, repeat
 from torch import einsum, nn
 from torchaudio.functional import resample
@@ -11,12 +11,13 @@ from tqdm import tqdm
 
 from .clap_quantized import ClapQuantized
 from .model_types import NeuralCodec, Wav2Vec
-from .transformer import Transformer
+from .prefix_cache import PrefixCache
+from .transformer import KVCache, StaticKVCache, Transformer
 from .utils import (all_rows_have_eos_id, append_eos_id,
                     batch_unique_consecutive, beartype_jit, ceil_div, default,
                     eval_decorator, exists, float32_to_int16,
                     generate_mask_with_prob, get_embeds, gumbel_sample,
-                    int16_to_float32, mask_out_after_eos_id,
+                    int16_to_float32, mask_out_after_eos_id, prob_mask_like,
                     round_down_nearest_multiple, top_k, prepare_audio)
 
 
@@ -49,7 +50,8 @@ class TokenConditionedTransformer(nn.Module):
         ff_dropout=0.1,
         has_condition=False,
         cond_as_self_attn_prefix=False,
-        cond_drop_prob=0.5,
+        cond_drop_prob=0.,
+        cond_sequence_indices: Tuple[int, ...] = (),
         grad_shrink_alpha=0.1,
         use_absolute_position_embeddings=False,
         max_absolute_position_embeddings=262,
@@ -61,6 +63,10 @@ class TokenConditionedTransformer(nn.Module):
 
         self.has_condition = has_condition
         self.cond_drop_prob = cond_drop_prob
+
+        # token sequences that are dropped (masked out of self attention) with cond_drop_prob in training, and for the
+        # unconditional branch of classifier free guidance, see forward_with_cond_scale
+        self.cond_sequence_indices = cond_sequence_indices
         self.use_absolute_position_embeddings = use_absolute_position_embeddings
 
         self.start_tokens = torch.nn.ParameterList()
@@ -97,123 +103,282 @@ class TokenConditionedTransformer(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    def embed_token_ids(self, index, token_ids, positions):
+        """
+        Embed token ids of the token sequence at index, given their positions within that sequence.
+        positions: (n,) shared by the batch or (b, n)
+        """
+        sequence = self.token_sequences[index]
+
+        # add offsets
+        if sequence.num_quantizers > 1:
+            token_ids = token_ids + sequence.codebook_size * (positions % sequence.num_quantizers)
+
+        token_embeddings = get_embeds(self.embeddings[index], token_ids, pad_id=-1)
+
+        if self.use_absolute_position_embeddings:
+            token_embeddings = token_embeddings + self.absolute_position_embeddings[index](positions)
+
+        return token_embeddings
+
+    def get_logits(self, index, pred_tokens, pred_offset=0):
+        """
+        Logits of the token sequence at index from the transformer output, where pred_tokens[:, 0] predicts
+        the token at position pred_offset of that sequence.
+        """
+        sequence, seq_logit_weights = self.token_sequences[index], self.logit_weights[index]
+
+        # left pad so that the grouping by quantizer lines up with the position in the sequence
+        pad = pred_offset % sequence.num_quantizers
+        pred_tokens = F.pad(pred_tokens, (0, 0, pad, 0))
+
+        n = pred_tokens.shape[1]
+        nq = round_down_nearest_multiple(n, sequence.num_quantizers)
+
+        pred_tokens_groupable, pred_tokens_remainder = pred_tokens[:, :nq], pred_tokens[:, nq:]
+
+        pred_tokens_groupable = rearrange(
+            pred_tokens_groupable, 'b (n q) d -> b n q d', q=sequence.num_quantizers)
+
+        pred_logits_groupable = einsum('q c d, b n q d -> b n q c', seq_logit_weights, pred_tokens_groupable)
+
+        pred_logits_groupable = rearrange(pred_logits_groupable, 'b n q c -> b (n q) c')
+
+        remainder_num_tokens_in_step = pred_tokens_remainder.shape[1]
+
+        if remainder_num_tokens_in_step > 0:
+            pred_logits_remainder = einsum(
+                'q c d, b q d -> b q c', seq_logit_weights[:remainder_num_tokens_in_step], pred_tokens_remainder)
+            pred_logits = torch.cat((pred_logits_groupable, pred_logits_remainder), dim=1)
+        else:
+            pred_logits = pred_logits_groupable
+
+        # sample from fp32 logits, also when autocasting to a lower precision
+        return pred_logits[:, pad:].float()
+
+    def decode_step(
+        self,
+        *,
+        token_ids: torch.Tensor,
+        pred_positions: torch.Tensor,
+        cache: KVCache,
+        self_attn_mask=None
+    ):
+        """
+        Run one newly sampled token per row of the final token sequence past the cache. Unlike forward, the rows
+        don't need to be at the same position, e.g. when decoding several requests as one batch.
+
+        token_ids: (b, 1) sampled tokens of the final token sequence
+        pred_positions: (b,) position of these tokens within the final token sequence
+        self_attn_mask: (b, cache.seq_len + 1), if some cached positions of a row must not be attended to
+
+        Returns the logits for the next token of every row (b, c) and the updated cache.
+        """
+        index = len(self.token_sequences) - 1
+        sequence = self.token_sequences[index]
+
+        tokens = self.embed_token_ids(index, token_ids, rearrange(pred_positions, 'b -> b 1'))
+        tokens, cache = self.transformer(tokens, self_attn_mask=self_attn_mask, cache=cache, return_cache=True)
+
+        # the output at position p predicts the token at p + 1, whose logit weights depend on its quantizer
+        quantizer_ids = (pred_positions + 1) % sequence.num_quantizers
+        logit_weights = self.logit_weights[index][quantizer_ids]
+        logits = einsum('b c d, b d -> b c', logit_weights, tokens[:, -1]).float()
+
+        return logits, cache
+
+    def decode_step_static(
+        self,
+        token_ids: torch.Tensor,
+        pred_positions: torch.Tensor,
+        position: torch.Tensor,
+        cache: StaticKVCache,
+        self_attn_mask=None
+    ):
+        """
+        decode_step with static shapes: the cache is preallocated and updated in place, and the positions are tensors,
+        so it can be compiled once and reused for every step.
+
+        token_ids: (b, 1) sampled tokens of the final token sequence
+        pred_positions: (b,) position of these tokens within the final token sequence
+        position: (1,) position of these tokens within the whole sequence (the number of positions cached before them)
+
+        Returns the logits for the next token of every row (b, c).
+        """
+        index = len(self.token_sequences) - 1
+        sequence = self.token_sequences[index]
+
+        tokens = self.embed_token_ids(index, token_ids, rearrange(pred_positions, 'b -> b 1'))
+        tokens = self.transformer.decode_static(tokens, cache=cache, position=position, self_attn_mask=self_attn_mask)
+
+        quantizer_ids = (pred_positions + 1) % sequence.num_quantizers
+        logit_weights = self.logit_weights[index][quantizer_ids]
+        return einsum('b c d, b d -> b c', logit_weights, tokens[:, -1]).float()
+
     def forward(self,
                 *,
                 all_token_ids: List[torch.Tensor],
                 self_attn_mask=None,
                 cond_drop_prob=None,
-                return_only_final_seq_logits=False
+                cond_drop_mask: Optional[torch.Tensor] = None,
+                return_only_final_seq_logits=False,
+                cache: Optional[KVCache] = None,
+                return_cache=False,
+                prefill_chunk_size: Optional[int] = None
                 ):
         """
         all_token_ids: List of tensors containing token ids. Each element can either be 2 dimensional (batch_size, n_time_steps * num_quantizers) or 3 dimensional (batch_size, n_time_steps, num_quantizers)
                        Each element in list corresponds to one token sequence in self.token_sequences (e.g. semantic, coarse acoustic, fine acoustic, etc.)
 
         return_only_final_seq_logits: If True, only return logits for the final token sequence in self.token_sequences.
+
+        cond_drop_prob: probability of dropping the cond_sequence_indices sequences of a row, defaults to
+                        self.cond_drop_prob in training and 0 otherwise
+        cond_drop_mask: (b,) rows whose cond_sequence_indices sequences are dropped, instead of sampling them with
+                        cond_drop_prob. Dropped sequences are masked out of self attention, only their start token is kept.
+
+        cache: KVCache returned by a previous call with return_cache=True. all_token_ids must start with the token ids
+               of that call, and only the positions past the cache are embedded and run through the transformer.
+               Logits are then only returned for those positions.
+        return_cache: If True, return (logits, cache)
+
+        prefill_chunk_size: If set, the positions are run through the transformer in chunks of at most this size, so the
+                            attention matrix of a long conditioning prefix is never fully materialized.
         """
-        # print("=================TokenConditionedTransformer=================")
-        # print(all_token_ids[0].shape,all_token_ids[0])
-        # print(all_token_ids[1].shape,all_token_ids[1])
         b, device = all_token_ids[0].shape[0], self.device
 
         all_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), all_token_ids))
 
         assert len(all_token_ids) == len(self.token_sequences) == len(self.embeddings)
 
+        cache_len = cache.seq_len if exists(cache) else 0
+
+        # every sequence is laid out as [start token, token ids], find where each one begins
+
+        seq_starts = [0]
+        for token_ids in all_token_ids:
+            seq_starts.append(seq_starts[-1] + token_ids.shape[-1] + 1)
+        total_len = seq_starts.pop()
+
+        assert cache_len < total_len, 'all positions are already cached'
+
+        # classifier free guidance, drop the conditioning sequences of some rows
+
+        cond_drop_prob = default(cond_drop_prob, self.cond_drop_prob if self.training else 0.)
+
+        if not exists(cond_drop_mask) and cond_drop_prob > 0 and len(self.cond_sequence_indices) > 0:
+            cond_drop_mask = prob_mask_like((b,), cond_drop_prob, device=device)
+
+        if exists(cond_drop_mask) and len(self.cond_sequence_indices) > 0:
+            cond_positions = torch.zeros((total_len,), device=device, dtype=torch.bool)
+            for index in self.cond_sequence_indices:
+                seq_start = seq_starts[index]
+                cond_positions[(seq_start + 1):(seq_start + all_token_ids[index].shape[-1] + 1)] = True
+
+            keep_mask = ~(rearrange(cond_drop_mask, 'b -> b 1') & cond_positions)
+            self_attn_mask = keep_mask & self_attn_mask if exists(self_attn_mask) else keep_mask
+
         tokens = []
-        start_tokens = []
-        split_at = []
-        for idx, sequence, token_ids, embedding, start_token in zip(range(len(self.token_sequences)), self.token_sequences, all_token_ids, self.embeddings, self.start_tokens):
-
-            # add offsets
-            if sequence.num_quantizers > 1:
-                offsets = sequence.codebook_size * torch.arange(sequence.num_quantizers, device=device)
-                offsets = repeat(offsets, 'q -> 1 (n q)', n=ceil_div(token_ids.shape[-1], sequence.num_quantizers))
-                offsets = offsets[:, :token_ids.shape[-1]]
-                token_ids = token_ids + offsets
-
-            # get embeddings and prepare for next step
-            token_embeddings = get_embeds(embedding, token_ids, pad_id=-1)
-            if self.use_absolute_position_embeddings:
-                position_embeddings = self.absolute_position_embeddings[idx](torch.arange(token_embeddings.shape[1], device=device)[None, :])
-                tokens.append(token_embeddings + position_embeddings)
-            else:
-                tokens.append(token_embeddings)
-            start_tokens.append(repeat(start_token, 'd -> b 1 d', b=b))
+        for idx, token_ids, start_token, seq_start in zip(range(len(self.token_sequences)), all_token_ids, self.start_tokens, seq_starts):
+
+            # skip positions that are already cached
+            seq_len = token_ids.shape[-1] + 1
+            if seq_start + seq_len <= cache_len:
+                continue
 
-            n_tokens = token_embeddings.shape[1] + 1 # +1 for start token of next sequence
-            split_at.append(n_tokens if len(split_at) == 0 else split_at[-1] + n_tokens)
+            if seq_start >= cache_len:
+                tokens.append(repeat(start_token, 'd -> b 1 d', b=b))
+
+            token_offset = max(cache_len - seq_start - 1, 0)
+            token_ids = token_ids[:, token_offset:]
+            positions = torch.arange(token_offset, token_offset + token_ids.shape[-1], device=device)
+
+            tokens.append(self.embed_token_ids(idx, token_ids, positions))
 
-        tokens = list(itertools.chain(*zip(start_tokens, tokens)))  # [start_1, tokens_1, start_2, tokens_2, ...]
         tokens = torch.cat(tokens, dim=1)
 
-        tokens = self.transformer(tokens, self_attn_mask=self_attn_mask)
+        tokens = self.transformer(tokens, self_attn_mask=self_attn_mask, cache=cache, return_cache=return_cache, chunk_size=prefill_chunk_size)
 
-        split_at = split_at[:-1]  # remove last element (total number of tokens)
-        all_pred_tokens = torch.tensor_split(tokens, split_at, dim=1)
+        if return_cache:
+            tokens, cache = tokens
 
         # strip next start token from end of every sequence besides last
         # in tokens: s1 t1 t2 t3 t4 .. e1   s2 t1 t2 t3 t4 e2
         # out logit: t1 t2 t3 t4 .. e1 s2   t1 t2 t3 t4 e2
         # split:    [t1 t2 t3 t4 .. e1 s2] [t1 t2 t3 t4 e2]
-        all_pred_tokens = [pred_tokens[:, :-1] for pred_tokens in all_pred_tokens[:-1]] + [all_pred_tokens[-1]]
 
         # get logits
 
         all_logits = []
-        assert len(all_pred_tokens) == len(self.token_sequences) == len(self.logit_weights)
+        assert len(seq_starts) == len(self.token_sequences) == len(self.logit_weights)
 
-        for index, (sequence, pred_tokens, seq_logit_weights) in enumerate(zip(self.token_sequences, all_pred_tokens, self.logit_weights)):
+        for index, (token_ids, seq_start) in enumerate(zip(all_token_ids, seq_starts)):
             if not return_only_final_seq_logits or index == len(self.token_sequences) - 1:
-                n = pred_tokens.shape[1]
-                nq = round_down_nearest_multiple(n, sequence.num_quantizers)
-
-                pred_tokens_groupable, pred_tokens_remainder = pred_tokens[:, :nq], pred_tokens[:, nq:]
-
-                pred_tokens_groupable = rearrange(
-                    pred_tokens_groupable, 'b (n q) d -> b n q d', q=sequence.num_quantizers)
-
-                pred_logits_groupable = einsum('q c d, b n q d -> b n q c', seq_logit_weights, pred_tokens_groupable)
+                is_final_seq = index == len(self.token_sequences) - 1
+                num_pred_tokens = token_ids.shape[-1] + (1 if is_final_seq else 0)
 
-                pred_logits_groupable = rearrange(pred_logits_groupable, 'b n q c -> b (n q) c')
+                # predictions for this sequence that were not computed in a previous (cached) call
+                pred_offset = min(max(cache_len - seq_start, 0), num_pred_tokens)
+                pred_tokens = tokens[:, (seq_start + pred_offset - cache_len):(seq_start + num_pred_tokens - cache_len)]
 
-                remainder_num_tokens_in_step = pred_tokens_remainder.shape[1]
-
-                if remainder_num_tokens_in_step > 0:
-                    pred_logits_remainder = einsum(
-                        'q c d, b q d -> b q c', seq_logit_weights[:remainder_num_tokens_in_step], pred_tokens_remainder)
-                    pred_logits = torch.cat((pred_logits_groupable, pred_logits_remainder), dim=1)
-                else:
-                    pred_logits = pred_logits_groupable
-
-                all_logits.append(pred_logits)
+                all_logits.append(self.get_logits(index, pred_tokens, pred_offset))
             else:
                 all_logits.append(None)
 
+        if return_cache:
+            return all_logits, cache
+
         return all_logits
 
     def forward_with_cond_scale(
         self,
-        *args,
+        *,
+        all_token_ids: List[torch.Tensor],
         cond_scale=3,
+        self_attn_mask=None,
+        cache: Optional[KVCache] = None,
+        return_cache=False,
         **kwargs
     ):
-        """Doesn't do anything without the AudioLM-pytorch text conditioning implementation. Just use forward() instead."""
+        """
+        Classifier free guidance. The conditional and unconditional (cond_sequence_indices dropped) logits are computed
+        in a single forward pass over a batch of 2b rows, and combined as null + (cond - null) * cond_scale.
 
-        logits = self.forward(*args, cond_drop_prob=0., **kwargs)
+        cache: with return_cache, the cache holds the 2b rows, the conditional ones first, and is passed back as is.
+               Without guidance (cond_scale of 1 or no cond_sequence_indices) this is just forward, over b rows.
+        """
+        if cond_scale == 1 or len(self.cond_sequence_indices) == 0:
+            return self.forward(all_token_ids=all_token_ids, self_attn_mask=self_attn_mask, cond_drop_prob=0., cache=cache, return_cache=return_cache, **kwargs)
 
-        if cond_scale == 1 or not self.has_condition:
-            return logits
+        b = all_token_ids[0].shape[0]
 
-        null_logits = self.forward(*args, cond_drop_prob=1., **kwargs)
+        all_token_ids = [repeat(t, 'b ... -> (r b) ...', r=2) for t in all_token_ids]
+        self_attn_mask = repeat(self_attn_mask, 'b n -> (r b) n', r=2) if exists(self_attn_mask) else None
+        cond_drop_mask = torch.arange(2 * b, device=self.device) >= b
+
+        out = self.forward(
+            all_token_ids=all_token_ids,
+            self_attn_mask=self_attn_mask,
+            cond_drop_mask=cond_drop_mask,
+            cache=cache,
+            return_cache=return_cache,
+            **kwargs
+        )
+
+        logits, cache = out if return_cache else (out, None)
 
         scaled_logits = []
 
-        for seq_logits, null_seq_logits in zip(logits, null_logits):
+        for seq_logits in logits:
             if seq_logits is None:
                 scaled_logits.append(None)
             else:
+                seq_logits, null_seq_logits = seq_logits.chunk(2, dim=0)
                 scaled_logits.append(null_seq_logits + (seq_logits - null_seq_logits) * cond_scale)
 
+        if return_cache:
+            return scaled_logits, cache
+
         return scaled_logits
 
 
@@ -227,11 +392,23 @@ class TokenConditionedTransformerWrapper(nn.Module):
         pad_id=-1,
         unique_consecutive=True,
         cross_entropy_loss_weights: Optional[List[float]] = None,
-        mask_prob=0.15
+        mask_prob=0.15,
+        prefix_cache: Optional[PrefixCache] = None,
+        draft_transformer: Optional[TokenConditionedTransformer] = None
     ):
         super().__init__()
 
         self.transformer = transformer
+        self.prefix_cache = prefix_cache
+
+        # small transformer over the same token sequences, proposes tokens for speculative decoding in generate
+        if exists(draft_transformer):
+            assert draft_transformer.token_sequences == transformer.token_sequences, 'draft transformer must be over the same token sequences'
+        self.draft_transformer = draft_transformer
+
+        # decode step with static shapes, compiled by compile_decoding
+        self.static_decode_step = None
+        self.static_max_seq_len = 0
 
         self.token_sequences = transformer.token_sequences
 
@@ -249,6 +426,113 @@ class TokenConditionedTransformerWrapper(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
+    def prepare_conditioning_token_ids(self, conditioning_token_ids: List[torch.Tensor], append_eos_to_conditioning_tokens=True):
+        """remove unique consecutives and append eos to the conditioning token ids, as done before generating"""
+        conditioning_token_ids = list(conditioning_token_ids)
+
+        # batch unique consecutive
+        for index, sequence_info in enumerate(self.token_sequences[:-1]):
+            if sequence_info.unique_consecutive:
+                conditioning_token_ids[index] = batch_unique_consecutive(
+                    conditioning_token_ids[index], pad_value=self.pad_id)
+
+        # reshape and append eos
+        if append_eos_to_conditioning_tokens:
+            conditioning_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), conditioning_token_ids))
+            conditioning_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(conditioning_token_ids, self.eos_ids)]
+
+        return conditioning_token_ids
+
+    def compile_decoding(self, max_seq_len=4096, warmup_batch_size=1, **compile_kwargs):
+        """
+        Opt in to decoding every token after the prefill with TokenConditionedTransformer.decode_step_static, compiled
+        with torch.compile(**compile_kwargs). Sequences longer than max_seq_len positions are still decoded eagerly.
+
+        Compiles right away, by generating a couple of time steps for dummy conditioning of warmup_batch_size rows
+        (other batch sizes compile again on first use). If that fails, decoding stays eager and False is returned.
+        """
+        try:
+            self.static_decode_step = torch.compile(self.transformer.decode_step_static, **compile_kwargs)
+            self.static_max_seq_len = max_seq_len
+
+            conditioning_token_ids = [
+                torch.zeros((warmup_batch_size, sequence.num_quantizers), device=self.device, dtype=torch.long)
+                for sequence in self.token_sequences[:-1]
+            ]
+            self.generate(conditioning_token_ids=conditioning_token_ids, max_time_steps=2, num_speculative_tokens=0)
+        except Exception as e:
+            print(f'compiling the decode step failed, decoding eagerly instead: {e}')
+            self.static_decode_step = None
+            return False
+
+        return True
+
+    @torch.no_grad()
+    def prefill(
+        self,
+        *,
+        all_token_ids: List[torch.Tensor],
+        prefill_chunk_size: Optional[int] = None,
+        cond_scale=1.,
+        **kwargs
+    ):
+        """
+        Run the conditioning (and any already given predicted) tokens through the transformer once, in chunks of at
+        most prefill_chunk_size positions. Returns the logits for the next predicted token and the KVCache to decode from.
+
+        If the wrapper has a prefix_cache, the conditioning prefix is looked up there first and only the given
+        predicted tokens are run on a hit.
+
+        cond_scale: classifier free guidance scale, see TokenConditionedTransformer.forward_with_cond_scale
+        """
+        if not exists(self.prefix_cache):
+            pred_logits, cache = self.transformer.forward_with_cond_scale(
+                all_token_ids=all_token_ids,
+                cond_scale=cond_scale,
+                return_only_final_seq_logits=True,
+                return_cache=True,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs
+            )
+            return pred_logits[-1][:, -1], cache
+
+        conditioning_token_ids, pred_token_ids = all_token_ids[:-1], all_token_ids[-1]
+
+        # guided prefixes hold the rows of both branches and their logits depend on the scale
+        key_token_ids = conditioning_token_ids if cond_scale == 1 else conditioning_token_ids + [torch.tensor([cond_scale])]
+
+        key = self.prefix_cache.key(key_token_ids)
+        cached = self.prefix_cache.get(key)
+
+        if exists(cached):
+            last_pred_logits, cache = cached
+        else:
+            empty_pred_token_ids = pred_token_ids[:, :0]
+            pred_logits, cache = self.transformer.forward_with_cond_scale(
+                all_token_ids=conditioning_token_ids + [empty_pred_token_ids],
+                cond_scale=cond_scale,
+                return_only_final_seq_logits=True,
+                return_cache=True,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs
+            )
+            last_pred_logits = pred_logits[-1][:, -1]
+            self.prefix_cache.put(key, last_pred_logits, cache)
+
+        if pred_token_ids.shape[-1] == 0:
+            return last_pred_logits, cache
+
+        pred_logits, cache = self.transformer.forward_with_cond_scale(
+            all_token_ids=all_token_ids,
+            cond_scale=cond_scale,
+            return_only_final_seq_logits=True,
+            cache=cache,
+            return_cache=True,
+            prefill_chunk_size=prefill_chunk_size,
+            **kwargs
+        )
+        return pred_logits[-1][:, -1], cache
+
     @eval_decorator
     @torch.no_grad()
     @beartype_jit
@@ -263,8 +547,30 @@ class TokenConditionedTransformerWrapper(nn.Module):
         include_eos_in_output=False,
         append_eos_to_conditioning_tokens=True,
         allow_eos_in_output=False,
+        use_kv_cache=True,
+        prefill_chunk_size: Optional[int] = None,
+        num_speculative_tokens=4,
+        cond_scale=1.,
+        num_samples=1,
+        on_time_step: Optional[Callable[[torch.Tensor], None]] = None,
         **kwargs
     ):
+        """
+        use_kv_cache: if True, the conditioning and already sampled tokens are run through the transformer once and
+                      every step only attends the newly sampled token to the cached keys / values.
+                      Set to False to re-run the full sequence on every step.
+        prefill_chunk_size: maximum number of positions run through the transformer at once when (pre)filling the
+                            conditioning tokens. None runs them all at once.
+        num_speculative_tokens: if the wrapper has a draft_transformer (and use_kv_cache is set), the number of tokens
+                                it proposes per forward pass of the transformer, see speculative_sample. 0 to not use it.
+        cond_scale: classifier free guidance scale, 1 for none. Guidance runs the conditional and unconditional branches
+                    as one batch of twice the size, without speculative or compiled decoding.
+        num_samples: number of samples per row. With use_kv_cache the conditioning is prefilled once per row and the
+                     cache is copied to its samples. Returns (b * num_samples, n, q), the samples of a row consecutive.
+        on_time_step: called with the tokens (b * num_samples, 1, q) of every time step as soon as it is sampled, to
+                      stream them. A row ends with the time step holding its eos, rows that ended are filled with -1.
+                      Tokens are sampled one time step at a time then, without speculative decoding.
+        """
         assert len(conditioning_token_ids) == len(self.token_sequences) - 1
 
         batch, device = conditioning_token_ids[0].shape[0], self.device
@@ -279,53 +585,428 @@ class TokenConditionedTransformerWrapper(nn.Module):
             init_pred_time_step = 0
             pred_token_ids = torch.empty((batch, 0), device=device, dtype=torch.long)
 
+        # rows of the prefill, and which of them every sample is copied from
+
+        prefill_batch = batch
+        sample_rows = torch.arange(batch, device=device).repeat_interleave(num_samples)
+
+        if num_samples > 1:
+            conditioning_token_ids = [t[sample_rows] for t in conditioning_token_ids]
+            pred_token_ids = pred_token_ids[sample_rows]
+            batch = batch * num_samples
+
         pred_sequence_info, pred_eos_id = self.token_sequences[-1], self.eos_ids[-1]
 
-        # batch unique consecutive
-        for index, sequence_info in enumerate(self.token_sequences[:-1]):
-            if sequence_info.unique_consecutive:
-                conditioning_token_ids[index] = batch_unique_consecutive(
-                    conditioning_token_ids[index], pad_value=self.pad_id)
+        conditioning_token_ids = self.prepare_conditioning_token_ids(
+            conditioning_token_ids, append_eos_to_conditioning_tokens=append_eos_to_conditioning_tokens)
+
+        # the first sample of every row
+        prefill_conditioning_token_ids = [t[::num_samples] for t in conditioning_token_ids]
+
         if self.token_sequences[-1].unique_consecutive:
             pred_token_ids = batch_unique_consecutive(pred_token_ids, pad_value=self.pad_id)
 
-        # reshape and append eos
-        if append_eos_to_conditioning_tokens:
-            conditioning_token_ids = list(map(lambda t: rearrange(t, 'b ... -> b (...)'), conditioning_token_ids))
-            conditioning_token_ids = [append_eos_id(ids, eos_id) for ids, eos_id in zip(conditioning_token_ids, self.eos_ids)]
-
         # initialize
 
-        sampled_pred_token_ids = pred_token_ids.clone()
+        # preallocate the output, filled with the value mask_out_after_eos_id masks with. rows that sample eos stop
+        # generating early, so the rest of their row is left as is
+
+        init_pred_len = pred_token_ids.shape[-1]
+        max_pred_len = init_pred_len + max(max_time_steps - init_pred_time_step, 0) * pred_sequence_info.num_quantizers
+
+        sampled_pred_token_ids = torch.full((batch, max_pred_len), -1, device=device, dtype=torch.long)
+        sampled_pred_token_ids[:, :init_pred_len] = pred_token_ids
+        pred_len = init_pred_len
+
+        use_guidance = cond_scale != 1 and len(self.transformer.cond_sequence_indices) > 0
+
+        if use_kv_cache and exists(self.draft_transformer) and num_speculative_tokens > 0 and not use_guidance and not exists(on_time_step):
+            self.speculative_sample(
+                conditioning_token_ids=conditioning_token_ids,
+                sampled_pred_token_ids=sampled_pred_token_ids,
+                pred_len=pred_len,
+                num_speculative_tokens=num_speculative_tokens,
+                filter_thres=filter_thres,
+                temperature=temperature,
+                allow_eos_in_output=allow_eos_in_output,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs
+            )
+        else:
+            # rows of the batch that haven't sampled eos yet. finished rows are dropped from the conditioning and cache
+
+            active_rows = torch.arange(batch, device=device)
+            cache = None
+
+            # once prefilled, the cache is moved to static buffers for the compiled decode step, if the sequence fits
+
+            static_cache = None
+            position = None
+
+            for time_step in tqdm(range(init_pred_time_step, max_time_steps), desc='generating predicted tokens'):
+                for ind in range(pred_sequence_info.num_quantizers):
+                    is_last_step = ind == (pred_sequence_info.num_quantizers - 1)
+
+                    if active_rows.shape[0] == batch:
+                        active_pred_token_ids = sampled_pred_token_ids[:, :pred_len]
+                    else:
+                        active_pred_token_ids = sampled_pred_token_ids[active_rows, :pred_len]
+
+                    if not use_kv_cache:
+                        last_pred_logits = self.transformer.forward_with_cond_scale(
+                            all_token_ids=conditioning_token_ids + [active_pred_token_ids],
+                            cond_scale=cond_scale,
+                            return_only_final_seq_logits=True,
+                            prefill_chunk_size=prefill_chunk_size,
+                            **kwargs
+                        )[-1][:, -1]
+                    elif exists(static_cache):
+                        last_pred_logits = self.static_decode_step(
+                            active_pred_token_ids[:, -1:],
+                            torch.full((active_rows.shape[0],), pred_len - 1, device=device),
+                            position,
+                            static_cache
+                        )
+                        position += 1
+                    elif not exists(cache):
+                        last_pred_logits, cache = self.prefill(
+                            all_token_ids=prefill_conditioning_token_ids + [active_pred_token_ids[::num_samples]],
+                            prefill_chunk_size=prefill_chunk_size,
+                            cond_scale=cond_scale,
+                            **kwargs
+                        )
+
+                        if num_samples > 1:
+                            # with guidance, the cache holds the conditional rows followed by the unconditional ones
+                            cache_rows = torch.cat((sample_rows, sample_rows + prefill_batch)) if use_guidance else sample_rows
+                            cache = cache.map(lambda t: t[cache_rows])
+                            last_pred_logits = last_pred_logits[sample_rows]
+
+                        if exists(self.static_decode_step) and not use_guidance and cache.seq_len + max_pred_len - pred_len <= self.static_max_seq_len:
+                            static_cache = StaticKVCache.from_cache(cache, self.static_max_seq_len)
+                            position = torch.tensor([cache.seq_len], device=device)
+                            cache = None
+                    else:
+                        pred_logits, cache = self.transformer.forward_with_cond_scale(
+                            all_token_ids=conditioning_token_ids + [active_pred_token_ids],
+                            cond_scale=cond_scale,
+                            return_only_final_seq_logits=True,
+                            cache=cache,
+                            return_cache=True,
+                            **kwargs
+                        )
+                        last_pred_logits = pred_logits[-1][:, -1]
+
+                    if not allow_eos_in_output or not is_last_step:
+                        # prevent eos 1) if we don't allow it or 2) in the middle of a time step
+                        last_pred_logits[:, -1] = float('-inf')
+
+                    filtered_logits = top_k(last_pred_logits, thres=filter_thres)
+                    sampled = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)
+
+                    sampled_pred_token_ids[active_rows, pred_len] = sampled
+                    pred_len += 1
+
+                if exists(on_time_step):
+                    time_step_token_ids = sampled_pred_token_ids[:, (pred_len - pred_sequence_info.num_quantizers):pred_len]
+                    on_time_step(rearrange(time_step_token_ids, 'b q -> b 1 q'))
+
+                # eos can only be sampled at the end of a time step
+
+                is_finished = sampled == pred_eos_id
+
+                if is_finished.any():
+                    if is_finished.all():
+                        break
+
+                    keep = (~is_finished).nonzero().squeeze(-1)
+                    active_rows = active_rows[keep]
+                    conditioning_token_ids = [ids[keep] for ids in conditioning_token_ids]
+
+                    # with guidance, the cache holds the conditional rows followed by the unconditional ones
+                    cache_keep = torch.cat((keep, keep + is_finished.shape[0])) if use_guidance else keep
+                    cache = cache.map(lambda t: t[cache_keep]) if exists(cache) else None
+                    static_cache = static_cache.select_rows(keep) if exists(static_cache) else None
+
+        sampled_pred_token_ids = mask_out_after_eos_id(
+            sampled_pred_token_ids, pred_eos_id, keep_eos=include_eos_in_output)
+        sampled_pred_token_ids = rearrange(
+            sampled_pred_token_ids, 'b (n q) -> b n q', q=pred_sequence_info.num_quantizers)
+
+        return sampled_pred_token_ids
+
+    @eval_decorator
+    @torch.no_grad()
+    def generate_sliding_windows(
+        self,
+        *,
+        conditioning_token_ids: List[torch.Tensor],
+        pred_token_ids: Optional[torch.Tensor] = None,
+        max_time_steps: int,
+        window_time_steps: int,
+        condition_time_steps: int,
+        filter_thres=0.9,
+        temperature=1.,
+        append_eos_to_conditioning_tokens=True,
+        prefill_chunk_size: Optional[int] = None,
+    ):
+        """
+        Generate max_time_steps time steps (including the given pred_token_ids) in sliding windows of window_time_steps,
+        each window conditioned on the last condition_time_steps of the previous one, like calling generate per window
+        with the tail of the previous one as pred_token_ids. Eos is never sampled.
+
+        Instead of prefilling every window again, the cache is carried over: once a sampled token fills the window, the
+        positions of the time steps sliding out of it are dropped from the cache before that token is run, so the first
+        token of the next window is sampled seeing only the condition_time_steps tail, as in a freshly prefilled window.
+        The relative position bias only depends on the distance between positions, so the kept positions line up
+        exactly as in a freshly prefilled window. Their keys / values were computed with the dropped time steps still in
+        context though, which is where this differs from prefilling. Returns (b, max_time_steps, q).
+        """
+        assert not self.transformer.use_absolute_position_embeddings, 'the cache can only be shifted with relative positions'
+        assert not self.token_sequences[-1].unique_consecutive
+        assert 0 < condition_time_steps < window_time_steps
+
+        batch, device = conditioning_token_ids[0].shape[0], self.device
+        num_quantizers, eos_id = self.token_sequences[-1].num_quantizers, self.eos_ids[-1]
 
-        for time_step in tqdm(range(init_pred_time_step, max_time_steps), desc='generating predicted tokens'):
-            for ind in range(pred_sequence_info.num_quantizers):
-                is_last_step = ind == (pred_sequence_info.num_quantizers - 1)
+        conditioning_token_ids = self.prepare_conditioning_token_ids(
+            [t.to(device) for t in conditioning_token_ids], append_eos_to_conditioning_tokens=append_eos_to_conditioning_tokens)
+
+        if exists(pred_token_ids):
+            pred_token_ids = rearrange(pred_token_ids.to(device), 'b ... -> b (...)')
+        else:
+            pred_token_ids = torch.empty((batch, 0), device=device, dtype=torch.long)
+
+        max_pred_len = max_time_steps * num_quantizers
+        sampled_pred_token_ids = torch.full((batch, max_pred_len), -1, device=device, dtype=torch.long)
+        sampled_pred_token_ids[:, :pred_token_ids.shape[-1]] = pred_token_ids
+        pred_len = pred_token_ids.shape[-1]
+
+        logits, cache = self.prefill(
+            all_token_ids=conditioning_token_ids + [pred_token_ids],
+            prefill_chunk_size=prefill_chunk_size
+        )
+
+        # the predicted tokens of the window start after the conditioning and their start token
+        window_start = sum(t.shape[-1] + 1 for t in conditioning_token_ids) + 1
+        window_len = pred_len
+        window_slide = (window_time_steps - condition_time_steps) * num_quantizers
+        assert window_len < window_time_steps * num_quantizers, 'the given pred_token_ids must fit in the first window'
+
+        for _ in tqdm(range(pred_len, max_pred_len), desc='generating predicted tokens in sliding windows'):
+            logits[:, eos_id] = float('-inf')
+
+            filtered_logits = top_k(logits, thres=filter_thres)
+            sampled = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)
+
+            sampled_pred_token_ids[:, pred_len] = sampled
+            pred_len += 1
+
+            if pred_len == max_pred_len:
+                break
+
+            # the sampled token fills the window, slide it before running the token
+            if window_len + 1 == window_time_steps * num_quantizers:
+                keep = torch.cat((
+                    torch.arange(window_start, device=device),
+                    torch.arange(window_start + window_slide, cache.seq_len, device=device)
+                ))
+                cache = cache.map_kv(lambda t: t[:, keep])
+                window_len -= window_slide
+
+            logits, cache = self.transformer.decode_step(
+                token_ids=rearrange(sampled, 'b -> b 1'),
+                pred_positions=torch.full((batch,), window_len, device=device),
+                cache=cache
+            )
+            window_len += 1
+
+        return rearrange(sampled_pred_token_ids, 'b (n q) -> b n q', q=num_quantizers)
+
+    def get_sampling_probs(self, logits, pred_positions, *, filter_thres, temperature, allow_eos_in_output):
+        """
+        The distribution generate samples the predicted tokens at pred_positions (n,) from, given their logits (b, n, c)
+        """
+        num_quantizers = self.token_sequences[-1].num_quantizers
+
+        # prevent eos 1) if we don't allow it or 2) in the middle of a time step
+        mask_eos = (pred_positions % num_quantizers) != (num_quantizers - 1)
+        if not allow_eos_in_output:
+            mask_eos = torch.ones_like(mask_eos)
+
+        logits = logits.clone()
+        logits[:, mask_eos, -1] = float('-inf')
+
+        filtered_logits = top_k(rearrange(logits, 'b n c -> (b n) c'), thres=filter_thres)
+        probs = (filtered_logits / temperature).softmax(dim=-1)
+        return rearrange(probs, '(b n) c -> b n c', b=logits.shape[0])
+
+    @torch.no_grad()
+    def speculative_sample(
+        self,
+        *,
+        conditioning_token_ids: List[torch.Tensor],
+        sampled_pred_token_ids: torch.Tensor,
+        pred_len: int,
+        num_speculative_tokens: int,
+        filter_thres=0.9,
+        temperature=1.,
+        allow_eos_in_output=False,
+        prefill_chunk_size: Optional[int] = None,
+        **kwargs
+    ):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192). The draft transformer proposes num_speculative_tokens
+        tokens one at a time, which the transformer then scores in a single forward pass. A proposed token is accepted
+        with probability min(1, p / q) and the first rejected one is resampled from max(0, p - q), so the sampled tokens
+        follow exactly the same distribution as sampling from the transformer alone.
 
-                pred_logits = self.transformer(
-                    all_token_ids=conditioning_token_ids + [sampled_pred_token_ids],
+        All rows of the batch advance by the smallest number of tokens accepted in any row. Fills sampled_pred_token_ids
+        (b, max_pred_len) in place, from pred_len on.
+        """
+        batch, device = sampled_pred_token_ids.shape[0], sampled_pred_token_ids.device
+        max_pred_len = sampled_pred_token_ids.shape[-1]
+        pred_eos_id = self.eos_ids[-1]
+
+        def forward_past_cache(transformer, pred_token_ids, cache, cached_len, cached_logits, num_logits):
+            """
+            run the predicted tokens past the cache, returns the logits for the last num_logits positions up to and
+            including position pred_token_ids.shape[-1], along with the updated cache
+            """
+            logits = rearrange(cached_logits, 'b c -> b 1 c')
+
+            if pred_token_ids.shape[-1] > cached_len:
+                new_logits, cache = transformer(
+                    all_token_ids=conditioning_token_ids + [pred_token_ids],
                     return_only_final_seq_logits=True,
+                    cache=cache,
+                    return_cache=True,
                     **kwargs
-                )[-1]
+                )
+                logits = torch.cat((logits, new_logits[-1]), dim=1)
 
-                last_pred_logits = pred_logits[:, -1]
+            return logits[:, -num_logits:], cache
 
-                if not allow_eos_in_output or not is_last_step:
-                    # prevent eos 1) if we don't allow it or 2) in the middle of a time step
-                    last_pred_logits[:, -1] = float('-inf')
+        # either cache covers the first main_len / draft_len predicted tokens, and is kept along with the logits
+        # for the next token. sampled tokens past it are run on the next forward pass
 
-                filtered_logits = top_k(last_pred_logits, thres=filter_thres)
-                sampled = gumbel_sample(filtered_logits, temperature=temperature, dim=-1)
+        pred_token_ids = sampled_pred_token_ids[:, :pred_len]
 
-                sampled = rearrange(sampled, 'b -> b 1')
-                sampled_pred_token_ids = torch.cat((sampled_pred_token_ids, sampled), dim=-1)
+        main_logits, main_cache = self.prefill(
+            all_token_ids=conditioning_token_ids + [pred_token_ids],
+            prefill_chunk_size=prefill_chunk_size,
+            **kwargs
+        )
+        draft_logits, draft_cache = self.draft_transformer(
+            all_token_ids=conditioning_token_ids + [pred_token_ids],
+            return_only_final_seq_logits=True,
+            return_cache=True,
+            prefill_chunk_size=prefill_chunk_size,
+            **kwargs
+        )
+        draft_logits = draft_logits[-1][:, -1]
+        main_len = draft_len = pred_len
 
-        sampled_pred_token_ids = mask_out_after_eos_id(
-            sampled_pred_token_ids, pred_eos_id, keep_eos=include_eos_in_output)
-        sampled_pred_token_ids = rearrange(
-            sampled_pred_token_ids, 'b (n q) -> b n q', q=pred_sequence_info.num_quantizers)
+        # rows of the batch that haven't sampled eos yet. finished rows are dropped from the conditioning and caches
 
-        return sampled_pred_token_ids
+        active_rows = torch.arange(batch, device=device)
+
+        get_probs = lambda logits, start: self.get_sampling_probs(
+            logits,
+            torch.arange(start, start + logits.shape[1], device=device),
+            filter_thres=filter_thres,
+            temperature=temperature,
+            allow_eos_in_output=allow_eos_in_output
+        )
+
+        progress = tqdm(total=max_pred_len, initial=pred_len, desc='generating predicted tokens (speculative)')
+
+        while pred_len < max_pred_len:
+            num_draft = min(num_speculative_tokens, max_pred_len - pred_len - 1)
+
+            pred_token_ids = sampled_pred_token_ids[active_rows, :pred_len]
+
+            # propose tokens with the draft transformer, keeping its cache and logits after every one of them
+
+            draft_token_ids = pred_token_ids[:, :0]
+            draft_probs, draft_states = [], []
+
+            for ind in range(num_draft):
+                step_logits, draft_cache = forward_past_cache(
+                    self.draft_transformer,
+                    torch.cat((pred_token_ids, draft_token_ids), dim=-1),
+                    draft_cache, draft_len, draft_logits, num_logits=1
+                )
+                draft_logits, draft_len = step_logits[:, -1], pred_len + ind
+                draft_states.append((draft_cache, draft_logits, draft_len))
+
+                probs = get_probs(step_logits, pred_len + ind)[:, -1]
+                draft_probs.append(probs)
+                draft_token_ids = torch.cat((draft_token_ids, torch.multinomial(probs, 1)), dim=-1)
+
+            # score all proposed tokens (and the sampled tokens the transformer hasn't seen yet) in one pass
+
+            logits, verify_cache = forward_past_cache(
+                self.transformer,
+                torch.cat((pred_token_ids, draft_token_ids), dim=-1),
+                main_cache, main_len, main_logits, num_logits=num_draft + 1
+            )
+            probs = get_probs(logits, pred_len)
+
+            num_accepted = torch.zeros((active_rows.shape[0],), device=device, dtype=torch.long)
+
+            if num_draft > 0:
+                draft_probs = torch.stack(draft_probs, dim=1)
+
+                p = probs[:, :-1].gather(-1, draft_token_ids[..., None]).squeeze(-1)
+                q = draft_probs.gather(-1, draft_token_ids[..., None]).squeeze(-1)
+
+                accepted = torch.rand_like(p) < (p / q)
+                num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+
+            num_kept = num_accepted.min().item()
+
+            # the token following the kept ones is a proposed token for rows that accepted more, resampled from the
+            # residual distribution for rows that rejected it, or sampled by the transformer if all were accepted
+
+            if num_kept < num_draft:
+                residual = (probs[:, num_kept] - draft_probs[:, num_kept]).clamp(min=0.)
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0, residual, probs[:, num_kept])
+                next_token_ids = torch.multinomial(residual, 1).squeeze(-1)
+                next_token_ids = torch.where(num_accepted > num_kept, draft_token_ids[:, num_kept], next_token_ids)
+            else:
+                next_token_ids = torch.multinomial(probs[:, num_kept], 1).squeeze(-1)
+
+            new_token_ids = torch.cat((draft_token_ids[:, :num_kept], rearrange(next_token_ids, 'b -> b 1')), dim=-1)
+            sampled_pred_token_ids[active_rows, pred_len:(pred_len + num_kept + 1)] = new_token_ids
+
+            # roll the caches back to the kept tokens. the cached causal conv inputs can't be truncated, so the
+            # transformer only keeps its new cache if all proposed tokens were kept
+
+            if num_kept == num_draft:
+                main_cache, main_logits, main_len = verify_cache, logits[:, -1], pred_len + num_draft
+
+            if num_draft > 0:
+                draft_cache, draft_logits, draft_len = draft_states[min(num_kept, num_draft - 1)]
+
+            pred_len += num_kept + 1
+            progress.update(num_kept + 1)
+
+            # eos can only be sampled at the end of a time step
+
+            is_finished = (new_token_ids == pred_eos_id).any(dim=-1)
+
+            if is_finished.any():
+                if is_finished.all():
+                    break
+
+                keep = (~is_finished).nonzero().squeeze(-1)
+                active_rows = active_rows[keep]
+                conditioning_token_ids = [ids[keep] for ids in conditioning_token_ids]
+                main_cache, main_logits = main_cache.map(lambda t: t[keep]), main_logits[keep]
+                draft_cache, draft_logits = draft_cache.map(lambda t: t[keep]), draft_logits[keep]
+
+        progress.close()
 
     def forward(
         self,
@@ -358,19 +1039,20 @@ class TokenConditionedTransformerWrapper(nn.Module):
             all_token_ids[-1] = all_token_ids[-1][:, :-1]  # don't include last token when returning loss (should be eos)
 
         # do not attend to padding tokens or eos tokens
-        combined_self_attn_mask = torch.empty((batch, 0), device=device, dtype=torch.bool)
+        # the transformer prepends a start token to every sequence, so the masks are laid out the same way
+        masks = []
         for ids, eos_id in zip(all_token_ids[:-1], self.eos_ids[:-1]):
             mask = (ids != self.pad_id) & (ids != eos_id)
 
             ids.masked_fill_(~mask, 0)  # inplace
 
-            # transformer appends a start token to beginning of sequence, so add to mask
-            mask = F.pad(mask, (1, 0), value=True)
-            combined_self_attn_mask = torch.cat((combined_self_attn_mask, mask), dim=-1)
+            masks.extend((torch.ones((batch, 1), device=device, dtype=torch.bool), mask))
 
         # add our predicted tokens + start token to our mask
         pred_token_len = all_token_ids[-1].shape[-1]
-        combined_self_attn_mask = F.pad(combined_self_attn_mask, (0, pred_token_len + 1), value=True)
+        masks.append(torch.ones((batch, pred_token_len + 1), device=device, dtype=torch.bool))
+
+        combined_self_attn_mask = torch.cat(masks, dim=-1)
 
         # forgetful causal mask - structured dropout
         if self.mask_prob > 0 and self.training:
@@ -419,6 +1101,7 @@ def create_semantic_transformer(
     clap_codebook_size=1024,
     semantic_codebook_size=1024,
     num_clap_quantizers=12,
+    cond_sequence_indices=(0,),  # the clap tokens
     **kwargs
 ):
 
@@ -427,7 +1110,7 @@ def create_semantic_transformer(
     semantic_sequence = TokenSequenceInfo(codebook_size=semantic_codebook_size,
                                           num_quantizers=1, unique_consecutive=False)
 
-    return TokenConditionedTransformer(token_sequences=[clap_sequence, semantic_sequence], dim=dim, depth=depth, **kwargs)
+    return TokenConditionedTransformer(token_sequences=[clap_sequence, semantic_sequence], dim=dim, depth=depth, cond_sequence_indices=cond_sequence_indices, **kwargs)
 
 
 @beartype_jit
@@ -439,6 +1122,7 @@ def create_coarse_transformer(
     acoustic_codebook_size=1024,
     num_clap_quantizers=12,
     num_coarse_quantizers=4,
+    cond_sequence_indices=(0,),  # the clap tokens
     **kwargs
 ):
 
@@ -449,7 +1133,7 @@ def create_coarse_transformer(
     coarse_sequence = TokenSequenceInfo(
         codebook_size=acoustic_codebook_size, num_quantizers=num_coarse_quantizers, unique_consecutive=False)
 
-    return TokenConditionedTransformer(token_sequences=[clap_sequence, semantic_sequence, coarse_sequence], dim=dim, depth=depth, **kwargs)
+    return TokenConditionedTransformer(token_sequences=[clap_sequence, semantic_sequence, coarse_sequence], dim=dim, depth=depth, cond_sequence_indices=cond_sequence_indices, **kwargs)
 
 
 @beartype_jit
@@ -529,7 +1213,8 @@ def get_or_compute_semantic_token_ids(semantic_token_ids: Optional[torch.Tensor]
 
 
 @beartype_jit
-def get_or_compute_acoustic_token_ids(coarse_token_ids: Optional[torch.Tensor], fine_token_ids: Optional[torch.Tensor], raw_audio: Optional[torch.Tensor], neural_codec: Optional[NeuralCodec], num_coarse_quantizers: int):
+def get_or_compute_acoustic_token_ids(coarse_token_ids: Optional[torch.Tensor], fine_token_ids: Optional[torch.Tensor], raw_audio: Optional[torch.Tensor], neural_codec: Optional[NeuralCodec], num_coarse_quantizers: int, coarse_only=False):
+    """coarse_only: encode only the coarse quantizers of raw_audio, fine_token_ids are returned empty"""
 
     if exists(raw_audio):
         assert not exists(coarse_token_ids) and not exists(fine_token_ids), "either provide coarse + fine ids or raw audio"
@@ -537,7 +1222,7 @@ def get_or_compute_acoustic_token_ids(coarse_token_ids: Optional[torch.Tensor],
 
         with torch.no_grad():
             neural_codec.eval()
-            _, indices, _ = neural_codec(raw_audio, return_encoded=True)
+            _, indices, _ = neural_codec(raw_audio, return_encoded=True, num_quantizers=num_coarse_quantizers if coarse_only else None)
             coarse_token_ids, fine_token_ids = indices[..., :num_coarse_quantizers], indices[..., num_coarse_quantizers:]
 
     return coarse_token_ids, fine_token_ids
@@ -647,7 +1332,9 @@ class CoarseStage(nn.Module):
         pad_id=-1,
         unique_consecutive=False,
         cross_entropy_loss_weights: List[float] = None,
-        mask_prob=0.15
+        mask_prob=0.15,
+        prefix_cache: Optional[PrefixCache] = None,
+        draft_transformer: Optional[TokenConditionedTransformer] = None
     ):
         super().__init__()
 
@@ -667,7 +1354,9 @@ class CoarseStage(nn.Module):
             pad_id=pad_id,
             unique_consecutive=unique_consecutive,
             cross_entropy_loss_weights=cross_entropy_loss_weights,
-            mask_prob=mask_prob
+            mask_prob=mask_prob,
+            prefix_cache=prefix_cache,
+            draft_transformer=draft_transformer
         )
 
     @property
@@ -691,6 +1380,7 @@ class CoarseStage(nn.Module):
         include_eos_in_output=False,  # if doing hierarchical sampling, eos can be kept for an easy time
         append_eos_to_conditioning_tokens=True, # if doing heirarchical sampling and you want more control
         reconstruct_wave = False,
+        cond_scale=1.,  # classifier free guidance on the clap tokens, 1 for none
         **kwargs
     ):
         clap_token_ids = get_or_compute_clap_token_ids(clap_token_ids, self.clap, conditioning_audio, conditioning_text)
@@ -703,6 +1393,7 @@ class CoarseStage(nn.Module):
             temperature=temperature,
             include_eos_in_output=include_eos_in_output,
             append_eos_to_conditioning_tokens=append_eos_to_conditioning_tokens,
+            cond_scale=cond_scale,
             **kwargs
         )
 
@@ -735,7 +1426,8 @@ class CoarseStage(nn.Module):
             fine_token_ids=None,
             raw_audio=raw_wave_for_acoustic,
             neural_codec=self.neural_codec,
-            num_coarse_quantizers=self.num_coarse_quantizers
+            num_coarse_quantizers=self.num_coarse_quantizers,
+            coarse_only=True
         )
 
         return self.transformer_wrapper.forward(
@@ -857,7 +1549,8 @@ class SemcoarsetosemStage(nn.Module): # 결국, clap discrete
         pad_id=-1,
         unique_consecutive=False,
         cross_entropy_loss_weights: List[float] = None,
-        mask_prob=0.15
+        mask_prob=0.15,
+        prefix_cache: Optional[PrefixCache] = None
     ):
         super().__init__()
 
@@ -873,7 +1566,8 @@ class SemcoarsetosemStage(nn.Module): # 결국, clap discrete
             pad_id=pad_id,
             unique_consecutive=unique_consecutive,
             cross_entropy_loss_weights=cross_entropy_loss_weights,
-            mask_prob=mask_prob
+            mask_prob=mask_prob,
+            prefix_cache=prefix_cache
         )
 
     @property
@@ -935,7 +1629,8 @@ class SemcoarsetosemStage(nn.Module): # 결국, clap discrete
             fine_token_ids=None,
             raw_audio=vocals_raw_wave_for_acoustic,
             neural_codec=self.neural_codec,
-            num_coarse_quantizers=self.num_coarse_quantizers
+            num_coarse_quantizers=self.num_coarse_quantizers,
+            coarse_only=True
         )
         return self.transformer_wrapper.forward(
             #vocals_clap_token_ids=torch.Size([2, 12, 1]),other_clap_token_ids=torch.Size([2, 12, 1])
@@ -1031,7 +1726,8 @@ class InstcoarseStage(nn.Module): # 결국, clap discrete
             fine_token_ids=None,
             raw_audio=vocals_raw_wave_for_acoustic,
             neural_codec=self.neural_codec,
-            num_coarse_quantizers=self.num_coarse_quantizers
+            num_coarse_quantizers=self.num_coarse_quantizers,
+            coarse_only=True
         )
         
         other_coarse_token_ids, _ = get_or_compute_acoustic_token_ids(
@@ -1039,7 +1735,8 @@ class InstcoarseStage(nn.Module): # 결국, clap discrete
             fine_token_ids=None,
             raw_audio=other_raw_wave_for_acoustic,
             neural_codec=self.neural_codec,
-            num_coarse_quantizers=self.num_coarse_quantizers
+            num_coarse_quantizers=self.num_coarse_quantizers,
+            coarse_only=True
         )
         return self.transformer_wrapper.forward(
             #vocals_clap_token_ids=torch.Size([2, 12, 1]),other_clap_token_ids=torch.Size([2, 12, 1])
@@ -1112,7 +1809,18 @@ class MusicLM(nn.Module):
         semantic_sliding_window_step_percent=0.5,
         coarse_sliding_window_step_percent=0.5,
         fine_sliding_window_step_percent=1,
+        reuse_semantic_window_cache=False,
+        max_windows_per_batch=16,
     ):
+        """
+        reuse_semantic_window_cache: carry the cache of the semantic stage over from one sliding window to the next
+                                     instead of prefilling every window, see generate_sliding_windows. The keys / values
+                                     of the kept time steps are approximate, so this is off until the windows benchmark
+                                     shows no quality difference. The coarse and fine windows are conditioned on a
+                                     different window of tokens every time, so they are still prefilled per window.
+        max_windows_per_batch: coarse / fine windows that don't depend on each other are generated together, at most
+                               this many at once, see generate_windows.
+        """
         assert exists(text), 'text needs to be passed in if one of the transformer requires conditioning'
 
         clap_token_ids = get_or_compute_clap_token_ids(None, self.clap, conditioning_audio=None, conditioning_text=text)
@@ -1161,16 +1869,32 @@ class MusicLM(nn.Module):
 
         # semantic stage
 
-        all_semantic_token_ids = self.semantic.generate(
-            clap_token_ids=clap_token_ids,
-            semantic_token_ids=audio_condition_semantic_token_ids,
-            max_time_steps=int(min(output_seconds, semantic_window_seconds) * semantic_steps_per_second),
-            include_eos_in_output=False,
-            append_eos_to_conditioning_tokens=True,
-        )
+        semantic_window_size = int(semantic_window_seconds * semantic_steps_per_second)
+        semantic_condition_length = int(semantic_window_seconds * semantic_steps_per_second * (1 - semantic_sliding_window_step_percent))
+        semantic_first_window_size = int(min(output_seconds, semantic_window_seconds) * semantic_steps_per_second)
+
+        if reuse_semantic_window_cache and not self.semantic.transformer_wrapper.transformer.use_absolute_position_embeddings:
+            # as many time steps as the windows below would generate
+            num_semantic_windows = ceil_div(max(int(output_seconds * semantic_steps_per_second) - semantic_first_window_size, 0), semantic_window_size - semantic_condition_length)
+
+            all_semantic_token_ids = self.semantic.transformer_wrapper.generate_sliding_windows(
+                conditioning_token_ids=[clap_token_ids],
+                pred_token_ids=audio_condition_semantic_token_ids,
+                max_time_steps=semantic_first_window_size + num_semantic_windows * (semantic_window_size - semantic_condition_length),
+                window_time_steps=semantic_window_size,
+                condition_time_steps=semantic_condition_length,
+            )
+        else:
+            all_semantic_token_ids = self.semantic.generate(
+                clap_token_ids=clap_token_ids,
+                semantic_token_ids=audio_condition_semantic_token_ids,
+                max_time_steps=semantic_first_window_size,
+                include_eos_in_output=False,
+                append_eos_to_conditioning_tokens=True,
+            )
 
         while all_semantic_token_ids.shape[1] < int(output_seconds * semantic_steps_per_second):
-            condition_length = int(semantic_window_seconds * semantic_steps_per_second * (1 - semantic_sliding_window_step_percent))
+            condition_length = semantic_condition_length
             condition_semantic_token_ids = all_semantic_token_ids[:, -condition_length:]
             pred_semantic_token_ids = self.semantic.generate(
                 clap_token_ids=clap_token_ids,
@@ -1192,30 +1916,20 @@ class MusicLM(nn.Module):
         all_semantic_token_ids = all_semantic_token_ids.unfold(1, window_size, step_size)
         all_semantic_token_ids = rearrange(all_semantic_token_ids, 'b n q w -> n b w q')
 
-        all_coarse_token_ids = None
-        for semantic_token_ids in all_semantic_token_ids:
-            if exists(all_coarse_token_ids):
-                condition_length = int(coarse_window_seconds * acoustic_steps_per_second * (1 - coarse_sliding_window_step_percent))
-                condition_coarse_token_ids = all_coarse_token_ids[:, -condition_length:]
-            else:
-                condition_coarse_token_ids = audio_condition_coarse_token_ids
-
-            pred_coarse_token_ids = self.coarse.generate(
-                clap_token_ids=clap_token_ids,
-                semantic_token_ids=semantic_token_ids,
-                coarse_token_ids=condition_coarse_token_ids,
-                max_time_steps=int(coarse_window_seconds * acoustic_steps_per_second),
-                reconstruct_wave=False,
-                include_eos_in_output=False,
-                append_eos_to_conditioning_tokens=True,
-                temperature=0.95,
-            )
-
-            if not exists(all_coarse_token_ids):
-                all_coarse_token_ids = pred_coarse_token_ids
-            else:
-                pred_coarse_token_ids = pred_coarse_token_ids[:, condition_length:]
-                all_coarse_token_ids = torch.cat([all_coarse_token_ids, pred_coarse_token_ids], dim=1)
+        all_coarse_token_ids = self.generate_windows(
+            self.coarse.generate,
+            windows=dict(semantic_token_ids=all_semantic_token_ids),
+            shared=dict(clap_token_ids=clap_token_ids),
+            pred_name='coarse_token_ids',
+            condition_length=int(coarse_window_seconds * acoustic_steps_per_second * (1 - coarse_sliding_window_step_percent)),
+            first_condition_token_ids=audio_condition_coarse_token_ids,
+            max_windows_per_batch=max_windows_per_batch,
+            max_time_steps=int(coarse_window_seconds * acoustic_steps_per_second),
+            reconstruct_wave=False,
+            include_eos_in_output=False,
+            append_eos_to_conditioning_tokens=True,
+            temperature=0.95,
+        )
 
         if return_coarse_generated_wave:
             wave = self.neural_codec.decode_from_codebook_indices(all_coarse_token_ids)
@@ -1232,29 +1946,20 @@ class MusicLM(nn.Module):
         all_coarse_token_ids_unfolded = all_coarse_token_ids.unfold(1, fine_window_size, fine_step_size)
         all_coarse_token_ids_unfolded = rearrange(all_coarse_token_ids_unfolded, 'b n q w -> n b w q')
 
-        all_fine_token_ids = None
-        for coarse_token_ids in all_coarse_token_ids_unfolded:
-            if exists(all_fine_token_ids):
-                condition_length = int(fine_window_size * (1 - fine_sliding_window_step_percent))
-                condition_fine_token_ids = all_fine_token_ids[:, -condition_length:] if condition_length > 0 else None
-            else:
-                condition_fine_token_ids = audio_condition_fine_token_ids
-
-            pred_fine_token_ids = self.fine.generate(
-                clap_token_ids=clap_token_ids,
-                coarse_token_ids=coarse_token_ids,
-                fine_token_ids=condition_fine_token_ids,
-                max_time_steps=fine_window_size,
-                reconstruct_wave=False,
-                include_eos_in_output=False,
-                append_eos_to_conditioning_tokens=True,
-                temperature=0.4,
-            )
-            if not exists(all_fine_token_ids):
-                all_fine_token_ids = pred_fine_token_ids
-            else:
-                pred_fine_token_ids = pred_fine_token_ids[:, condition_length:]
-                all_fine_token_ids = torch.cat([all_fine_token_ids, pred_fine_token_ids], dim=1)
+        all_fine_token_ids = self.generate_windows(
+            self.fine.generate,
+            windows=dict(coarse_token_ids=all_coarse_token_ids_unfolded),
+            shared=dict(clap_token_ids=clap_token_ids),
+            pred_name='fine_token_ids',
+            condition_length=int(fine_window_size * (1 - fine_sliding_window_step_percent)),
+            first_condition_token_ids=audio_condition_fine_token_ids,
+            max_windows_per_batch=max_windows_per_batch,
+            max_time_steps=fine_window_size,
+            reconstruct_wave=False,
+            include_eos_in_output=False,
+            append_eos_to_conditioning_tokens=True,
+            temperature=0.4,
+        )
 
         # crop fine tokens to remove conditioning audio
         all_fine_token_ids = all_fine_token_ids[:, fine_token_adjustment:]
@@ -1268,6 +1973,64 @@ class MusicLM(nn.Module):
         wave = rearrange(wave, 'b 1 n -> b n')
         return wave
 
+    def generate_windows(
+        self,
+        stage_generate: Callable,
+        *,
+        windows: Dict[str, torch.Tensor],
+        shared: Dict[str, torch.Tensor],
+        pred_name: str,
+        condition_length: int,
+        first_condition_token_ids: Optional[torch.Tensor] = None,
+        max_windows_per_batch: Optional[int] = None,
+        **kwargs
+    ):
+        """
+        Generate consecutive windows with stage_generate and concatenate their tokens along time.
+
+        windows: conditioning token ids of every window (n, b, w, q), by stage_generate argument
+        shared: conditioning token ids (b, ...) of all windows, by stage_generate argument
+        pred_name: stage_generate argument for the start of the predicted tokens. A window is given the last
+                   condition_length tokens of the windows before it, the first one first_condition_token_ids.
+
+        A window given no tokens doesn't depend on the windows before it. With condition_length 0 that holds for every
+        window after the first, so they are stacked into the batch and generated together, up to max_windows_per_batch
+        at a time. The other windows are generated in order.
+        """
+        num_windows = next(iter(windows.values())).shape[0]
+        max_windows_per_batch = default(max_windows_per_batch, num_windows)
+
+        all_token_ids = None
+        ind = 0
+
+        while ind < num_windows:
+            if not exists(all_token_ids):
+                condition_token_ids = first_condition_token_ids
+            else:
+                condition_token_ids = all_token_ids[:, -condition_length:] if condition_length > 0 else None
+
+            independent = not exists(condition_token_ids) and condition_length == 0
+            end = min(num_windows, ind + max_windows_per_batch) if independent else ind + 1
+            num_batched = end - ind
+
+            pred_token_ids = stage_generate(
+                **{name: rearrange(t[ind:end], 'n b ... -> (n b) ...') for name, t in windows.items()},
+                **{name: repeat(t, 'b ... -> (n b) ...', n=num_batched) for name, t in shared.items()},
+                **{pred_name: condition_token_ids},
+                **kwargs
+            )
+            pred_token_ids = rearrange(pred_token_ids, '(n b) w q -> b (n w) q', n=num_batched)
+
+            if not exists(all_token_ids):
+                all_token_ids = pred_token_ids
+            else:
+                pred_token_ids = pred_token_ids[:, (condition_token_ids.shape[1] if exists(condition_token_ids) else 0):]
+                all_token_ids = torch.cat([all_token_ids, pred_token_ids], dim=1)
+
+            ind = end
+
+        return all_token_ids
+
     @eval_decorator
     @torch.no_grad()
     def generate_top_match(
@@ -1283,23 +2046,27 @@ class MusicLM(nn.Module):
 
         Returns a list of generated waves and a list of their topk cosine similarity scores.
         """
-        all_samples = []
-        all_similarities = []
-        for prompt in text:
-            text_input = [prompt for _ in range(num_samples)]
-            samples = self.forward(text=text_input, **kwargs)
+        # all samples of all prompts are generated, and embedded by clap, as one batch
+        text_input = [prompt for prompt in text for _ in range(num_samples)]
+        samples = self.forward(text=text_input, **kwargs)
+
+        text_latents = self.clap(text_input=text, return_embedding=True)
+        text_latents = repeat(text_latents, 'p d -> (p n) d', n=num_samples)
 
-            text_latents = self.clap(text_input=[prompt], return_embedding=True)
-            text_latents = repeat(text_latents, 'b d -> (repeat b) d', repeat=num_samples)
+        clap_input = resample(samples, self.neural_codec.sample_rate, self.clap.sample_rate)
+        clap_input = int16_to_float32(float32_to_int16(clap_input))
+        audio_latents = self.clap(audio_input=clap_input, return_embedding=True)
 
-            clap_input = resample(samples, self.neural_codec.sample_rate, self.clap.sample_rate)
-            clap_input = int16_to_float32(float32_to_int16(clap_input))
-            audio_latents = self.clap(audio_input=clap_input, return_embedding=True)
+        sim = F.cosine_similarity(text_latents, audio_latents, dim=-1)
+        sim = rearrange(sim, '(p n) -> p n', n=num_samples)
+        samples = rearrange(samples, '(p n) ... -> p n ...', n=num_samples)
 
-            sim = F.cosine_similarity(text_latents, audio_latents, dim=-1)
-            top_matches = sim.topk(num_top_matches, dim=0, sorted=True).indices
+        all_samples = []
+        all_similarities = []
+        for prompt_sim, prompt_samples in zip(sim, samples):
+            top_matches = prompt_sim.topk(num_top_matches, dim=0, sorted=True).indices
 
-            all_similarities.append(sim[top_matches].detach().cpu())
-            all_samples.append(samples[top_matches])
+            all_similarities.append(prompt_sim[top_matches].detach().cpu())
+            all_samples.append(prompt_samples[top_matches])
 
         return all_samples, all_similarities
@@ -0,0 +1,197 @@
+import queue
+import threading
+import time
+from dataclasses import dataclass
+
+import torch
+from beartype.typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+
+from .utils import exists
+
+
+@dataclass
+class PipelineStage:
+    name: str
+    fn: Callable[[Any], Any]
+    num_workers: int = 1    # items of this stage processed concurrently, keep 1 for stages that must see items in order
+    num_threads: Optional[int] = None    # intra-op threads of each worker, by default the count when the pipeline ran
+    max_queue_size: int = 2    # items waiting for this stage before the previous one blocks
+
+
+@dataclass
+class StageSpan:
+    stage: str
+    worker: int
+    item: int
+    start: float    # seconds since the pipeline started
+    end: float
+
+
+class StagePipeline:
+    """
+    Runs items through a chain of stages, each on its own worker threads, with bounded queues between them, so the
+    stages of consecutive items overlap: while the last stage of item k runs, the first stage can already run on
+    item k + 1. Outputs are yielded in the order of the inputs.
+
+    Grad mode and autocast are thread local, workers run without grad and stages enter autocast themselves.
+    The start and end of every (stage, item) are recorded, see timeline and utilization.
+
+    Every worker sets its intra-op thread count, the stage's num_threads or the count when run was called, since
+    torch.set_num_threads also changes the default that threads pick up and MKL's global count. Partitioning the cores
+    between stages relies on OpenMP keeping a thread count per calling thread (libgomp / Intel OpenMP do), other
+    threads of the process (e.g. continuous batching schedulers) can still end up with a stage's count.
+    """
+
+    def __init__(self, stages: List[PipelineStage]):
+        assert len(stages) > 0, 'a pipeline needs at least one stage'
+        assert len(set(stage.name for stage in stages)) == len(stages), 'stage names must be unique'
+
+        self.stages = stages
+        self.spans: List[StageSpan] = []
+        self.seconds = 0.
+        self.lock = threading.Lock()
+
+    def run(self, items: Iterable) -> Iterator:
+        """yields fn_n(...fn_1(item)) for every item, raises the first exception of a stage"""
+        self.spans = []
+        self.seconds = 0.
+        start = time.perf_counter()
+
+        default_num_threads = torch.get_num_threads()
+
+        end = object()
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=stage.max_queue_size) for stage in self.stages] + [queue.Queue()]
+
+        def put(q, item):
+            # give up once the pipeline is stopped, so no worker stays blocked on a full queue
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def feed():
+            try:
+                for ind, item in enumerate(items):
+                    if stop.is_set():
+                        return
+                    put(queues[0], (ind, item))
+            except Exception as e:
+                put(queues[-1], (None, e))
+            finally:
+                for _ in range(self.stages[0].num_workers):
+                    put(queues[0], end)
+
+        def work(stage_ind, worker):
+            stage = self.stages[stage_ind]
+            in_queue, out_queue = queues[stage_ind], queues[stage_ind + 1]
+
+            torch.set_num_threads(stage.num_threads if exists(stage.num_threads) else default_num_threads)
+
+            with torch.no_grad():
+                while not stop.is_set():
+                    try:
+                        job = in_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+
+                    if job is end:
+                        break
+
+                    ind, item = job
+                    span_start = time.perf_counter()
+
+                    try:
+                        output = stage.fn(item)
+                    except Exception as e:
+                        put(queues[-1], (None, e))
+                        break
+
+                    with self.lock:
+                        self.spans.append(StageSpan(stage.name, worker, ind, span_start - start, time.perf_counter() - start))
+
+                    put(out_queue, (ind, output))
+
+            # the last worker of a stage to finish ends the next one
+            with self.lock:
+                remaining[stage_ind] -= 1
+                is_last = remaining[stage_ind] == 0
+
+            if is_last:
+                num_next_workers = self.stages[stage_ind + 1].num_workers if stage_ind + 1 < len(self.stages) else 1
+                for _ in range(num_next_workers):
+                    put(out_queue, end)
+
+        remaining = [stage.num_workers for stage in self.stages]
+        threads = [threading.Thread(target=feed, daemon=True)]
+        for stage_ind, stage in enumerate(self.stages):
+            for worker in range(stage.num_workers):
+                threads.append(threading.Thread(target=work, args=(stage_ind, worker), daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        # stages with several workers finish items out of order
+        outputs: Dict[int, Any] = {}
+        next_ind = 0
+
+        try:
+            while True:
+                job = queues[-1].get()
+
+                if job is end:
+                    break
+
+                # errors are handed over without an item index
+                ind, output = job
+                if ind is None:
+                    raise output
+
+                outputs[ind] = output
+                while next_ind in outputs:
+                    yield outputs.pop(next_ind)
+                    next_ind += 1
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            self.seconds = time.perf_counter() - start
+
+            # the workers changed the process wide default
+            torch.set_num_threads(default_num_threads)
+
+    def timeline(self) -> List[StageSpan]:
+        """the (stage, worker, item, start, end) spans of the last run, by start"""
+        return sorted(self.spans, key=lambda span: span.start)
+
+    def utilization(self) -> Dict[str, float]:
+        """fraction of the last run each stage's workers spent processing items"""
+        busy = {stage.name: 0. for stage in self.stages}
+        for span in self.spans:
+            busy[span.stage] += span.end - span.start
+
+        return {
+            stage.name: busy[stage.name] / (self.seconds * stage.num_workers) if self.seconds > 0 else 0.
+            for stage in self.stages
+        }
+
+    def format_timeline(self, width=60) -> str:
+        """one row per stage, # where a worker was busy, scaled to width columns"""
+        lines = []
+        utilization = self.utilization()
+
+        for stage in self.stages:
+            row = [' '] * width
+            for span in self.spans:
+                if span.stage != stage.name or self.seconds <= 0:
+                    continue
+                first = int(span.start / self.seconds * width)
+                last = max(first + 1, int(span.end / self.seconds * width))
+                for col in range(first, min(last, width)):
+                    row[col] = '#'
+
+            lines.append(f"{stage.name:>14} |{''.join(row)}| {utilization[stage.name]:.0%}")
+
+        return '\n'.join(lines)
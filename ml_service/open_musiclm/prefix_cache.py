@@ -0,0 +1,120 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import torch
+from beartype.typing import Any, List, Optional, Tuple
+
+from .transformer import KVCache
+from .utils import exists
+
+
+def tensor_nbytes(t: torch.Tensor):
+    return t.numel() * t.element_size()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache of values of a known size in bytes, the least recently used ones are evicted to keep the
+    total within max_bytes. Values larger than max_bytes on their own are not cached.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+        self.nbytes = 0
+        self.evictions = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if not exists(entry):
+                return None
+
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: str, value: Any, nbytes: int):
+        if nbytes > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return
+
+            while self.nbytes + nbytes > self.max_bytes:
+                _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+                self.nbytes -= evicted_nbytes
+                self.evictions += 1
+
+            self.entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                evictions=self.evictions,
+                entries=len(self.entries),
+                bytes=self.nbytes,
+                max_bytes=self.max_bytes,
+            )
+
+
+class PrefixCache:
+    """
+    LRU cache of prefilled conditioning prefixes of a TokenConditionedTransformer, shared across requests.
+
+    Entries are keyed by a hash of the conditioning token ids and hold the logits for the first predicted token
+    along with the KVCache of the prefix. Use one cache per transformer, as the key doesn't identify the model.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 2 ** 20):
+        self.entries = LRUCache(max_bytes)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(token_ids: List[torch.Tensor]):
+        hasher = hashlib.sha1()
+        for t in token_ids:
+            hasher.update(str((tuple(t.shape), t.dtype)).encode())
+            hasher.update(t.detach().cpu().contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[torch.Tensor, KVCache]]:
+        entry = self.entries.get(key)
+
+        with self.lock:
+            if not exists(entry):
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        # logits get modified in place while sampling
+        logits, cache = entry
+        return logits.clone(), cache
+
+    def put(self, key: str, logits: torch.Tensor, cache: KVCache):
+        self.entries.put(key, (logits.clone(), cache), tensor_nbytes(logits) + cache.nbytes)
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            counts = dict(hits=self.hits, misses=self.misses)
+        return {**counts, **self.entries.stats()}
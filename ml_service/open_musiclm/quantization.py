@@ -0,0 +1,52 @@
+import torch
+from torch import nn
+
+from .open_musiclm import TokenConditionedTransformer
+
+
+class Int8WeightList(nn.Module):
+    """
+    Weight only int8 stand-in for a ParameterList of (..., c, d) weights, with a scale per row of d.
+    Indexing returns the dequantized fp32 weight, so the modules reading it stay the same.
+    """
+
+    def __init__(self, weights: nn.ParameterList):
+        super().__init__()
+        self.num_weights = len(weights)
+
+        for ind, weight in enumerate(weights):
+            weight = weight.detach().float()
+            scale = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / 127
+            self.register_buffer(f'weight_{ind}', torch.round(weight / scale).to(torch.int8))
+            self.register_buffer(f'scale_{ind}', scale)
+
+    def __len__(self):
+        return self.num_weights
+
+    def __getitem__(self, ind):
+        return getattr(self, f'weight_{ind}').float() * getattr(self, f'scale_{ind}')
+
+    def __iter__(self):
+        return (self[ind] for ind in range(self.num_weights))
+
+
+def quantize_dynamic_int8(transformer: TokenConditionedTransformer, quantize_logit_weights=False):
+    """
+    Int8 dynamic quantization of the attention (to_q, to_kv, to_out) and feedforward linear layers of a
+    TokenConditionedTransformer, for cpu inference: their weights are stored in int8 and the activations are
+    quantized on the fly. The logit weights stay in fp32, unless quantize_logit_weights, then they are stored in int8
+    (weight only). Embeddings, norms and the relative position bias are left as they are.
+
+    Quantizes the transformer in place and returns it. Load checkpoints before quantizing.
+    """
+    linear_names = {
+        name for name, module in transformer.named_modules()
+        if isinstance(module, nn.Linear) and name.startswith('transformer.layers.')
+    }
+
+    torch.ao.quantization.quantize_dynamic(transformer, qconfig_spec=linear_names, dtype=torch.qint8, inplace=True)
+
+    if quantize_logit_weights:
+        transformer.logit_weights = Int8WeightList(transformer.logit_weights)
+
+    return transformer
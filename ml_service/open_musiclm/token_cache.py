@@ -0,0 +1,274 @@
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unicodedata
+from pathlib import Path
+
+import numpy as np
+import torch
+from beartype.typing import Dict, List, Optional
+from einops import rearrange
+
+from .prefix_cache import LRUCache
+from .utils import exists
+
+
+class InputTokenCache:
+    """
+    Cache of the token ids computed from an input audio (e.g. its semantic and coarse acoustic tokens), keyed by a hash
+    of its decoded samples and a fingerprint of the models that tokenized it.
+
+    Entries are held in memory (LRU, up to max_memory_bytes) and, with a cache_dir, on disk as uint16 arrays (LRU by
+    last use, up to max_disk_bytes). The disk cache can be shared by several worker processes: files are written to a
+    temporary name and renamed into place, and writes and evictions hold an exclusive lock on the cache directory.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[Path] = None,
+        max_disk_bytes: int = 1024 * 2 ** 20,
+        max_memory_bytes: int = 64 * 2 ** 20
+    ):
+        self.cache_dir = Path(cache_dir) if exists(cache_dir) else None
+        self.max_disk_bytes = max_disk_bytes
+        self.max_memory_bytes = max_memory_bytes
+
+        self.entries = LRUCache(max_memory_bytes)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+        if exists(self.cache_dir):
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def key(samples: torch.Tensor, sample_hz: int, fingerprint: str):
+        hasher = hashlib.sha1()
+        hasher.update(f"{fingerprint}:{sample_hz}:{tuple(samples.shape)}".encode())
+        hasher.update(samples.detach().cpu().float().contiguous().numpy().tobytes())
+        return hasher.hexdigest()
+
+    def path(self, key: str):
+        return self.cache_dir / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[List[torch.Tensor]]:
+        token_ids = self.entries.get(key)
+        if exists(token_ids):
+            with self.lock:
+                self.hits += 1
+            return [t.clone() for t in token_ids]
+
+        token_ids = self.load(key)
+
+        with self.lock:
+            if not exists(token_ids):
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+
+        self.put_memory(key, token_ids)
+        return token_ids
+
+    def put(self, key: str, token_ids: List[torch.Tensor]):
+        token_ids = [t.detach().cpu() for t in token_ids]
+        self.put_memory(key, token_ids)
+
+        if exists(self.cache_dir):
+            self.save(key, token_ids)
+
+    def put_memory(self, key: str, token_ids: List[torch.Tensor]):
+        nbytes = sum(t.numel() * t.element_size() for t in token_ids)
+        self.entries.put(key, [t.clone() for t in token_ids], nbytes)
+
+    def load(self, key: str) -> Optional[List[torch.Tensor]]:
+        if not exists(self.cache_dir):
+            return None
+
+        path = self.path(key)
+        try:
+            with np.load(path) as arrays:
+                token_ids = [torch.from_numpy(arrays[f"token_ids_{ind}"].astype(np.int64)) for ind in range(len(arrays.files))]
+            # the modification time orders the files for eviction
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            # missing, or evicted / replaced by another process meanwhile
+            return None
+
+        return token_ids
+
+    def save(self, key: str, token_ids: List[torch.Tensor]):
+        assert all(t.numel() == 0 or (t.min() >= 0 and t.max() < 2 ** 16) for t in token_ids), 'token ids are stored as uint16'
+        arrays = {f"token_ids_{ind}": t.numpy().astype(np.uint16) for ind, t in enumerate(token_ids)}
+
+        with self.directory_lock():
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.path(key))
+
+            self.evict_disk()
+
+    def evict_disk(self):
+        """remove the least recently used files until the cache directory fits max_disk_bytes, holding the lock"""
+        files = []
+        for path in self.cache_dir.glob("*.npz"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total_bytes = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total_bytes <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total_bytes -= size
+            with self.lock:
+                self.disk_evictions += 1
+
+    def directory_lock(self):
+        return DirectoryLock(self.cache_dir / ".lock")
+
+    def clear(self):
+        self.entries.clear()
+
+    def stats(self):
+        """evictions are from memory, disk_evictions are the files removed from the cache directory"""
+        with self.lock:
+            counts = dict(
+                hits=self.hits,
+                disk_hits=self.disk_hits,
+                misses=self.misses,
+                disk_evictions=self.disk_evictions,
+            )
+        return {
+            **counts,
+            **self.entries.stats(),
+            "max_disk_bytes": self.max_disk_bytes if exists(self.cache_dir) else 0,
+        }
+
+
+def file_sha1(path: Path, chunk_size=2 ** 20):
+    hasher = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class PromptTokenCache:
+    """
+    Persistent map of text prompts to their clap token ids, so warm prompts need neither the CLAP text tower nor the
+    CLAP model to be loaded. Prompts are compared after unicode (NFC) and whitespace normalization, and entries are
+    kept per fingerprint of the CLAP model and its RVQ checkpoint.
+
+    The tables are json files {fingerprint: {prompt: token ids}}: a read only shipped table of common prompts
+    (see precompute_prompt_tokens.py) and the cache file, which new prompts are added to. The cache file can be shared
+    by several worker processes, it is rewritten under an exclusive lock and renamed into place, and reread on a miss.
+    """
+
+    def __init__(self, fingerprint: str, path: Optional[Path] = None, shipped_path: Optional[Path] = None):
+        self.fingerprint = fingerprint
+        self.path = Path(path) if exists(path) else None
+        self.entries: Dict[str, List[int]] = {}
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+        if exists(shipped_path) and Path(shipped_path).exists():
+            self.entries.update(self.read(Path(shipped_path)))
+
+        if exists(self.path):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.entries.update(self.read(self.path))
+
+    @staticmethod
+    def normalize(prompt: str):
+        return ' '.join(unicodedata.normalize('NFC', prompt).split())
+
+    def read(self, path: Path) -> Dict[str, List[int]]:
+        """the entries of this fingerprint in a table, empty if it is missing or unreadable"""
+        try:
+            with open(path) as f:
+                return json.load(f).get(self.fingerprint, {})
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, prompt: str) -> Optional[torch.Tensor]:
+        """clap token ids (1, n, 1) of the prompt, None if it isn't cached"""
+        prompt = self.normalize(prompt)
+
+        with self.lock:
+            token_ids = self.entries.get(prompt)
+
+        # another process may have added it
+        if not exists(token_ids) and exists(self.path):
+            entries = self.read(self.path)
+            with self.lock:
+                self.entries.update(entries)
+                token_ids = self.entries.get(prompt)
+
+        with self.lock:
+            if not exists(token_ids):
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        return rearrange(torch.tensor(token_ids, dtype=torch.long), 'n -> 1 n 1')
+
+    def put(self, prompt: str, clap_token_ids: torch.Tensor):
+        """clap_token_ids (1, n, 1) of the prompt"""
+        prompt = self.normalize(prompt)
+        token_ids = clap_token_ids.flatten().tolist()
+
+        with self.lock:
+            self.entries[prompt] = token_ids
+
+        if exists(self.path):
+            self.write(self.path, {prompt: token_ids})
+
+    def write(self, path: Path, entries: Dict[str, List[int]]):
+        """add entries of this fingerprint to a table, keeping the entries other processes and fingerprints wrote"""
+        with DirectoryLock(path.with_suffix(".lock")):
+            try:
+                with open(path) as f:
+                    tables = json.load(f)
+            except (OSError, ValueError):
+                tables = {}
+
+            tables.setdefault(self.fingerprint, {}).update(entries)
+
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(tables, f)
+            os.replace(tmp_path, path)
+
+    def stats(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self.entries))
+
+
+class DirectoryLock:
+    """exclusive advisory lock (flock) on a lock file, across processes and threads"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a")
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
@@ -31,7 +31,8 @@ from .hf_hubert_kmeans import HfHubertWithKmeans, learn_kmeans
 from .model_types import NeuralCodec, Wav2Vec
 from .open_musiclm import (CoarseStage, FineStage, SemanticStage,SemcoarsetosemStage,
                            InstcoarseStage,
-                           TokenConditionedTransformer)
+                           TokenConditionedTransformer,
+                           TokenConditionedTransformerWrapper)
 from .optimizer import get_linear_scheduler, get_optimizer
 from .utils import (all_rows_have_eos_id, append_eos_id,
                     batch_unique_consecutive, beartype_jit, ceil_div,
@@ -122,6 +123,17 @@ def determine_types(data, config):
 def noop(*args, **kwargs):
     pass
 
+def init_draft_from_teacher(draft: TokenConditionedTransformer, teacher: TokenConditionedTransformer):
+    """
+    Start a draft transformer for speculative decoding from the weights of the transformer it is distilled from:
+    the embeddings, start tokens, logit weights and first layers, wherever the shapes match.
+    Returns the number of tensors copied.
+    """
+    draft_state_dict = draft.state_dict()
+    state_dict = {k: v for k, v in teacher.state_dict().items() if k in draft_state_dict and draft_state_dict[k].shape == v.shape}
+    draft.load_state_dict(state_dict, strict=False)
+    return len(state_dict)
+
 
 @beartype_jit
 class SingleStageTrainer(nn.Module):
@@ -168,6 +180,9 @@ class SingleStageTrainer(nn.Module):
         config_paths: Optional[List[str]] = None,
         split_batches=False,
         wandb_name=None,
+        teacher_transformer: Optional[TokenConditionedTransformer] = None,
+        distill_temperature=1.,
+        distill_loss_weight=1.,
     ):
         super().__init__()
         kwargs_handler = DistributedDataParallelKwargs(find_unused_parameters=True)
@@ -255,6 +270,22 @@ class SingleStageTrainer(nn.Module):
         self.batch_size = batch_size
         self.grad_accum_every = grad_accum_every
 
+        # distillation, e.g. of a shallow draft transformer for speculative decoding from a trained checkpoint.
+        # the loss is mixed with the kl divergence to the teacher's predictions of the final sequence
+
+        self.teacher_wrapper = None
+        if exists(teacher_transformer):
+            teacher_transformer.requires_grad_(False)
+            self.teacher_wrapper = TokenConditionedTransformerWrapper(
+                transformer=teacher_transformer,
+                pad_id=self.train_wrapper.transformer_wrapper.pad_id,
+                unique_consecutive=self.train_wrapper.transformer_wrapper.unique_consecutive,
+                mask_prob=0.
+            ).to(self.accelerator.device).eval()
+
+        self.distill_temperature = distill_temperature
+        self.distill_loss_weight = distill_loss_weight
+
         # optimizers
 
         self.optim = get_optimizer(transformer.parameters(), lr=lr, wd=wd)
@@ -459,6 +490,35 @@ class SingleStageTrainer(nn.Module):
     def is_local_main(self):
         return self.accelerator.is_local_main_process
 
+    def distill_loss(self, logits, labels):
+        """
+        kl divergence from the teacher's (temperature softened) predictions of the final sequence to the student's
+        logits (b, c, n), given all labels returned by the train wrapper
+        """
+        pad_id = self.teacher_wrapper.pad_id
+
+        with torch.no_grad():
+            # labels come with eos, which isn't fed to the student for the final sequence
+            all_token_ids = [ids.clone() for ids in labels[:-1]] + [labels[-1][:, :-1].clone()]
+            teacher_logits = self.teacher_wrapper(
+                all_token_ids=all_token_ids,
+                input_has_eos=True,
+                return_only_final_seq_logits=True
+            )[-1]
+
+        teacher_logits = rearrange(teacher_logits, 'b n c -> b c n')
+
+        temperature = self.distill_temperature
+        kl = F.kl_div(
+            F.log_softmax(logits / temperature, dim=1),
+            F.log_softmax(teacher_logits / temperature, dim=1),
+            log_target=True,
+            reduction='none'
+        ).sum(dim=1)
+
+        mask = labels[-1] != pad_id
+        return kl[mask].mean() * temperature ** 2
+
     def train_step(self):
         device = self.device
 
@@ -481,7 +541,12 @@ class SingleStageTrainer(nn.Module):
 
                 non_empty_batch = True
 
-                loss, _, _ = self.train_wrapper(**data_kwargs, return_loss=True)
+                loss, all_logits, all_labels = self.train_wrapper(**data_kwargs, return_loss=True)
+
+                if exists(self.teacher_wrapper):
+                    distill_loss = self.distill_loss(all_logits[-1], all_labels)
+                    accum_log(logs, {'distill_loss': distill_loss.item() / self.grad_accum_every})
+                    loss = (1 - self.distill_loss_weight) * loss + self.distill_loss_weight * distill_loss
 
                 self.accelerator.backward(loss / self.grad_accum_every)
 
@@ -1,9 +1,12 @@
 # Transformer implementation from https://github.com/lucidrains/audiolm-pytorch/blob/main/audiolm_pytorch/audiolm_pytorch.py
 
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from functools import partial
 
 import torch
 import torch.nn.functional as F
+from beartype.typing import Callable, List, Optional, Tuple
 from einops import rearrange, repeat
 from torch import einsum, nn
 import math
@@ -17,6 +20,89 @@ try:
 except ImportError:
     is_xformers_available = False
 
+# cache for incremental decoding
+
+
+@dataclass
+class LayerKVCache:
+    """
+    Keys / values of a causal self attention layer (after l2norm + scaling, without null kv) and
+    the trailing inputs of the causal depthwise conv in the following feedforward
+    """
+    k: torch.Tensor    # (b, n, d)
+    v: torch.Tensor    # (b, n, d)
+    conv: Optional[torch.Tensor] = None    # (b, 2, c)
+
+
+@dataclass
+class KVCache:
+    """
+    Per-layer cache of a Transformer, covering the first `seq_len` positions of the sequence
+    """
+    layers: List[LayerKVCache]
+
+    @property
+    def seq_len(self):
+        return self.layers[0].k.shape[-2] if len(self.layers) > 0 else 0
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for layer in self.layers for t in (layer.k, layer.v, layer.conv) if exists(t))
+
+    def map(self, fn: Callable[[torch.Tensor], torch.Tensor]):
+        """apply fn to every cached tensor, e.g. to select or repeat batch rows"""
+        return KVCache([
+            LayerKVCache(*(fn(t) if exists(t) else None for t in (layer.k, layer.v, layer.conv)))
+            for layer in self.layers
+        ])
+
+    def map_kv(self, fn: Callable[[torch.Tensor], torch.Tensor]):
+        """apply fn to the cached keys / values only, e.g. to pad or slice the sequence"""
+        return KVCache([LayerKVCache(fn(layer.k), fn(layer.v), layer.conv) for layer in self.layers])
+
+    def left_pad(self, seq_len: int):
+        """left pad the keys / values to seq_len positions, the padding must be masked out when attending"""
+        pad = seq_len - self.seq_len
+        assert pad >= 0
+        return self.map_kv(lambda t: F.pad(t, (0, 0, pad, 0))) if pad > 0 else self
+
+    @staticmethod
+    def cat(caches: List['KVCache']):
+        """concat caches of the same length along the batch"""
+        return KVCache([
+            LayerKVCache(*(torch.cat(ts, dim=0) if exists(ts[0]) else None for ts in zip(*((layer.k, layer.v, layer.conv) for layer in layers))))
+            for layers in zip(*(cache.layers for cache in caches))
+        ])
+
+
+@dataclass
+class StaticKVCache:
+    """
+    Preallocated keys / values (and conv states) of all layers for a fixed number of positions, which
+    Transformer.decode_static writes into in place. Every decoding step then runs with the same shapes.
+    """
+    k: torch.Tensor    # (l, b, max_len, d)
+    v: torch.Tensor    # (l, b, max_len, d)
+    conv: Optional[torch.Tensor] = None    # (l, b, 2, c)
+
+    @property
+    def max_len(self):
+        return self.k.shape[-2]
+
+    @classmethod
+    def from_cache(cls, cache: KVCache, max_len: int):
+        """copy a KVCache into buffers of max_len positions"""
+        pad = max_len - cache.seq_len
+        assert pad >= 0, f'cache of {cache.seq_len} positions does not fit in {max_len}'
+
+        k = torch.stack([F.pad(layer.k, (0, 0, 0, pad)) for layer in cache.layers])
+        v = torch.stack([F.pad(layer.v, (0, 0, 0, pad)) for layer in cache.layers])
+        conv = torch.stack([layer.conv for layer in cache.layers]) if exists(cache.layers[0].conv) else None
+        return cls(k, v, conv)
+
+    def select_rows(self, rows: torch.Tensor):
+        return StaticKVCache(*(t[:, rows] if exists(t) else None for t in (self.k, self.v, self.conv)))
+
 # bias-less layernorm, being used in more recent T5s, PaLM, also in @borisdayma 's experiments shared with me
 # greater stability
 
@@ -33,7 +119,82 @@ class LayerNorm(nn.Module):
 # relative positional bias
 
 
-class RelativePositionBias(nn.Module):
+class DistanceBias(nn.Module, ABC):
+    """
+    Base for relative position biases that only depend on the distance i - j between query and key. Subclasses
+    implement compute_table.
+
+    The bias per distance is computed as a table and gathered into the (h, i, j) bias. Outside of training (and with
+    grad disabled), the table is kept and reused for all lengths up to the one it was computed for, growing in powers of 2.
+    It is invalidated when switching to training mode, loading a state dict or moving the module.
+    """
+
+    def __init__(self, min_cached_len=1024):
+        super().__init__()
+        self.min_cached_len = min_cached_len
+        self.cached_table = None
+
+    @abstractmethod
+    def compute_table(self, n, device):
+        """bias for the distances -(n - 1) .. (n - 1), (2n - 1, h)"""
+
+    def clear_cache(self):
+        self.cached_table = None
+
+    def get_table(self, n, device):
+        if self.training or torch.is_grad_enabled():
+            return self.compute_table(n, device)
+
+        if not exists(self.cached_table) or self.cached_table.shape[0] < 2 * n - 1 or self.cached_table.device != device:
+            cached_len = 2 ** math.ceil(math.log2(max(n, self.min_cached_len)))
+            self.cached_table = self.compute_table(cached_len, device)
+
+        return self.cached_table
+
+    def train(self, mode=True):
+        if mode:
+            self.clear_cache()
+        return super().train(mode)
+
+    def _apply(self, *args, **kwargs):
+        self.clear_cache()
+        return super()._apply(*args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self.clear_cache()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def forward_static(self, position, n, device=torch.device('cpu')):
+        """
+        bias (h, 1, n) of the query at position, a (1,) tensor, attending to the n positions of a static kv cache
+        """
+        table = self.get_table(n, device)
+        table_len = (table.shape[0] + 1) // 2
+
+        rel_pos = position - torch.arange(n, device=device) + (table_len - 1)
+
+        bias = table[rel_pos]
+        return rearrange(bias, 'j h -> h 1 j')
+
+    def forward(self, n, device=torch.device('cpu'), num_queries=None):
+        """
+        bias of the last num_queries positions (default: all n) attending to all n positions
+        """
+        num_queries = default(num_queries, n)
+
+        table = self.get_table(n, device)
+        table_len = (table.shape[0] + 1) // 2
+
+        q_pos = torch.arange(n - num_queries, n, device=device)
+        k_pos = torch.arange(n, device=device)
+        rel_pos = (rearrange(q_pos, 'i -> i 1') - rearrange(k_pos, 'j -> 1 j'))
+        rel_pos += (table_len - 1)
+
+        bias = table[rel_pos]
+        return rearrange(bias, 'i j h -> h i j')
+
+
+class RelativePositionBias(DistanceBias):
     """ from https://arxiv.org/abs/2111.09883 """
 
     def __init__(
@@ -52,21 +213,16 @@ class RelativePositionBias(nn.Module):
 
         self.net.append(nn.Linear(dim, heads))
 
-    def forward(self, n, device=torch.device('cpu')):
-        pos = torch.arange(n, device=device)
-        rel_pos = (rearrange(pos, 'i -> i 1') - rearrange(pos, 'j -> 1 j'))
-        rel_pos += (n - 1)
-
+    def compute_table(self, n, device):
         x = torch.arange(-n + 1, n, device=device).float()
         x = rearrange(x, '... -> ... 1')
 
         for layer in self.net:
             x = layer(x)
 
-        x = x[rel_pos]
-        return rearrange(x, 'i j h -> h i j')
+        return x
 
-class T5RelativePositionBias(nn.Module):
+class T5RelativePositionBias(DistanceBias):
     def __init__(
         self,
         *,
@@ -104,17 +260,10 @@ class T5RelativePositionBias(nn.Module):
         ret += torch.where(is_small, n, val_if_large)
         return ret
 
-    def forward(
-        self,
-        n,
-        device=torch.device('cpu')
-    ):
-        pos = torch.arange(n, device=device)
-        rel_pos = (rearrange(pos, 'i -> i 1') - rearrange(pos, 'j -> 1 j'))
+    def compute_table(self, n, device):
+        rel_pos = torch.arange(-n + 1, n, device=device)
         rel_pos = self._relative_position_bucket(rel_pos, causal=self.causal, num_buckets=self.num_buckets, max_distance=self.max_distance)
-
-        bias = self.relative_attention_bias(rel_pos)
-        return rearrange(bias, 'i j h -> h i j')
+        return self.relative_attention_bias(rel_pos)
 
 # feedforward
 
@@ -124,11 +273,25 @@ class CausalDSConv(nn.Module):
         super().__init__()
         self.ds_conv = nn.Conv1d(dim, dim, 3, bias=False, groups=dim)
 
-    def forward(self, x):
+    def forward(self, x, conv_cache=None, return_conv_cache=False):
+        """
+        conv_cache: the last 2 inputs preceding x, (b, 2, c). Zero padding is used if not given
+        """
+        if exists(conv_cache):
+            x = torch.cat((conv_cache, x), dim=-2)
+        else:
+            x = F.pad(x, (0, 0, 2, 0))
+
+        new_conv_cache = x[:, -2:] if return_conv_cache else None
+
         x = rearrange(x, 'b n c -> b c n')
-        x = F.pad(x, (2, 0))
         x = self.ds_conv(x)
-        return rearrange(x, 'b c n -> b n c')
+        x = rearrange(x, 'b c n -> b n c')
+
+        if return_conv_cache:
+            return x, new_conv_cache
+
+        return x
 
 
 class GEGLU(nn.Module):
@@ -137,9 +300,29 @@ class GEGLU(nn.Module):
         return F.gelu(gate) * x
 
 
+class FeedForwardSequential(nn.Sequential):
+    """nn.Sequential that threads a cache through its causal depthwise conv, if it has one"""
+
+    def forward(self, x, conv_cache=None, return_conv_cache=False):
+        new_conv_cache = None
+
+        for layer in self:
+            if isinstance(layer, CausalDSConv):
+                x = layer(x, conv_cache=conv_cache, return_conv_cache=return_conv_cache)
+                if return_conv_cache:
+                    x, new_conv_cache = x
+            else:
+                x = layer(x)
+
+        if return_conv_cache:
+            return x, new_conv_cache
+
+        return x
+
+
 def ConvFeedForward(dim, mult=4, dropout=0.1):
     inner_dim = int(dim * 2 * mult / 3)
-    return nn.Sequential(
+    return FeedForwardSequential(
         LayerNorm(dim),
         nn.Linear(dim, inner_dim * 2, bias=False),
         CausalDSConv(inner_dim * 2),
@@ -151,7 +334,7 @@ def ConvFeedForward(dim, mult=4, dropout=0.1):
 
 def FeedForward(dim, mult=4, dropout=0.1):
     inner_dim = int(dim * mult)
-    return nn.Sequential(
+    return FeedForwardSequential(
         LayerNorm(dim),
         nn.Linear(dim, inner_dim * 2, bias=False),
         GEGLU(),
@@ -176,7 +359,8 @@ class Attention(nn.Module):
         num_null_kv=0,
         dropout=0.1,
         scale=8,
-        use_memory_efficient_attention=False
+        use_memory_efficient_attention=False,
+        use_sdpa_attention=False
     ):
         super().__init__()
         self.heads = heads
@@ -188,6 +372,9 @@ class Attention(nn.Module):
         if self.use_memory_efficient_attention and not is_xformers_available:
             raise ImportError("Please install xformers to use memory efficient attention")
 
+        assert not (use_memory_efficient_attention and use_sdpa_attention), 'choose one of memory efficient (xformers) or sdpa attention'
+        self.use_sdpa_attention = use_sdpa_attention
+
         inner_dim = dim_head * heads
 
         dim_context = default(dim_context, dim)
@@ -211,6 +398,51 @@ class Attention(nn.Module):
             nn.Dropout(dropout)
         )
 
+    def get_causal_mask(self, i, j, cache_len, device):
+        """(i, j) bool mask, True where the query may not attend to the key"""
+        causal_mask = torch.ones((i, j), dtype=torch.bool, device=device).triu(j - i + 1)
+
+        if self.non_causal_prefix > 0:
+            causal_mask[:max(self.non_causal_prefix - cache_len, 0), :(self.non_causal_prefix + j - i - cache_len)] = False
+
+        return causal_mask
+
+    def sdpa_attend(self, q, k, v, mask=None, attn_bias=None, causal_mask=None):
+        """
+        multi-query attention of q (b, h, i, d) to the shared k / v (b, j, d) with F.scaled_dot_product_attention.
+        The heads are folded into the query length, so k / v are never repeated across heads, and the relative position
+        bias, padding mask and causal mask are combined into one additive mask.
+        """
+        b, h, i, _ = q.shape
+        j = k.shape[-2]
+
+        if exists(attn_bias):
+            bias = attn_bias.to(q.dtype)
+            if bias.ndim == 3:
+                bias = rearrange(bias, 'h i j -> 1 h i j')
+        else:
+            bias = torch.zeros((1, 1, i, j), device=q.device, dtype=q.dtype)
+
+        if exists(mask):
+            bias = bias.masked_fill(~rearrange(mask, 'b j -> b 1 1 j'), -torch.finfo(bias.dtype).max)
+
+        if exists(causal_mask):
+            bias = bias.masked_fill(causal_mask, -torch.finfo(bias.dtype).max)
+
+        bias = rearrange(bias.expand(-1, h, -1, -1), 'b h i j -> b 1 (h i) j')
+
+        q = rearrange(q, 'b h i d -> b 1 (h i) d')
+        k, v = map(lambda t: rearrange(t.to(q.dtype), 'b j d -> b 1 j d'), (k, v))
+
+        out = F.scaled_dot_product_attention(
+            q, k, v,
+            attn_mask=bias,
+            dropout_p=self.dropout if self.training else 0.,
+            scale=self.scale
+        )
+
+        return rearrange(out, 'b 1 (h i) d -> b i (h d)', h=h)
+
     def forward(
         self,
         x,
@@ -218,9 +450,21 @@ class Attention(nn.Module):
         mask=None,
         attn_bias=None,
         prefix_context=None,
-        prefix_context_mask=None
+        prefix_context_mask=None,
+        kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        return_cached_kv=False,
+        causal=None
     ):
+        """
+        kv_cache: keys and values of the preceding positions, as returned with return_cached_kv=True.
+                  x is then treated as the continuation of the cached sequence, and mask / attn_bias must cover
+                  the cached + new keys.
+        causal: overrides self.causal, False when the causal mask is already part of attn_bias
+        """
         b, n, _, device = *x.shape, x.device
+        causal = default(causal, self.causal)
+
+        assert not (exists(kv_cache) or return_cached_kv) or not (exists(context) or exists(prefix_context)), 'kv caching is only supported for self attention'
 
         if exists(context):
             context = self.context_norm(context)
@@ -253,13 +497,6 @@ class Attention(nn.Module):
 
         q, k, v = self.to_q(x), *self.to_kv(kv_input).chunk(2, dim=-1)
 
-        # null key / values
-
-        if self.num_null_kv > 0:
-            null_k, null_v = repeat(self.null_kv, 'kv n d -> kv b n d', b=b).unbind(dim=0)
-            k = torch.cat((null_k, k), dim=-2)
-            v = torch.cat((null_v, v), dim=-2)
-
         # split for multi-headed attention
 
         q = rearrange(q, 'b n (h d) -> b h n d', h=self.heads)
@@ -270,6 +507,25 @@ class Attention(nn.Module):
         q = q * self.q_scale
         k = k * self.k_scale
 
+        # concat with cached keys / values from previous positions
+
+        cache_len = 0
+        if exists(kv_cache):
+            cached_k, cached_v = kv_cache
+            cache_len = cached_k.shape[-2]
+            k = torch.cat((cached_k, k), dim=-2)
+            v = torch.cat((cached_v, v), dim=-2)
+
+        new_kv_cache = (k, v) if return_cached_kv else None
+
+        # null key / values
+
+        if self.num_null_kv > 0:
+            null_k, null_v = repeat(self.null_kv, 'kv n d -> kv b n d', b=b).unbind(dim=0)
+            null_k = l2norm(null_k) * self.k_scale
+            k = torch.cat((null_k, k), dim=-2)
+            v = torch.cat((null_v, v), dim=-2)
+
         # attention
 
         if self.use_memory_efficient_attention:
@@ -281,13 +537,8 @@ class Attention(nn.Module):
                     mask = rearrange(mask, 'b j -> b 1 1 j')
                     attn_bias = attn_bias.masked_fill(~mask, -torch.finfo(attn_bias.dtype).max)
 
-                if self.causal:
-                    i, j = attn_bias.shape[-2:]
-                    causal_mask = torch.ones((i, j), dtype=torch.bool, device=x.device).triu(j - i + 1)
-
-                    if self.non_causal_prefix > 0:
-                        causal_mask[:self.non_causal_prefix, :(self.non_causal_prefix + j - i)] = False
-
+                if causal:
+                    causal_mask = self.get_causal_mask(*attn_bias.shape[-2:], cache_len, device)
                     attn_bias = attn_bias.masked_fill(causal_mask, -torch.finfo(attn_bias.dtype).max)
 
             q = rearrange(q, 'b h n d -> b n h d')
@@ -300,6 +551,17 @@ class Attention(nn.Module):
             # merge heads
             out = rearrange(out, 'b n h d -> b n (h d)')
 
+        elif self.use_sdpa_attention:
+            if exists(attn_bias):
+                attn_bias = F.pad(attn_bias, (self.num_null_kv, 0), value=0.)
+
+            if exists(mask):
+                mask = F.pad(mask, (self.num_null_kv, 0), value=True)
+
+            causal_mask = self.get_causal_mask(q.shape[-2], k.shape[-2], cache_len, device) if causal else None
+
+            out = self.sdpa_attend(q, k, v, mask=mask, attn_bias=attn_bias, causal_mask=causal_mask)
+
         else:
             sim = einsum('b h i d, b j d -> b h i j', q, k) * self.scale
 
@@ -312,16 +574,11 @@ class Attention(nn.Module):
                 mask = rearrange(mask, 'b j -> b 1 1 j')
                 sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
 
-            if self.causal:
-                i, j = sim.shape[-2:]
-                causal_mask = torch.ones((i, j), dtype=torch.bool, device=x.device).triu(j - i + 1)
-
-                if self.non_causal_prefix > 0:
-                    causal_mask[:self.non_causal_prefix, :(self.non_causal_prefix + j - i)] = False
-
+            if causal:
+                causal_mask = self.get_causal_mask(*sim.shape[-2:], cache_len, device)
                 sim = sim.masked_fill(causal_mask, -torch.finfo(sim.dtype).max)
 
-            attn = sim.softmax(dim=-1)
+            attn = sim.float().softmax(dim=-1)
             attn = self.attn_dropout(attn)
 
             # aggregate
@@ -330,6 +587,66 @@ class Attention(nn.Module):
             # merge heads
             out = rearrange(out, 'b h n d -> b n (h d)')
 
+        out = self.to_out(out)
+
+        if return_cached_kv:
+            return out, new_kv_cache
+
+        return out
+
+    def decode_static(self, x, *, k_cache, v_cache, position, mask=None, attn_bias=None):
+        """
+        causal self attention of a single position against preallocated keys / values (b, max_len, d), written in
+        place at position, a (1,) tensor. mask (b, max_len) must be False for the positions after it, or be part
+        of attn_bias already.
+        """
+        b = x.shape[0]
+
+        # keys / values are projected from the input before the norm, as in forward
+        kv_input = x
+        x = self.norm(x)
+
+        q, k, v = self.to_q(x), *self.to_kv(kv_input).chunk(2, dim=-1)
+
+        q = rearrange(q, 'b n (h d) -> b h n d', h=self.heads)
+
+        q, k = map(l2norm, (q, k))
+        q = q * self.q_scale
+        k = k * self.k_scale
+
+        k_cache.index_copy_(1, position, k)
+        v_cache.index_copy_(1, position, v)
+        k, v = k_cache, v_cache
+
+        if self.num_null_kv > 0:
+            null_k, null_v = repeat(self.null_kv, 'kv n d -> kv b n d', b=b).unbind(dim=0)
+            null_k = l2norm(null_k) * self.k_scale
+            k = torch.cat((null_k, k), dim=-2)
+            v = torch.cat((null_v, v), dim=-2)
+
+        if exists(attn_bias):
+            attn_bias = F.pad(attn_bias, (self.num_null_kv, 0), value=0.)
+
+        if exists(mask):
+            mask = F.pad(mask, (self.num_null_kv, 0), value=True)
+
+        if self.use_sdpa_attention:
+            return self.to_out(self.sdpa_attend(q, k, v, mask=mask, attn_bias=attn_bias))
+
+        sim = einsum('b h i d, b j d -> b h i j', q, k) * self.scale
+
+        if exists(attn_bias):
+            sim = sim + attn_bias
+
+        if exists(mask):
+            mask = rearrange(mask, 'b j -> b 1 1 j')
+            sim = sim.masked_fill(~mask, -torch.finfo(sim.dtype).max)
+
+        attn = sim.float().softmax(dim=-1)
+
+        out = einsum('b h i j, b j d -> b h i d', attn, v)
+        out = rearrange(out, 'b h n d -> b n (h d)')
+
         return self.to_out(out)
 
 # transformer
@@ -358,6 +675,10 @@ class Transformer(nn.Module):
         self.dim_context = default(dim_context, dim)
 
         self.cond_as_self_attn_prefix = cond_as_self_attn_prefix
+        self.non_causal_prefix_size = non_causal_prefix_size
+
+        self.min_cached_causal_mask_len = 1024
+        self.cached_causal_mask = None
 
         self.grad_shrink = partial(grad_shrink, alpha=grad_shrink_alpha)
 
@@ -382,6 +703,39 @@ class Transformer(nn.Module):
 
         self.norm = LayerNorm(dim)
 
+    def get_causal_mask(self, i, j, device):
+        """
+        (i, j) bool mask of the last i of j positions attending to all j, True where they may not. Sliced from a mask
+        over all positions that is kept and grown in powers of 2, like the relative position bias table.
+        """
+        if not exists(self.cached_causal_mask) or self.cached_causal_mask.shape[0] < j or self.cached_causal_mask.device != device:
+            n = 2 ** math.ceil(math.log2(max(j, self.min_cached_causal_mask_len)))
+            causal_mask = torch.ones((n, n), dtype=torch.bool, device=device).triu(1)
+            causal_mask[:self.non_causal_prefix_size, :self.non_causal_prefix_size] = False
+            self.cached_causal_mask = causal_mask
+
+        return self.cached_causal_mask[(j - i):j, :j]
+
+    def get_self_attn_bias(self, rel_pos_bias, self_attn_mask, i, j, dtype, device):
+        """
+        additive self attention bias (b or 1, h or 1, i, j) shared by all layers, the relative position bias with the
+        causal and padding masks filled in, so the masks are built once per forward instead of in every layer
+        """
+        if exists(rel_pos_bias):
+            bias = rel_pos_bias.to(dtype)
+            if bias.ndim == 3:
+                bias = rearrange(bias, 'h i j -> 1 h i j')
+        else:
+            bias = torch.zeros((1, 1, i, j), dtype=dtype, device=device)
+
+        mask_value = -torch.finfo(dtype).max
+        bias = bias.masked_fill(self.get_causal_mask(i, j, device), mask_value)
+
+        if exists(self_attn_mask):
+            bias = bias.masked_fill(~rearrange(self_attn_mask, 'b j -> b 1 1 j'), mask_value)
+
+        return bias
+
     def forward(
         self,
         x,
@@ -389,12 +743,36 @@ class Transformer(nn.Module):
         context=None,
         context_mask=None,
         attn_bias=None,
+        cache: Optional[KVCache] = None,
+        return_cache=False,
+        chunk_size: Optional[int] = None
     ):
+        """
+        cache: KVCache of the preceding positions. x is then only the continuation of the cached sequence,
+               and self_attn_mask / attn_bias must cover the cached + new positions.
+        return_cache: if True, also return the KVCache covering the cached + new positions
+        chunk_size: if set, x is run through the layers at most chunk_size positions at a time, attending to the
+                    cache of the previous chunks. This bounds the attention matrix to (chunk_size x n) for long prefixes.
+        """
         assert not (self.cond_as_self_attn_prefix and not exists(context))
         assert not (exists(
             context) and context.shape[-1] != self.dim_context), f'you had specified a conditioning dimension of {self.dim_context}, yet what was received by the transformer has dimension of {context.shape[-1]}'
+        assert not (self.cond_as_self_attn_prefix and (exists(cache) or return_cache)), 'kv caching is not supported with conditioning as self attention prefix'
 
         n, device = x.shape[1], x.device
+        cache_len = cache.seq_len if exists(cache) else 0
+
+        if exists(chunk_size) and n > chunk_size:
+            return self.forward_chunked(
+                x,
+                chunk_size=chunk_size,
+                self_attn_mask=self_attn_mask,
+                context=context,
+                context_mask=context_mask,
+                attn_bias=attn_bias,
+                cache=cache,
+                return_cache=return_cache
+            )
 
         # from cogview paper, adopted by GLM 130B LLM, decreases likelihood of attention net instability
         x = self.grad_shrink(x)
@@ -402,23 +780,132 @@ class Transformer(nn.Module):
         if exists(attn_bias):
             rel_pos_bias = attn_bias
         else:
-            rel_pos_bias = self.rel_pos_bias(n, device = device) if exists(self.rel_pos_bias) else None
+            rel_pos_bias = self.rel_pos_bias(cache_len + n, device = device, num_queries = n) if exists(self.rel_pos_bias) else None
 
-        self_attn_kwargs = dict()
         if self.cond_as_self_attn_prefix:
             self_attn_kwargs = dict(
+                mask=self_attn_mask,
+                attn_bias=rel_pos_bias,
                 prefix_context=context,
                 prefix_context_mask=context_mask
             )
+        else:
+            self_attn_bias = self.get_self_attn_bias(rel_pos_bias, self_attn_mask, n, cache_len + n, x.dtype, device)
+            self_attn_kwargs = dict(attn_bias=self_attn_bias, causal=False)
 
-        for attn, cross_attn, ff in self.layers:
-            x = attn(x, attn_bias=rel_pos_bias, mask=self_attn_mask, **self_attn_kwargs) + x
+        layer_caches = cache.layers if exists(cache) else [None] * len(self.layers)
+        new_layer_caches = []
+
+        for (attn, cross_attn, ff), layer_cache in zip(self.layers, layer_caches):
+            kv_cache = (layer_cache.k, layer_cache.v) if exists(layer_cache) else None
+            conv_cache = layer_cache.conv if exists(layer_cache) else None
+
+            attn_out = attn(x, kv_cache=kv_cache, return_cached_kv=return_cache, **self_attn_kwargs)
+            if return_cache:
+                attn_out, kv_cache = attn_out
+            x = attn_out + x
 
             if exists(cross_attn):
                 assert exists(context)
 
                 x = cross_attn(x, context=context, mask=context_mask) + x
 
-            x = ff(x) + x
+            ff_out = ff(x, conv_cache=conv_cache, return_conv_cache=return_cache)
+            if return_cache:
+                ff_out, conv_cache = ff_out
+                new_layer_caches.append(LayerKVCache(*kv_cache, conv=conv_cache))
+            x = ff_out + x
+
+        x = self.norm(x)
+
+        if return_cache:
+            return x, KVCache(new_layer_caches)
+
+        return x
+
+    def decode_static(
+        self,
+        x,
+        *,
+        cache: StaticKVCache,
+        position,
+        self_attn_mask=None
+    ):
+        """
+        run a single position x (b, 1, d) against a StaticKVCache, which is updated in place. Unlike forward, all
+        shapes are the same for every position, so this can be compiled once (see torch.compile) and reused.
+
+        position: (1,) tensor, position of x in the sequence. The cache must hold the preceding positions.
+        self_attn_mask: (b, max_len), if some of the cached positions of a row must not be attended to
+        """
+        assert not self.cond_as_self_attn_prefix, 'static decoding is not supported with conditioning as self attention prefix'
+
+        b, device, max_len = x.shape[0], x.device, cache.max_len
+
+        x = self.grad_shrink(x)
+
+        mask = repeat(torch.arange(max_len, device=device) <= position, 'j -> b j', b=b)
+        if exists(self_attn_mask):
+            mask = mask & self_attn_mask
+
+        rel_pos_bias = self.rel_pos_bias.forward_static(position, max_len, device=device) if exists(self.rel_pos_bias) else None
+
+        # the mask is filled into the bias once, for all layers
+        attn_bias = default(rel_pos_bias, torch.zeros((1, 1, max_len), device=device)).to(x.dtype)
+        attn_bias = attn_bias.masked_fill(~rearrange(mask, 'b j -> b 1 1 j'), -torch.finfo(x.dtype).max)
+
+        for ind, (attn, cross_attn, ff) in enumerate(self.layers):
+            assert not exists(cross_attn), 'static decoding is only supported for self attention'
+
+            x = attn.decode_static(x, k_cache=cache.k[ind], v_cache=cache.v[ind], position=position, attn_bias=attn_bias) + x
+
+            if exists(cache.conv):
+                ff_out, conv_cache = ff(x, conv_cache=cache.conv[ind], return_conv_cache=True)
+                cache.conv[ind].copy_(conv_cache)
+            else:
+                ff_out = ff(x)
+
+            x = ff_out + x
 
         return self.norm(x)
+
+    def forward_chunked(
+        self,
+        x,
+        *,
+        chunk_size,
+        self_attn_mask=None,
+        context=None,
+        context_mask=None,
+        attn_bias=None,
+        cache: Optional[KVCache] = None,
+        return_cache=False
+    ):
+        """run x through the transformer chunk_size positions at a time, carrying the KVCache between chunks"""
+        cache_len = cache.seq_len if exists(cache) else 0
+
+        outputs = []
+        for chunk_start in range(0, x.shape[1], chunk_size):
+            chunk_end = min(chunk_start + chunk_size, x.shape[1])
+            num_keys = cache_len + chunk_end
+
+            chunk_attn_bias = attn_bias[..., chunk_start:chunk_end, :num_keys] if exists(attn_bias) else None
+            chunk_self_attn_mask = self_attn_mask[:, :num_keys] if exists(self_attn_mask) else None
+
+            out, cache = self.forward(
+                x[:, chunk_start:chunk_end],
+                self_attn_mask=chunk_self_attn_mask,
+                context=context,
+                context_mask=context_mask,
+                attn_bias=chunk_attn_bias,
+                cache=cache,
+                return_cache=True
+            )
+            outputs.append(out)
+
+        x = torch.cat(outputs, dim=1)
+
+        if return_cache:
+            return x, cache
+
+        return x
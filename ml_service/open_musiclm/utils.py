@@ -66,7 +66,8 @@ def log(t, eps = 1e-20):
     return torch.log(t + eps)
 
 def l2norm(t):
-    return F.normalize(t, dim = -1)
+    # in fp32, also when autocasting to a lower precision
+    return F.normalize(t.float(), dim = -1).to(t.dtype)
 
 def gumbel_noise(t):
     noise = torch.zeros_like(t).uniform_(0, 1)
@@ -152,6 +153,7 @@ def float32_to_int16(x):
     return (x * 32767.).type(torch.int16)
 
 def zero_mean_unit_var_norm(x):
+    x = x.float()
     return (x - x.mean(dim=-1, keepdim=True)) / torch.sqrt(x.var(dim=-1, keepdim=True) + 1e-7)
 
 def prepare_audio(data, sample_hz, target_sample_hz, normalize=True, target_length_seconds=None):
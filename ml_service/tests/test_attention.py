@@ -0,0 +1,157 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from open_musiclm.transformer import Attention, StaticKVCache, Transformer
+
+DIM = 32
+HEADS = 4
+DIM_HEAD = 16
+
+
+def make_pair(module_cls, **kwargs):
+    """the same randomly initialized module with einsum and with scaled dot product attention, in eval mode"""
+    torch.manual_seed(0)
+    einsum_module = module_cls(**kwargs, use_sdpa_attention=False).eval()
+    sdpa_module = module_cls(**kwargs, use_sdpa_attention=True).eval()
+    sdpa_module.load_state_dict(einsum_module.state_dict())
+    return einsum_module, sdpa_module
+
+
+def padding_mask(batch, n, num_padded=2):
+    """(batch, n) mask with the last positions of the last row padded"""
+    mask = torch.ones((batch, n), dtype=torch.bool)
+    mask[-1, -num_padded:] = False
+    return mask
+
+
+def assert_close(einsum_out, sdpa_out):
+    assert torch.allclose(einsum_out, sdpa_out, atol=1e-5, rtol=1e-4), (einsum_out - sdpa_out).abs().max()
+
+
+@pytest.mark.parametrize('causal, non_causal_prefix', [(False, 0), (True, 0), (True, 3)])
+@torch.no_grad()
+def test_attention_forward(causal, non_causal_prefix):
+    einsum_attn, sdpa_attn = make_pair(Attention, dim=DIM, heads=HEADS, dim_head=DIM_HEAD, causal=causal, non_causal_prefix=non_causal_prefix)
+
+    x = torch.randn(2, 7, DIM)
+    mask = padding_mask(2, 7)
+    attn_bias = torch.randn(HEADS, 7, 7)
+
+    for kwargs in (dict(), dict(mask=mask), dict(attn_bias=attn_bias), dict(mask=mask, attn_bias=attn_bias)):
+        assert_close(einsum_attn(x, **kwargs), sdpa_attn(x, **kwargs))
+
+
+@pytest.mark.parametrize('non_causal_prefix', [0, 3])
+@torch.no_grad()
+def test_attention_forward_with_cache(non_causal_prefix):
+    einsum_attn, sdpa_attn = make_pair(Attention, dim=DIM, heads=HEADS, dim_head=DIM_HEAD, causal=True, non_causal_prefix=non_causal_prefix)
+
+    x = torch.randn(2, 7, DIM)
+    mask = padding_mask(2, 7)
+    attn_bias = torch.randn(HEADS, 7, 7)
+
+    # the non causal prefix fits in the first call
+    outputs = []
+    for attn in (einsum_attn, sdpa_attn):
+        out, kv_cache = attn(x[:, :4], mask=mask[:, :4], attn_bias=attn_bias[:, :4, :4], return_cached_kv=True)
+        next_out = attn(x[:, 4:], mask=mask, attn_bias=attn_bias[:, 4:], kv_cache=kv_cache)
+        outputs.append(torch.cat((out, next_out), dim=1))
+
+    assert_close(*outputs)
+
+    # and the cache doesn't change the output
+    assert_close(einsum_attn(x, mask=mask, attn_bias=attn_bias), outputs[0])
+
+
+@torch.no_grad()
+def test_attention_prefix_context():
+    einsum_attn, sdpa_attn = make_pair(Attention, dim=DIM, heads=HEADS, dim_head=DIM_HEAD, causal=True)
+
+    x = torch.randn(2, 7, DIM)
+    prefix_context = torch.randn(2, 5, DIM)
+    prefix_context_mask = padding_mask(2, 5)
+    attn_bias = torch.randn(HEADS, 7, 7)
+
+    kwargs = dict(prefix_context=prefix_context, prefix_context_mask=prefix_context_mask, mask=padding_mask(2, 7), attn_bias=attn_bias)
+    assert_close(einsum_attn(x, **kwargs), sdpa_attn(x, **kwargs))
+
+
+@torch.no_grad()
+def test_cross_attention_with_null_kv():
+    einsum_attn, sdpa_attn = make_pair(Attention, dim=DIM, heads=HEADS, dim_head=DIM_HEAD, dim_context=24, num_null_kv=1, norm_context=True)
+
+    x = torch.randn(2, 7, DIM)
+    context = torch.randn(2, 5, 24)
+    context_mask = padding_mask(2, 5, num_padded=5)    # only the null key / value is attended to
+
+    for kwargs in (dict(context=context), dict(context=context, mask=context_mask)):
+        assert_close(einsum_attn(x, **kwargs), sdpa_attn(x, **kwargs))
+
+
+@pytest.mark.parametrize('non_causal_prefix_size, relative_position_bias_type', [(0, 'continuous'), (3, 'continuous'), (0, 't5')])
+@torch.no_grad()
+def test_transformer_forward_with_cache(non_causal_prefix_size, relative_position_bias_type):
+    einsum_transformer, sdpa_transformer = make_pair(
+        Transformer, dim=DIM, depth=2, heads=HEADS, dim_head=DIM_HEAD,
+        non_causal_prefix_size=non_causal_prefix_size, relative_position_bias_type=relative_position_bias_type
+    )
+
+    x = torch.randn(2, 10, DIM)
+    mask = padding_mask(2, 10, num_padded=3)
+
+    assert_close(einsum_transformer(x, self_attn_mask=mask), sdpa_transformer(x, self_attn_mask=mask))
+
+    outputs = []
+    for transformer in (einsum_transformer, sdpa_transformer):
+        out, cache = transformer(x[:, :6], self_attn_mask=mask[:, :6], return_cache=True)
+        next_out = transformer(x[:, 6:], self_attn_mask=mask, cache=cache)
+        outputs.append(torch.cat((out, next_out), dim=1))
+
+    assert_close(*outputs)
+
+
+@torch.no_grad()
+def test_transformer_cross_attend():
+    einsum_transformer, sdpa_transformer = make_pair(
+        Transformer, dim=DIM, depth=2, heads=HEADS, dim_head=DIM_HEAD, dim_context=24, cross_attend=True
+    )
+
+    x = torch.randn(2, 10, DIM)
+    context = torch.randn(2, 5, 24)
+    context_mask = padding_mask(2, 5)
+
+    kwargs = dict(self_attn_mask=padding_mask(2, 10), context=context, context_mask=context_mask)
+    assert_close(einsum_transformer(x, **kwargs), sdpa_transformer(x, **kwargs))
+
+
+@torch.no_grad()
+def test_transformer_decode_static():
+    einsum_transformer, sdpa_transformer = make_pair(Transformer, dim=DIM, depth=2, heads=HEADS, dim_head=DIM_HEAD)
+
+    x = torch.randn(2, 10, DIM)
+    mask = padding_mask(2, 6)
+    full_mask = F.pad(mask, (0, 4), value=True)
+    max_len = 16
+
+    outputs = []
+    for transformer in (einsum_transformer, sdpa_transformer):
+        _, cache = transformer(x[:, :6], self_attn_mask=mask, return_cache=True)
+        static_cache = StaticKVCache.from_cache(cache, max_len)
+        self_attn_mask = F.pad(mask, (0, max_len - mask.shape[-1]), value=True)
+
+        decoded = []
+        for position in range(6, 10):
+            out = transformer.decode_static(x[:, position:(position + 1)], cache=static_cache, position=torch.tensor([position]), self_attn_mask=self_attn_mask)
+            decoded.append(out)
+        decoded = torch.cat(decoded, dim=1)
+
+        # matches decoding with the dynamic cache of the same backend, and writes the same keys / values
+        out, cache = transformer(x[:, 6:], self_attn_mask=full_mask, cache=cache, return_cache=True)
+        assert_close(out, decoded)
+        assert_close(torch.stack([layer.k for layer in cache.layers]), static_cache.k[:, :, :10])
+        assert_close(torch.stack([layer.v for layer in cache.layers]), static_cache.v[:, :, :10])
+
+        outputs.append(decoded)
+
+    assert_close(*outputs)
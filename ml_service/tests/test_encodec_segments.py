@@ -0,0 +1,84 @@
+import pytest
+import torch
+from einops import rearrange, repeat
+from encodec import EncodecModel
+
+from open_musiclm.encodec_wrapper import EncodecWrapper
+
+SEGMENT_FRAMES = 20
+
+
+@pytest.fixture(scope='module')
+def encodec():
+    """the 24kHz Encodec architecture with random weights and codebooks, nothing is downloaded"""
+    torch.manual_seed(0)
+    encodec = EncodecModel._get_model([1.5, 3., 6., 12., 24.], 24000, 1, causal=True, model_norm='weight_norm', name='test')
+    encodec.set_target_bandwidth(6.)
+
+    for layer in encodec.quantizer.vq.layers:
+        layer._codebook.embed.normal_()
+        layer._codebook.inited.fill_(1.)
+
+    return encodec.eval()
+
+
+class FrameLocalWrapper(EncodecWrapper):
+    """
+    Encodes and decodes every frame on its own, so stitching the segments must give the all at once result exactly.
+    Tests the segment and crossfade bookkeeping without the convolutions' context.
+    """
+
+    def encode(self, x, num_quantizers=None):
+        frames = torch.nn.functional.pad(x, (0, -x.shape[-1] % self.samples_per_frame))
+        frames = rearrange(frames, 'b 1 (t s) -> b t s', s=self.samples_per_frame)
+        codes = (frames.abs().sum(dim=-1) * 1000).long() % self.codebook_size
+        return repeat(codes, 'b t -> b t q', q=num_quantizers or self.num_quantizers)
+
+    def decode(self, quantized_indices):
+        return repeat(quantized_indices.float().sum(dim=-1), 'b t -> b 1 (t s)', s=self.samples_per_frame)
+
+
+def make_wrapper(encodec, wrapper_cls=EncodecWrapper, **kwargs):
+    return wrapper_cls(encodec=encodec, segment_frames=SEGMENT_FRAMES, segment_context_frames=10, segment_crossfade_frames=4, **kwargs)
+
+
+# a tail shorter than the crossfade, several whole segments, and a partial last frame
+NUM_FRAMES = [SEGMENT_FRAMES + 3, 3 * SEGMENT_FRAMES, 2 * SEGMENT_FRAMES + 11]
+
+
+@pytest.mark.parametrize('num_frames', NUM_FRAMES)
+def test_frame_local_segments_match_all_at_once(encodec, num_frames):
+    wrapper = make_wrapper(encodec, FrameLocalWrapper)
+
+    wav = torch.randn(2, 1, num_frames * wrapper.samples_per_frame - 100)
+    _, codes, _ = wrapper(wav)
+    assert torch.equal(codes, wrapper.encode(wav))
+
+    indices = torch.randint(0, wrapper.codebook_size, (2, num_frames, wrapper.num_quantizers))
+    assert torch.allclose(wrapper.decode_from_codebook_indices(indices), wrapper.decode(indices))
+
+
+@pytest.mark.parametrize('num_frames', NUM_FRAMES)
+@torch.no_grad()
+def test_segments_keep_the_length(encodec, num_frames):
+    wrapper = make_wrapper(encodec)
+
+    wav = torch.randn(1, 1, num_frames * wrapper.samples_per_frame)
+    _, codes, _ = wrapper(wav)
+    assert codes.shape == wrapper.encode(wav).shape
+
+    indices = torch.randint(0, wrapper.codebook_size, (1, num_frames, wrapper.num_quantizers))
+    assert wrapper.decode_from_codebook_indices(indices).shape == wrapper.decode(indices).shape
+
+
+@torch.no_grad()
+def test_segment_workers(encodec):
+    wrapper = make_wrapper(encodec)
+    parallel_wrapper = make_wrapper(encodec, segment_workers=3)
+
+    num_frames = 3 * SEGMENT_FRAMES + 3
+    wav = torch.randn(1, 1, num_frames * wrapper.samples_per_frame)
+    assert torch.equal(wrapper(wav)[1], parallel_wrapper(wav)[1])
+
+    indices = torch.randint(0, wrapper.codebook_size, (1, num_frames, wrapper.num_quantizers))
+    assert torch.allclose(wrapper.decode_from_codebook_indices(indices), parallel_wrapper.decode_from_codebook_indices(indices))
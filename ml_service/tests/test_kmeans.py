@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.cluster import MiniBatchKMeans
+from transformers import HubertConfig, HubertModel
+
+from open_musiclm.hf_hubert_kmeans import HfHubertWithKmeans
+
+CODEBOOK_SIZE = 16
+DIM = 8
+
+
+@pytest.fixture(scope='module')
+def kmeans():
+    features = np.random.default_rng(0).standard_normal((2000, DIM), dtype=np.float32)
+    return MiniBatchKMeans(n_clusters=CODEBOOK_SIZE, n_init=3, random_state=0).fit(features)
+
+
+def tiny_hubert():
+    """a randomly initialized HubertModel, assign_clusters doesn't use it"""
+    config = HubertConfig(
+        hidden_size=DIM,
+        num_hidden_layers=1,
+        num_attention_heads=2,
+        intermediate_size=16,
+        conv_dim=(8,),
+        conv_stride=(5,),
+        conv_kernel=(10,),
+        num_conv_pos_embeddings=16,
+        num_conv_pos_embedding_groups=2,
+    )
+    return HubertModel(config)
+
+
+def make_wav2vec(**kwargs):
+    return HfHubertWithKmeans(hubert=tiny_hubert(), embed_layer=1, codebook_size=CODEBOOK_SIZE, **kwargs)
+
+
+@pytest.mark.parametrize('kmeans_chunk_size', [8192, 64, 7])
+def test_assign_clusters_matches_predict(kmeans, kmeans_chunk_size):
+    wav2vec = make_wav2vec(kmeans=kmeans, kmeans_chunk_size=kmeans_chunk_size)
+
+    embed = torch.randn(500, DIM, generator=torch.Generator().manual_seed(1))
+
+    token_ids = wav2vec.assign_clusters(embed)
+
+    assert token_ids.dtype == torch.long
+    assert torch.equal(token_ids, torch.from_numpy(kmeans.predict(embed.numpy())).long())
+
+
+def test_assign_clusters_bf16(kmeans):
+    wav2vec = make_wav2vec(kmeans=kmeans, kmeans_chunk_size=64)
+
+    embed = torch.randn(500, DIM, generator=torch.Generator().manual_seed(2)).bfloat16()
+
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16):
+        token_ids = wav2vec.assign_clusters(embed)
+
+    # the features are rounded to bf16, the distances are still computed in fp32
+    assert torch.equal(token_ids, torch.from_numpy(kmeans.predict(embed.float().numpy())).long())
+
+
+def test_cluster_centers_match_kmeans(kmeans):
+    """the exported cluster centers (export_kmeans_cluster_centers) assign like the joblib model"""
+    wav2vec = make_wav2vec(cluster_centers=torch.from_numpy(kmeans.cluster_centers_), kmeans_chunk_size=64)
+
+    embed = torch.randn(500, DIM, generator=torch.Generator().manual_seed(3))
+
+    assert torch.equal(wav2vec.assign_clusters(embed), torch.from_numpy(kmeans.predict(embed.numpy())).long())